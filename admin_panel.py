@@ -1,4 +1,5 @@
 """Веб-админ-панель бота — стиль Remnawave"""
+import asyncio
 import html
 import json
 import logging
@@ -13,6 +14,7 @@ from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 import uvicorn
 
+import metrics
 from config import Config
 from database import Database
 from remnawave_client import RemnawaveClient, RemnawaveError
@@ -222,6 +224,7 @@ async def dashboard(request: Request, _: str = Depends(verify_admin)):
     <div class="card-grid">
     <div class="card card-stat"><div class="label">Оплаченных заказов</div><div class="value">{stats['orders_succeeded']}</div></div>
     <div class="card card-stat"><div class="label">Ожидают оплаты</div><div class="value">{stats['orders_pending']}</div></div>
+    <div class="card card-stat"><div class="label">Не оплачены (истекли)</div><div class="value">{stats['orders_expired']}</div></div>
     <div class="card card-stat"><div class="label">Выручка</div><div class="value">{stats['revenue']:.0f} ₽</div></div>
     <div class="card card-stat"><div class="label">Trial</div><div class="value">{stats['trial_users']}</div></div>
     <div class="card card-stat"><div class="label">Рефералов</div><div class="value">{stats['referrals']}</div></div>
@@ -307,7 +310,7 @@ async def revoke_user(telegram_id: int, _: str = Depends(verify_admin)):
     if not db or not remnawave:
         raise HTTPException(503, "Сервисы не инициализированы")
     try:
-        deleted, _ = remnawave.revoke_user_by_telegram_id(telegram_id)
+        deleted, _ = await asyncio.to_thread(remnawave.revoke_user_by_telegram_id, telegram_id)
         await db.block_user(telegram_id, "Ключ отозван")
         msg = f"Ключ отозван ({deleted} записей)"
     except RemnawaveError as e:
@@ -315,6 +318,12 @@ async def revoke_user(telegram_id: int, _: str = Depends(verify_admin)):
     return RedirectResponse(url=f"/users?msg={msg.replace(' ', '+')}", status_code=302)
 
 
+@app.get("/metrics")
+async def metrics_json(_: str = Depends(verify_admin)):
+    """Метрики процесса: задержки внешних API и счётчики"""
+    return JSONResponse(metrics.snapshot())
+
+
 SERVICE_NAME = os.getenv("VPN_BOT_SERVICE", "vpn-bot")
 
 
@@ -468,14 +477,19 @@ async def settings_save(
     return RedirectResponse(url=f"/settings?msg=Сохранено.", status_code=302)
 
 
-def run_admin_panel(
-    cfg: Config, db_instance: Database, rw_client: RemnawaveClient
-) -> None:
-    """Запустить админ-панель на 127.0.0.1 (только SSH-туннель). Блокирующая функция для потока."""
+def configure(cfg: Config, db_instance: Database, rw_client: RemnawaveClient) -> None:
+    """Передать панели общие сервисы (БД и клиент Remnawave процесса)"""
     global config, db, remnawave
     config = cfg
     db = db_instance
     remnawave = rw_client
+
+
+def run_admin_panel(
+    cfg: Config, db_instance: Database, rw_client: RemnawaveClient
+) -> None:
+    """Запустить админ-панель на 127.0.0.1 (только SSH-туннель). Блокирующая функция для потока."""
+    configure(cfg, db_instance, rw_client)
     if not cfg.admin_panel_enabled or not cfg.admin_panel_password:
         logger.info("Админ-панель отключена или пароль не задан")
         return
@@ -2,6 +2,9 @@
 import asyncio
 import logging
 import re
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
 from typing import Optional
 
 from telegram import (
@@ -13,18 +16,39 @@ from telegram import (
 )
 from telegram.ext import (
     Application,
+    ApplicationHandlerStop,
+    CallbackContext,
     CallbackQueryHandler,
+    ChatMemberHandler,
     CommandHandler,
     ContextTypes,
+    ExtBot,
     MessageHandler,
+    TypeHandler,
     filters,
 )
+from telegram.request import HTTPXRequest
 
+import metrics
+from broadcast import BROADCAST_CONCURRENCY, BroadcastManager
 from config import Config, PlanConfig
-from database import Database
+from database import Broadcast, Database, Job, OutboxMessage, UserState
+from payments import PaymentService
+from rate_limit import (
+    BULK,
+    INTERACTIVE,
+    NOTIFY,
+    KeyedRateLimiter,
+    PriorityRateLimiter,
+    PriorityScheduler,
+)
+from persistence import SqlitePersistence
+from reminders import ExpiryReminders
 from remnawave_client import RemnawaveClient, RemnawaveError
+from subscription_view import SubscriptionView, SubscriptionViews
+from update_processor import PerUserUpdateProcessor
 from utils import extract_short_uuid, get_subscription_url
-from yookassa_client import create_payment, init_yookassa
+from yookassa_client import YookassaClient
 
 from bot_messages import (
     BACK_BUTTON,
@@ -35,13 +59,26 @@ from bot_messages import (
     BTN_MY_SUBSCRIPTION,
     BTN_REFERRAL,
     BTN_TARIFFS,
+    BROADCAST_ALREADY_RUNNING,
     BROADCAST_CANCELLED,
+    BROADCAST_CHOOSE_SEGMENT,
     BROADCAST_CONFIRM,
     BROADCAST_PREVIEW,
+    BROADCAST_PROGRESS,
     BROADCAST_RESULT,
+    BROADCAST_SEGMENT_LINE,
     BROADCAST_SEND_BUTTONS,
     BROADCAST_SEND_PHOTO,
     BROADCAST_SEND_TEXT,
+    BROADCAST_STARTED,
+    BROADCAST_STOPPED,
+    BTN_BROADCAST_STOP,
+    SEGMENT_ACTIVE,
+    SEGMENT_ALL,
+    SEGMENT_EXPIRED,
+    SEGMENT_PLAN,
+    SEGMENT_REFERRERS,
+    SEGMENT_TRIAL,
     BTN_ADMIN_BROADCAST,
     BTN_ADMIN_STATS,
     CONTACTS_COOPERATION,
@@ -51,11 +88,12 @@ from bot_messages import (
     TARIFFS_HEADING,
     TARIFFS_INTRO,
     INFO_NOT_CONFIGURED,
-    NO_SUBSCRIPTION,
+    OVERLOADED,
     PAY_BUTTON,
     PAYMENT_CREATED,
     PAYMENT_ERROR,
     PLAN_NOT_FOUND,
+    RATE_LIMITED,
     REFERRAL_BONUS_EXTENDED,
     REFERRAL_BONUS_PENDING,
     REFERRAL_DISABLED,
@@ -65,12 +103,6 @@ from bot_messages import (
     SUBSCRIBE_BUTTON,
     SUBSCRIBE_CHECK_BUTTON,
     SUBSCRIBE_TEXT,
-    SUBSCRIPTION_ACTIVE_NO_LINK,
-    SUBSCRIPTION_HEADER,
-    SUBSCRIPTION_LINK_ONLY,
-    SUBSCRIPTION_LOAD_ERROR,
-    SUBSCRIPTION_SHORT,
-    SUBSCRIPTION_WITH_PLAN,
     SUPPORT_HEADING,
     TRIAL_ACTIVATED,
     TRIAL_ALREADY_USED,
@@ -90,6 +122,65 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Глобальный лимит Telegram на исходящие сообщения одного бота, в секунду
+TELEGRAM_GLOBAL_RATE = 30
+
+# Кэш подписки на обязательный канал, сек: подписчик меняется редко, отписавшийся — проверяем чаще
+CHANNEL_MEMBER_TTL = 600
+CHANNEL_LEFT_TTL = 30
+# Выше этого размера кэш при записи очищается от устаревших записей
+CHANNEL_CACHE_MAX = 50_000
+
+# Тип задачи очереди: переход нового пользователя по реферальной ссылке
+REFERRAL_JOB = "referral.joined"
+
+# Лимиты тяжёлых действий на пользователя: (токенов в секунду, запас подряд)
+ACTION_LIMITS = {
+    "buy": (1 / 10, 3),  # платёж в Yookassa и заказ
+    "trial": (1 / 60, 2),
+    "subscription": (1 / 3, 5),  # запрос к Remnawave
+}
+# Внешний сервис действия: его задержка учитывается детектором перегрузки
+ACTION_UPSTREAM = {
+    "buy": "yookassa.create_payment",
+    "trial": "remnawave.request",
+    "subscription": "remnawave.request",
+}
+
+
+@dataclass(frozen=True)
+class MenuRenders:
+    """Готовые тексты и клавиатуры меню — зависят только от config, общие для всех обновлений"""
+    reply_keyboard: ReplyKeyboardMarkup
+    admin_reply_keyboard: ReplyKeyboardMarkup
+    tariffs: tuple[str, InlineKeyboardMarkup]
+    main_menu_full: tuple[str, InlineKeyboardMarkup]
+    main_menu_short: tuple[str, InlineKeyboardMarkup]
+
+
+@dataclass(frozen=True)
+class BotIdentity:
+    """Данные бота, известные после initialize (get_me), и префикс реферальной ссылки"""
+    id: int
+    username: str
+    referral_prefix: str
+
+    @classmethod
+    def from_bot(cls, bot: ExtBot) -> "BotIdentity":
+        """Из инициализированного Bot — без запроса к Telegram (get_me уже выполнен в initialize)"""
+        return cls(bot.id, bot.username, f"https://t.me/{bot.username}?start=ref_")
+
+    def referral_link(self, telegram_id: int) -> str:
+        return f"{self.referral_prefix}{telegram_id}"
+
+
+class BotContext(CallbackContext[ExtBot, dict, dict, dict]):
+    """Контекст обработчиков: user_state заполняет guard до вызова обработчиков"""
+
+    def __init__(self, application: Application, chat_id: Optional[int] = None, user_id: Optional[int] = None):
+        super().__init__(application, chat_id=chat_id, user_id=user_id)
+        self.user_state: Optional[UserState] = None
+
 
 class VPNBot:
     """Бот для продажи VPN подписок"""
@@ -98,9 +189,33 @@ class VPNBot:
         self.config = config
         self.db = Database()
         self.remnawave = RemnawaveClient(config.remnawave)
+        self.yookassa: Optional[YookassaClient] = None
+        self.payments: Optional[PaymentService] = None
+        self.broadcasts = BroadcastManager(self.db, rate=config.broadcast_rate)
+        # Общий бюджет запросов к Telegram; у каждого класса трафика свой Bot и пул соединений
+        self.telegram_scheduler = PriorityScheduler(rate=TELEGRAM_GLOBAL_RATE)
+        self.notify_bot: Optional[ExtBot] = None
+        self.bulk_bot: Optional[ExtBot] = None
+        self.update_processor = PerUserUpdateProcessor(config.update_concurrency)
+        # Постановка фоновой задачи; main.py подставляет webhook.enqueue_job — с пробуждением пула
+        self.enqueue_job = self.db.enqueue_job
+        # user_data (реферер, шаги рассылки) переживает перезапуск
+        self.persistence = SqlitePersistence(self.db)
+        self.reminders = ExpiryReminders(self.db, config)
+        self.subscriptions = SubscriptionViews(self.db, self.remnawave, config)
+        self.flood = {
+            action: KeyedRateLimiter(rate, capacity)
+            for action, (rate, capacity) in ACTION_LIMITS.items()
+        }
+        # telegram_id -> (подписан на канал, monotonic-время устаревания)
+        self._channel_members: dict[int, tuple[bool, float]] = {}
+        self.identity: Optional[BotIdentity] = None
+        # Кэш меню (_menus), собирается при первом обращении
+        self._menus_cache: Optional[MenuRenders] = None
 
         if config.yookassa_shop_id and config.yookassa_secret_key:
-            init_yookassa(config.yookassa_shop_id, config.yookassa_secret_key)
+            self.yookassa = YookassaClient(config.yookassa_shop_id, config.yookassa_secret_key)
+            self.payments = PaymentService(config, self.db, self.yookassa)
 
     def _parse_referrer_from_start(self, context: ContextTypes.DEFAULT_TYPE) -> Optional[int]:
         """Извлечь referrer_id из /start ref_12345"""
@@ -123,28 +238,129 @@ class VPNBot:
         """Получить referrer_id из user_data"""
         return (context.user_data or {}).get("referrer_id")
 
-    async def _check_blocked(self, update: Update, user_id: int) -> bool:
-        """Проверить блокировку. Возвращает True если заблокирован."""
-        if await self.db.is_blocked(user_id):
-            text = BLOCKED
-            if update.message:
-                await update.message.reply_text(text)
-            elif update.callback_query:
-                await update.callback_query.answer()
-                await update.callback_query.edit_message_text(text)
+    async def _reply_blocked(self, update: Update) -> None:
+        """Ответить заблокированному пользователю"""
+        text = BLOCKED
+        if update.message:
+            await update.message.reply_text(text)
+        elif update.callback_query:
+            await update.callback_query.answer()
+            await update.callback_query.edit_message_text(text)
+
+    async def guard(self, update: Update, context: BotContext) -> None:
+        """
+        Группа -1, до всех обработчиков: состояние пользователя одним запросом к БД
+        (context.user_state), затем блокировка и подписка на канал. Если пользователю
+        нужно ответить отказом — ApplicationHandlerStop, обработчики не вызываются.
+        Админы проверки не проходят (рассылка и статистика не прерываются).
+        """
+        user = update.effective_user
+        if not user or not (update.message or update.callback_query):
+            return
+        state = await self.db.get_user_state(user.id)
+        context.user_state = state
+        if user.id in self.config.admin_ids:
+            return
+        if state.blocked:
+            await self._reply_blocked(update)
+            raise ApplicationHandlerStop
+        # Кнопка «Проверить подписку» всегда спрашивает Telegram
+        fresh = bool(update.callback_query and update.callback_query.data == "check_sub")
+        if await self._check_subscription(update, user.id, context.bot, fresh=fresh):
+            raise ApplicationHandlerStop
+
+    def _overloaded(self, action: str) -> bool:
+        """Перегрузка: слишком много пользователей ждут обработки или внешний сервис действия отвечает медленно"""
+        if self.update_processor.active > self.config.overload_max_pending:
             return True
-        return False
+        limit = self.config.overload_latency_ms
+        return limit > 0 and metrics.recent_latency(ACTION_UPSTREAM[action]) > limit
+
+    async def _throttle(self, update: Update, user_id: int, action: str) -> bool:
+        """
+        Лимит тяжёлого действия. Возвращает True (и отвечает пользователю), если
+        действие сейчас выполнять нельзя. Вызывать до query.answer().
+        """
+        if self._overloaded(action):
+            metrics.incr(f"shed.{action}")
+            text = OVERLOADED
+        elif user_id not in self.config.admin_ids and not self.flood[action].allow(user_id):
+            metrics.incr(f"flood.{action}")
+            text = RATE_LIMITED
+        else:
+            return False
+        if update.callback_query:
+            await update.callback_query.answer(text, show_alert=True)
+        elif update.message:
+            await update.message.reply_text(text)
+        return True
+
+    async def _user_state(self, context: BotContext, user_id: int) -> UserState:
+        """Состояние из guard; если обновление прошло мимо него — запросить"""
+        state = getattr(context, "user_state", None)
+        if state is None or state.telegram_id != user_id:
+            state = await self.db.get_user_state(user_id)
+        return state
+
+    async def _register_visit(self, state: UserState) -> bool:
+        """Первый ли это визит; запись в user_seen — только если её нет или пользователь был недоступен"""
+        if state.seen and not state.unreachable:
+            return False
+        return await self.db.is_first_visit(state.telegram_id)
+
+    def _cache_membership(self, user_id: int, is_member: bool) -> None:
+        """Запомнить подписку на канал с TTL по статусу"""
+        now = time.monotonic()
+        if len(self._channel_members) >= CHANNEL_CACHE_MAX:
+            self._channel_members = {
+                uid: entry for uid, entry in self._channel_members.items() if entry[1] > now
+            }
+        ttl = CHANNEL_MEMBER_TTL if is_member else CHANNEL_LEFT_TTL
+        self._channel_members[user_id] = (is_member, now + ttl)
+
+    async def _is_channel_member(self, bot, channel_id: str, user_id: int, fresh: bool) -> bool:
+        """Подписан ли пользователь на канал: из кэша или через get_chat_member (fresh — мимо кэша)"""
+        cached = self._channel_members.get(user_id)
+        if cached and not fresh and cached[1] > time.monotonic():
+            metrics.incr("channel_check.cache_hit")
+            return cached[0]
+        metrics.incr("channel_check.api")
+        member = await bot.get_chat_member(chat_id=channel_id, user_id=user_id)
+        is_member = member.status not in ("left", "kicked")
+        self._cache_membership(user_id, is_member)
+        return is_member
+
+    def _is_forced_channel(self, chat) -> bool:
+        """Относится ли чат к обязательному каналу (FORCED_CHANNEL_ID — числовой ID или @username)"""
+        channel_id = str(self.config.forced_channel_id or "")
+        if str(chat.id) == channel_id:
+            return True
+        return bool(chat.username) and channel_id.lstrip("@").lower() == chat.username.lower()
 
-    async def _check_subscription(self, update: Update, user_id: int, bot) -> bool:
-        """Проверить подписку на канал. Возвращает True если нужно подписаться."""
+    async def channel_member_update(
+        self, update: Update, context: ContextTypes.DEFAULT_TYPE
+    ) -> None:
+        """Обновление участника канала (бот — админ канала): освежить кэш подписки без запроса к API"""
+        change = update.chat_member
+        if not change or not self._is_forced_channel(change.chat):
+            return
+        member = change.new_chat_member
+        self._cache_membership(member.user.id, member.status not in ("left", "kicked"))
+
+    async def _check_subscription(
+        self, update: Update, user_id: int, bot, fresh: bool = False
+    ) -> bool:
+        """
+        Проверить подписку на канал. Возвращает True если нужно подписаться.
+        fresh=True — не брать результат из кэша (кнопка «Проверить подписку»).
+        """
         if not self.config.forced_channel_enabled:
             return False
         channel_id = self.config.forced_channel_id
         if not channel_id:
             return False
         try:
-            member = await bot.get_chat_member(chat_id=channel_id, user_id=user_id)
-            if member.status in ("left", "kicked"):
+            if not await self._is_channel_member(bot, channel_id, user_id, fresh):
                 username = self.config.forced_channel_username or ""
                 link = f"https://t.me/{username.lstrip('@')}" if username else f"https://t.me/c/{str(channel_id).replace('-100', '')}"
                 text = SUBSCRIBE_TEXT.format(link=link)
@@ -159,7 +375,7 @@ class VPNBot:
             logger.warning(f"Ошибка проверки подписки: {e}")
         return False
 
-    def _get_main_reply_keyboard(self, telegram_id: Optional[int] = None) -> ReplyKeyboardMarkup:
+    def _reply_keyboard_rows(self, admin: bool) -> list[list[KeyboardButton]]:
         """Постоянные кнопки главного меню. Для админов добавляются Статистика и Рассылка."""
         buttons = [
             [KeyboardButton(BTN_TARIFFS), KeyboardButton(BTN_MY_SUBSCRIPTION)],
@@ -170,27 +386,12 @@ class VPNBot:
             buttons.append([KeyboardButton(BTN_CONTACTS)])
         if self.config.referral_days > 0:
             buttons.append([KeyboardButton(BTN_REFERRAL)])
-        if telegram_id is not None and telegram_id in self.config.admin_ids:
+        if admin:
             buttons.append([KeyboardButton(BTN_ADMIN_STATS), KeyboardButton(BTN_ADMIN_BROADCAST)])
-        return ReplyKeyboardMarkup(
-            buttons,
-            resize_keyboard=True,
-            one_time_keyboard=False,
-        )
-
-    def _get_welcome_only_text(self, user_first_name: str, is_first_visit: bool) -> str:
-        """Текст приветствия — одна строка: добро пожаловать или с возвращением."""
-        if is_first_visit:
-            return WELCOME_SIMPLE_NEW.format(vpn_name=self.config.vpn_name)
-        return WELCOME_SIMPLE_RETURN.format(name=user_first_name)
+        return buttons
 
-    def _get_tariffs_inline(self) -> tuple[str, list[list[InlineKeyboardButton]]]:
-        """Текст тарифов и инлайн-кнопки (без техподдержки — она в главном меню)."""
-        text = TARIFFS_INTRO + "\n\n"
-        text += TARIFFS_HEADING + "\n"
-        for plan in self.config.plans:
-            text += f"• {plan.name} — {plan.price:.0f} ₽\n"
-        text += "\n" + CHOOSE_TARIFF
+    def _plan_buttons(self) -> list[list[InlineKeyboardButton]]:
+        """Кнопки покупки тарифов и пробного периода"""
         keyboard: list[list[InlineKeyboardButton]] = []
         for plan in self.config.plans:
             keyboard.append([
@@ -206,73 +407,94 @@ class VPNBot:
                     callback_data="trial",
                 )
             ])
-        return text, keyboard
-
-    def _build_main_menu(
-        self, user_first_name: str, full_welcome: bool = True
-    ) -> tuple[str, list[list[InlineKeyboardButton]]]:
-        """Собрать текст и клавиатуру главного меню"""
-        vpn = self.config.vpn_name
-        text = WELCOME_PREFIX.format(vpn_name=vpn) + "\n\n"
-        text += f"{self.config.keyboard_info}\n\n"
-        if full_welcome:
-            text += TARIFFS_HEADING + "\n"
-            for plan in self.config.plans:
-                text += f"• *{plan.name}* — {plan.price:.0f} ₽\n"
-            text += "\n" + CHOOSE_TARIFF
-        else:
-            text += CHOOSE_TARIFF
-        keyboard: list[list[InlineKeyboardButton]] = []
+        return keyboard
+
+    def _render_menus(self) -> MenuRenders:
+        """Собрать тексты и клавиатуры меню из текущего config и bot_messages"""
+        plan_keyboard = InlineKeyboardMarkup(self._plan_buttons())
+
+        tariffs_text = TARIFFS_INTRO + "\n\n"
+        tariffs_text += TARIFFS_HEADING + "\n"
         for plan in self.config.plans:
-            keyboard.append([
-                InlineKeyboardButton(
-                    f"{plan.name} — {plan.price:.0f} ₽",
-                    callback_data=f"buy:{plan.id}",
-                )
-            ])
-        if self.config.trial_days > 0:
-            keyboard.append([
-                InlineKeyboardButton(
-                    TRIAL_BUTTON.format(days=self.config.trial_days),
-                    callback_data="trial",
-                )
-            ])
-        return text, keyboard
+            tariffs_text += f"• {plan.name} — {plan.price:.0f} ₽\n"
+        tariffs_text += "\n" + CHOOSE_TARIFF
+
+        menu_text = WELCOME_PREFIX.format(vpn_name=self.config.vpn_name) + "\n\n"
+        menu_text += f"{self.config.keyboard_info}\n\n"
+        full_text = menu_text + TARIFFS_HEADING + "\n"
+        for plan in self.config.plans:
+            full_text += f"• *{plan.name}* — {plan.price:.0f} ₽\n"
+        full_text += "\n" + CHOOSE_TARIFF
+
+        return MenuRenders(
+            reply_keyboard=ReplyKeyboardMarkup(
+                self._reply_keyboard_rows(admin=False), resize_keyboard=True, one_time_keyboard=False
+            ),
+            admin_reply_keyboard=ReplyKeyboardMarkup(
+                self._reply_keyboard_rows(admin=True), resize_keyboard=True, one_time_keyboard=False
+            ),
+            tariffs=(tariffs_text, plan_keyboard),
+            main_menu_full=(full_text, plan_keyboard),
+            main_menu_short=(menu_text + CHOOSE_TARIFF, plan_keyboard),
+        )
+
+    @property
+    def _menus(self) -> MenuRenders:
+        """
+        Кэш меню на всё время работы процесса: config не меняется, а настройки из
+        админ-панели (тарифы, тексты) применяются перезапуском сервиса.
+        """
+        if self._menus_cache is None:
+            self._menus_cache = self._render_menus()
+        return self._menus_cache
+
+    def load_identity(self, bot: ExtBot) -> BotIdentity:
+        """Запомнить данные бота (вызывается после app.initialize)"""
+        self.identity = BotIdentity.from_bot(bot)
+        return self.identity
+
+    def _referral_link(self, bot: ExtBot, telegram_id: int) -> str:
+        identity = self.identity or self.load_identity(bot)
+        return identity.referral_link(telegram_id)
+
+    def _get_main_reply_keyboard(self, telegram_id: Optional[int] = None) -> ReplyKeyboardMarkup:
+        """Постоянные кнопки главного меню (из кэша). Для админов — со Статистикой и Рассылкой."""
+        if telegram_id is not None and telegram_id in self.config.admin_ids:
+            return self._menus.admin_reply_keyboard
+        return self._menus.reply_keyboard
+
+    def _get_welcome_only_text(self, user_first_name: str, is_first_visit: bool) -> str:
+        """Текст приветствия — одна строка: добро пожаловать или с возвращением."""
+        if is_first_visit:
+            return WELCOME_SIMPLE_NEW.format(vpn_name=self.config.vpn_name)
+        return WELCOME_SIMPLE_RETURN.format(name=user_first_name)
+
+    def _get_tariffs_inline(self) -> tuple[str, InlineKeyboardMarkup]:
+        """Текст тарифов и инлайн-кнопки (без техподдержки — она в главном меню)."""
+        return self._menus.tariffs
 
-    async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    def _build_main_menu(self, full_welcome: bool = True) -> tuple[str, InlineKeyboardMarkup]:
+        """Текст и клавиатура главного меню (из кэша)"""
+        return self._menus.main_menu_full if full_welcome else self._menus.main_menu_short
+
+    async def start(self, update: Update, context: BotContext) -> None:
         """Обработка команды /start"""
         user = update.effective_user
         if not user:
             return
-        if await self._check_blocked(update, user.id):
-            return
-        if await self._check_subscription(update, user.id, context.bot):
-            return
+        state = await self._user_state(context, user.id)
 
         # Реферальная ссылка: /start ref_12345 — бонус за переход нового пользователя
         referrer_id = self._parse_referrer_from_start(context)
+        new_referral = False
         if referrer_id and referrer_id != user.id and self.config.referral_days > 0:
             self._save_referrer(context, referrer_id)
-            if await self.db.user_is_new(user.id):
-                try:
-                    extended = self.remnawave.extend_user_by_telegram_id(
-                        referrer_id, self.config.referral_days
-                    )
-                    await self.db.add_referral(referrer_id, user.id, order_id=None)
-                    if extended and self.config.referral_days > 0:
-                        await context.bot.send_message(
-                            chat_id=referrer_id,
-                            text=REFERRAL_BONUS_EXTENDED.format(days=self.config.referral_days),
-                        )
-                    else:
-                        await context.bot.send_message(
-                            chat_id=referrer_id,
-                            text=REFERRAL_BONUS_PENDING,
-                        )
-                except Exception as e:
-                    logger.error(f"Ошибка реферального бонуса: {e}")
+            new_referral = state.is_new
+        # Бонус, не начисленный за все попытки задачи (панель была недоступна), — ещё раз
+        if state.referral_pending and self.config.referral_days > 0:
+            referrer_id, new_referral = state.referrer_id, True
 
-        is_first_visit = await self.db.is_first_visit(user.id)
+        is_first_visit = await self._register_visit(state)
         name = user.first_name or "User"
         welcome_text = self._get_welcome_only_text(name, is_first_visit)
         reply_kbd = self._get_main_reply_keyboard(user.id)
@@ -288,19 +510,88 @@ class VPNBot:
         await update.message.reply_text(
             tariffs_text,
             parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(tariffs_keyboard),
+            reply_markup=tariffs_keyboard,
+        )
+
+        # Бонус рефереру — в фоне (referral_job), после ответа пользователю
+        if new_referral:
+            await self.enqueue_job(
+                REFERRAL_JOB,
+                {"referrer_id": referrer_id, "referral_id": user.id},
+                event_id=f"referral:{user.id}",
+            )
+
+    async def referral_job(self, job: Job, last_attempt: bool) -> None:
+        """
+        Задача очереди: начислить бонус рефереру и уведомить его (через outbox).
+        Окончание после бонуса вычисляется один раз и сохраняется в referrals до
+        обращения к панели; повторы (в том числе после таймаута, когда прерванный
+        поток всё же дописал продление) доводят окончание до той же даты, а не
+        прибавляют дни заново. rewarded_at ставится после продления.
+        """
+        referrer_id = int(job.payload["referrer_id"])
+        referral_id = int(job.payload["referral_id"])
+        if not await self.db.claim_referral(referrer_id, referral_id):
+            logger.info(f"Реферал {referral_id} от {referrer_id}: бонус уже начислен или реферер другой")
+            return
+        days = self.config.referral_days
+        plan = await self.db.get_referral_bonus_plan(referrer_id, referral_id)
+        if plan is None:
+            plan = await asyncio.to_thread(self._plan_referrer_bonus, referrer_id, days)
+            if plan is not None:
+                await self.db.save_referral_bonus_plan(referrer_id, referral_id, *plan)
+                # Параллельная попытка могла записать свой план раньше — действует он
+                plan = await self.db.get_referral_bonus_plan(referrer_id, referral_id)
+        if plan is not None:
+            expires_at = await asyncio.to_thread(self.remnawave.ensure_user_expiration, *plan)
+            await self.subscriptions.extended(referrer_id, expires_at)
+        text = REFERRAL_BONUS_EXTENDED.format(days=days) if plan else REFERRAL_BONUS_PENDING
+        await self.db.mark_referral_rewarded(
+            referrer_id, referral_id, notifications=[OutboxMessage(referrer_id, text)]
         )
 
+    async def referral_dead(self, job: Job, error: Exception) -> None:
+        """
+        Все попытки referral_job исчерпаны: запись и план в referrals остаются
+        (rewarded_at пуст), событие снимается — следующий /start реферала
+        поставит задачу снова, и она доведёт продление до сохранённой даты.
+        """
+        referral_id = int(job.payload["referral_id"])
+        logger.error(f"Бонус за реферала {referral_id} не начислен: {error}")
+        await self.db.forget_event(f"referral:{referral_id}")
+
+    def _plan_referrer_bonus(self, referrer_id: int, days: int) -> Optional[tuple[str, datetime]]:
+        """
+        Пользователь Remnawave реферера (с самым поздним окончанием) и окончание после
+        бонуса; None — реферера нет в панели. Ошибки API пробрасываются
+        """
+        users = self.remnawave.get_user_by_telegram_id(referrer_id) or []
+        users = [u for u in users if isinstance(u, dict)]
+        oldest = datetime.min.replace(tzinfo=timezone.utc)
+        user = max(users, key=lambda u: RemnawaveClient.user_expiration(u) or oldest, default=None)
+        user_uuid = user and (user.get("uuid") or user.get("id"))
+        if not user_uuid:
+            return None
+        now = datetime.now(timezone.utc)
+        current = RemnawaveClient.user_expiration(user)
+        return user_uuid, max(current or now, now) + timedelta(days=days)
+
+    async def expiry_reminder_job(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """JobQueue: поставить в outbox напоминания об окончании подписки"""
+        try:
+            await self.reminders.scan()
+        except Exception as e:
+            logger.exception(f"Ошибка проверки окончания подписок: {e}")
+
     async def buy_callback(
         self, update: Update, context: ContextTypes.DEFAULT_TYPE
     ) -> None:
         """Обработка нажатия на кнопку покупки"""
         query = update.callback_query
+        if query.from_user and await self._throttle(update, query.from_user.id, "buy"):
+            return
         await query.answer()
         user = query.from_user
-        if user and (await self._check_blocked(update, user.id) or await self._check_subscription(update, user.id, context.bot)):
-            return
-
         if not query.data or not query.data.startswith("buy:"):
             return
 
@@ -312,47 +603,22 @@ class VPNBot:
         if not user:
             return
 
-        telegram_id = user.id
+        if not self.payments:
+            logger.error("Yookassa не настроена (YOOKASSA_SHOP_ID / YOOKASSA_SECRET_KEY)")
+            await query.edit_message_text(PAYMENT_ERROR)
+            return
 
         try:
-            # Создаём платёж в Yookassa
-            return_url = f"{self.config.webhook_base_url}/return"
-            description = f"VPN подписка: {plan.name}"
-
-            referrer_id = self._get_referrer(context)
-            metadata = {
-                "telegram_id": str(telegram_id),
-                "plan_id": plan_id,
-            }
-            if referrer_id:
-                metadata["referrer_id"] = str(referrer_id)
-
-            payment = create_payment(
-                amount=plan.price,
-                description=description,
-                return_url=return_url,
-                metadata=metadata,
-            )
-
-            confirmation_url = payment.get("confirmation_url")
-            if not confirmation_url:
-                logger.error("Yookassa не вернула confirmation_url: %s", payment)
-                await query.edit_message_text(PAYMENT_ERROR)
-                return
-
-            # Сохраняем заказ в БД
-            await self.db.create_order(
-                payment_id=payment["id"],
-                telegram_id=telegram_id,
-                plan_id=plan_id,
-                plan_name=plan.name,
-                amount=plan.price,
-                referrer_id=referrer_id,
+            # Ссылка на оплату: повторно выдаём неоплаченную или создаём платёж в Yookassa
+            checkout = await self.payments.checkout(
+                telegram_id=user.id,
+                plan=plan,
+                referrer_id=self._get_referrer(context),
             )
 
             # Отправляем ссылку на оплату
             keyboard = [
-                [InlineKeyboardButton(PAY_BUTTON, url=confirmation_url)],
+                [InlineKeyboardButton(PAY_BUTTON, url=checkout.confirmation_url)],
                 [InlineKeyboardButton(BACK_BUTTON, callback_data="back")],
             ]
             text = PAYMENT_CREATED.format(plan_name=plan.name, plan_price=plan.price)
@@ -371,94 +637,45 @@ class VPNBot:
     ) -> None:
         """Показать информацию о подписке пользователя"""
         query = update.callback_query
-        await query.answer()
         user = query.from_user
         if not user:
+            await query.answer()
             return
-        if await self._check_blocked(update, user.id) or await self._check_subscription(update, user.id, context.bot):
+        view = await self._subscription_view(update, user.id)
+        if view is None:
             return
+        await query.answer()
+        button = (
+            InlineKeyboardButton(BACK_BUTTON, callback_data="back")
+            if view.has_subscription
+            else InlineKeyboardButton(BTN_CHOOSE_TARIFF, callback_data="back")
+        )
+        await query.edit_message_text(
+            view.text,
+            parse_mode="Markdown",
+            reply_markup=InlineKeyboardMarkup([[button]]),
+        )
 
-        try:
-            users = self.remnawave.get_user_by_telegram_id(user.id)
-
-            if not users or (isinstance(users, list) and len(users) == 0):
-                # Проверяем в наших заказах
-                orders = await self.db.get_user_orders(user.id)
-                active_orders = [o for o in orders if o.status == "succeeded" and o.short_uuid]
-
-                if not active_orders:
-                    keyboard = [[InlineKeyboardButton(BTN_CHOOSE_TARIFF, callback_data="back")]]
-                    await query.edit_message_text(
-                        NO_SUBSCRIPTION,
-                        reply_markup=InlineKeyboardMarkup(keyboard),
-                    )
-                    return
-
-                # Берём последний активный заказ
-                order = active_orders[0]
-                subscription_url = get_subscription_url(
-                    order.short_uuid, self.config.remnawave.subscription_base_url
-                )
-
-                text = SUBSCRIPTION_WITH_PLAN.format(
-                    plan_name=order.plan_name,
-                    subscription_url=subscription_url,
-                )
-            else:
-                # Пользователь найден в Remnawave
-                rw_user = users[0] if isinstance(users, list) else users
-                short_uuid = extract_short_uuid(rw_user)
-                if short_uuid:
-                    subscription_url = get_subscription_url(
-                        short_uuid, self.config.remnawave.subscription_base_url
-                    )
-                    text = SUBSCRIPTION_LINK_ONLY.format(subscription_url=subscription_url)
-                else:
-                    text = SUBSCRIPTION_ACTIVE_NO_LINK
-
-            keyboard = [[InlineKeyboardButton(BACK_BUTTON, callback_data="back")]]
-            await query.edit_message_text(
-                text,
-                parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup(keyboard),
-            )
-
-        except RemnawaveError as e:
-            logger.error(f"Ошибка Remnawave: {e}")
-            # Показываем из наших заказов
-            orders = await self.db.get_user_orders(user.id)
-            active = [o for o in orders if o.status == "succeeded" and o.short_uuid]
-            if active:
-                order = active[0]
-                sub_url = get_subscription_url(
-                    order.short_uuid, self.config.remnawave.subscription_base_url
-                )
-                await query.edit_message_text(
-                    SUBSCRIPTION_SHORT.format(subscription_url=sub_url),
-                    parse_mode="Markdown",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton(BACK_BUTTON, callback_data="back")]
-                    ]),
-                )
-            else:
-                await query.edit_message_text(
-                    SUBSCRIPTION_LOAD_ERROR,
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton(BACK_BUTTON, callback_data="back")]
-                    ]),
-                )
+    async def _subscription_view(self, update: Update, user_id: int) -> Optional[SubscriptionView]:
+        """Экран подписки; лимит и перегрузка — только если экрана нет в кэше (None — отклонено)"""
+        view = self.subscriptions.cached(user_id)
+        if view:
+            return view
+        if await self._throttle(update, user_id, "subscription"):
+            return None
+        return await self.subscriptions.get(user_id)
 
     async def trial_callback(
-        self, update: Update, context: ContextTypes.DEFAULT_TYPE
+        self, update: Update, context: BotContext
     ) -> None:
         """Обработка запроса пробного периода"""
         query = update.callback_query
+        if query.from_user and await self._throttle(update, query.from_user.id, "trial"):
+            return
         await query.answer()
         user = query.from_user
         if not user:
             return
-        if await self._check_blocked(update, user.id) or await self._check_subscription(update, user.id, context.bot):
-            return
 
         if self.config.trial_days <= 0:
             await query.edit_message_text(
@@ -469,8 +686,8 @@ class VPNBot:
             )
             return
 
-        used = await self.db.has_used_trial(user.id)
-        if used:
+        state = await self._user_state(context, user.id)
+        if state.trial_used:
             await query.edit_message_text(
                 TRIAL_ALREADY_USED,
                 reply_markup=InlineKeyboardMarkup([
@@ -488,12 +705,14 @@ class VPNBot:
                 data_limit_gb=self.config.trial_data_limit_gb,
             )
             username = f"trial_{user.id}"
-            user_data = self.remnawave.create_user(
+            user_data = await asyncio.to_thread(
+                self.remnawave.create_user,
                 username=username,
                 plan=trial_plan,
                 telegram_id=user.id,
             )
             await self.db.add_trial_user(user.id)
+            self.subscriptions.invalidate(user.id)
 
             short_uuid = extract_short_uuid(user_data)
 
@@ -535,8 +754,6 @@ class VPNBot:
         user = query.from_user
         if not user:
             return
-        if await self._check_blocked(update, user.id) or await self._check_subscription(update, user.id, context.bot):
-            return
 
         if self.config.referral_days <= 0:
             await query.edit_message_text(
@@ -547,9 +764,7 @@ class VPNBot:
             )
             return
 
-        bot_info = await context.bot.get_me()
-        bot_username = bot_info.username
-        ref_link = f"https://t.me/{bot_username}?start=ref_{user.id}"
+        ref_link = self._referral_link(context.bot, user.id)
         text = REFERRAL_TEXT.format(
             referral_days=self.config.referral_days,
             ref_link=ref_link,
@@ -563,17 +778,15 @@ class VPNBot:
         )
 
     async def check_sub_callback(
-        self, update: Update, context: ContextTypes.DEFAULT_TYPE
+        self, update: Update, context: BotContext
     ) -> None:
-        """Проверка подписки — если подписался, показать приветствие и тарифы"""
+        """Проверка подписки (выполнил guard без кэша) — подписался: приветствие и тарифы"""
         query = update.callback_query
         await query.answer()
         user = query.from_user
         if not user:
             return
-        if await self._check_subscription(update, user.id, context.bot):
-            return
-        is_first_visit = await self.db.is_first_visit(user.id)
+        is_first_visit = await self._register_visit(await self._user_state(context, user.id))
         name = user.first_name or "User"
         welcome_text = self._get_welcome_only_text(name, is_first_visit)
         tariffs_text, tariffs_keyboard = self._get_tariffs_inline()
@@ -592,7 +805,7 @@ class VPNBot:
             chat_id=chat_id,
             text=tariffs_text,
             parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(tariffs_keyboard),
+            reply_markup=tariffs_keyboard,
         )
 
     async def main_menu_message(
@@ -603,18 +816,12 @@ class VPNBot:
         user = update.effective_user
         if not user:
             return
-        if await self._check_blocked(update, user.id):
-            return
-        if await self._check_subscription(update, user.id, context.bot):
-            return
         if text == BTN_TARIFFS:
-            welcome_text, keyboard = self._build_main_menu(
-                user.first_name or "User", full_welcome=False
-            )
+            welcome_text, keyboard = self._build_main_menu(full_welcome=False)
             await update.message.reply_text(
                 welcome_text,
                 parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup(keyboard),
+                reply_markup=keyboard,
             )
         elif text == BTN_MY_SUBSCRIPTION:
             await self._handle_my_subscription_via_message(update, context)
@@ -636,59 +843,20 @@ class VPNBot:
         user = update.effective_user
         if not user:
             return
-        try:
-            users = self.remnawave.get_user_by_telegram_id(user.id)
-            if not users or (isinstance(users, list) and len(users) == 0):
-                orders = await self.db.get_user_orders(user.id)
-                active_orders = [o for o in orders if o.status == "succeeded" and o.short_uuid]
-                if not active_orders:
-                    keyboard = [[InlineKeyboardButton(BTN_CHOOSE_TARIFF, callback_data="back")]]
-                    await update.message.reply_text(
-                        NO_SUBSCRIPTION,
-                        reply_markup=InlineKeyboardMarkup(keyboard),
-                    )
-                    return
-                order = active_orders[0]
-                subscription_url = get_subscription_url(
-                    order.short_uuid, self.config.remnawave.subscription_base_url
-                )
-                msg = SUBSCRIPTION_WITH_PLAN.format(
-                    plan_name=order.plan_name,
-                    subscription_url=subscription_url,
-                )
-            else:
-                rw_user = users[0] if isinstance(users, list) else users
-                short_uuid = extract_short_uuid(rw_user)
-                if short_uuid:
-                    subscription_url = get_subscription_url(
-                        short_uuid, self.config.remnawave.subscription_base_url
-                    )
-                    msg = SUBSCRIPTION_LINK_ONLY.format(subscription_url=subscription_url)
-                else:
-                    msg = SUBSCRIPTION_ACTIVE_NO_LINK
-            await update.message.reply_text(
-                msg,
-                parse_mode="Markdown",
-                reply_markup=self._get_main_reply_keyboard(user.id),
+        view = await self._subscription_view(update, user.id)
+        if view is None:
+            return
+        if view.has_subscription:
+            reply_markup = self._get_main_reply_keyboard(user.id)
+        else:
+            reply_markup = InlineKeyboardMarkup(
+                [[InlineKeyboardButton(BTN_CHOOSE_TARIFF, callback_data="back")]]
             )
-        except RemnawaveError as e:
-            logger.error(f"Ошибка Remnawave: {e}")
-            orders = await self.db.get_user_orders(user.id)
-            active = [o for o in orders if o.status == "succeeded" and o.short_uuid]
-            if active:
-                sub_url = get_subscription_url(
-                    active[0].short_uuid, self.config.remnawave.subscription_base_url
-                )
-                await update.message.reply_text(
-                    SUBSCRIPTION_SHORT.format(subscription_url=sub_url),
-                    parse_mode="Markdown",
-                    reply_markup=self._get_main_reply_keyboard(user.id),
-                )
-            else:
-                await update.message.reply_text(
-                    SUBSCRIPTION_LOAD_ERROR,
-                    reply_markup=self._get_main_reply_keyboard(user.id),
-                )
+        await update.message.reply_text(
+            view.text,
+            parse_mode="Markdown",
+            reply_markup=reply_markup,
+        )
 
     def _normalize_link(self, raw: str) -> str:
         """Преобразовать ссылку (t.me/..., @user) в полный URL."""
@@ -756,8 +924,7 @@ class VPNBot:
                 reply_markup=self._get_main_reply_keyboard(user.id),
             )
             return
-        bot_info = await context.bot.get_me()
-        ref_link = f"https://t.me/{bot_info.username}?start=ref_{user.id}"
+        ref_link = self._referral_link(context.bot, user.id)
         text = REFERRAL_TEXT.format(
             referral_days=self.config.referral_days,
             ref_link=ref_link,
@@ -777,16 +944,12 @@ class VPNBot:
         user = query.from_user
         if not user:
             return
-        if await self._check_blocked(update, user.id) or await self._check_subscription(update, user.id, context.bot):
-            return
-        welcome_text, keyboard = self._build_main_menu(
-            user.first_name or "User", full_welcome=False
-        )
+        welcome_text, keyboard = self._build_main_menu(full_welcome=False)
 
         await query.edit_message_text(
             welcome_text,
             parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            reply_markup=keyboard,
         )
 
     async def stats_command(
@@ -802,6 +965,7 @@ class VPNBot:
         text = STATS_TEXT.format(
             orders_succeeded=stats["orders_succeeded"],
             orders_pending=stats["orders_pending"],
+            orders_expired=stats["orders_expired"],
             revenue=stats["revenue"],
             trial_users=stats["trial_users"],
             referrals=stats["referrals"],
@@ -824,6 +988,7 @@ class VPNBot:
         text = STATS_TEXT.format(
             orders_succeeded=stats["orders_succeeded"],
             orders_pending=stats["orders_pending"],
+            orders_expired=stats["orders_expired"],
             revenue=stats["revenue"],
             trial_users=stats["trial_users"],
             referrals=stats["referrals"],
@@ -845,11 +1010,135 @@ class VPNBot:
             context.user_data = {}
         context.user_data["broadcast_state"] = "wait_text"
         context.user_data["broadcast_buttons"] = []
+        context.user_data.pop("broadcast_segment", None)
         await update.message.reply_text(
             BROADCAST_SEND_TEXT,
             reply_markup=self._get_main_reply_keyboard(user.id),
         )
 
+    def _broadcast_stop_keyboard(self, broadcast_id: int) -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup(
+            [[InlineKeyboardButton(BTN_BROADCAST_STOP, callback_data=f"bc_stop:{broadcast_id}")]]
+        )
+
+    def _start_broadcast(self, broadcast: Broadcast) -> None:
+        """
+        Запустить рассылку в фоне: отправка — через bulk_bot (остаток бюджета Telegram),
+        прогресс — правкой статусного сообщения, итог — новым сообщением (через notify_bot).
+        """
+        bot = self.notify_bot
+
+        async def progress(b: Broadcast) -> None:
+            if b.status_chat_id and b.status_message_id:
+                await bot.edit_message_text(
+                    chat_id=b.status_chat_id,
+                    message_id=b.status_message_id,
+                    text=BROADCAST_PROGRESS.format(
+                        id=b.id, done=b.processed, total=b.total,
+                        sent=b.sent, unreachable=b.unreachable, failed=b.failed,
+                    ),
+                    reply_markup=self._broadcast_stop_keyboard(b.id),
+                )
+
+        async def on_finish(b: Broadcast) -> None:
+            if b.status_chat_id and b.status_message_id:
+                text = (
+                    BROADCAST_STOPPED.format(id=b.id, done=b.processed, total=b.total)
+                    if b.status == "cancelled"
+                    else BROADCAST_PROGRESS.format(
+                        id=b.id, done=b.processed, total=b.total,
+                        sent=b.sent, unreachable=b.unreachable, failed=b.failed,
+                    )
+                )
+                try:
+                    await bot.edit_message_text(
+                        chat_id=b.status_chat_id, message_id=b.status_message_id, text=text
+                    )
+                except Exception as e:
+                    logger.debug(f"Рассылка #{b.id}: не удалось обновить статус: {e}")
+            if b.status == "done":
+                await bot.send_message(
+                    chat_id=b.admin_id,
+                    text=BROADCAST_RESULT.format(
+                        id=b.id, sent=b.sent, unreachable=b.unreachable,
+                        failed=b.failed, total=b.total,
+                    ),
+                    parse_mode="Markdown",
+                    reply_markup=self._get_main_reply_keyboard(b.admin_id),
+                )
+
+        self.broadcasts.start(self.bulk_bot, broadcast, progress=progress, on_finish=on_finish)
+
+    async def resume_broadcasts(self) -> None:
+        """Продолжить рассылки, прерванные перезапуском"""
+        for broadcast in await self.db.get_running_broadcasts():
+            logger.info(
+                f"Рассылка #{broadcast.id} продолжена после перезапуска: "
+                f"{broadcast.processed} из {broadcast.total}"
+            )
+            self._start_broadcast(broadcast)
+
+    def _broadcast_segments(self) -> list[tuple[str, str]]:
+        """Доступные сегменты рассылки: (ключ, подпись)"""
+        segments = [
+            ("all", SEGMENT_ALL),
+            ("active", SEGMENT_ACTIVE),
+            ("expired:7", SEGMENT_EXPIRED.format(days=7)),
+            ("expired:30", SEGMENT_EXPIRED.format(days=30)),
+            ("trial", SEGMENT_TRIAL),
+        ]
+        segments += [(f"plan:{p.id}", SEGMENT_PLAN.format(name=p.name)) for p in self.config.plans]
+        segments.append(("referrers", SEGMENT_REFERRERS))
+        return segments
+
+    def _broadcast_segment_keyboard(self) -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup([
+            [InlineKeyboardButton(label, callback_data=f"bc_seg:{key}")]
+            for key, label in self._broadcast_segments()
+        ])
+
+    async def broadcast_segment_callback(
+        self, update: Update, context: ContextTypes.DEFAULT_TYPE
+    ) -> None:
+        """Выбор аудитории рассылки: сохранить сегмент и показать предпросмотр с числом получателей"""
+        query = update.callback_query
+        user = update.effective_user
+        if not query or not user or user.id not in self.config.admin_ids:
+            return
+        ud = context.user_data if context.user_data is not None else {}
+        if ud.get("broadcast_state") != "wait_segment":
+            await query.answer()
+            return
+        segment = query.data.split(":", 1)[1]
+        labels = dict(self._broadcast_segments())
+        if segment not in labels:
+            await query.answer()
+            return
+        await query.answer()
+        ud["broadcast_segment"] = segment
+        ud["broadcast_state"] = "wait_confirm"
+        total = await self.db.count_broadcast_recipients(segment)
+        preview = (ud.get("broadcast_text") or "")[:200]
+        if ud.get("broadcast_photo"):
+            preview = "[Фото] " + preview
+        await query.edit_message_text(
+            BROADCAST_PREVIEW.format(total=total) + "\n"
+            + BROADCAST_SEGMENT_LINE.format(segment=labels[segment])
+            + "\n\n" + preview + "\n\n" + BROADCAST_CONFIRM,
+        )
+
+    async def broadcast_stop_callback(
+        self, update: Update, context: ContextTypes.DEFAULT_TYPE
+    ) -> None:
+        """Кнопка «Остановить» под статусом рассылки"""
+        query = update.callback_query
+        user = update.effective_user
+        if not query or not user or user.id not in self.config.admin_ids:
+            return
+        broadcast_id = int(query.data.split(":", 1)[1])
+        stopped = await self.broadcasts.cancel(broadcast_id)
+        await query.answer("Останавливается…" if stopped else "Рассылка уже завершена")
+
     async def broadcast_step_handler(
         self, update: Update, context: ContextTypes.DEFAULT_TYPE
     ) -> None:
@@ -869,6 +1158,7 @@ class VPNBot:
                 ud.pop("broadcast_text", None)
                 ud.pop("broadcast_photo", None)
                 ud.pop("broadcast_buttons", None)
+                ud.pop("broadcast_segment", None)
                 await update.message.reply_text(
                     BROADCAST_CANCELLED,
                     reply_markup=self._get_main_reply_keyboard(user.id),
@@ -876,58 +1166,36 @@ class VPNBot:
                 return
             if state == "wait_confirm":
                 if text_cmd == "/yes":
+                    if self.broadcasts.is_running():
+                        await update.message.reply_text(BROADCAST_ALREADY_RUNNING)
+                        return
                     ud.pop("broadcast_state", None)
-                    recipients = await self.db.get_broadcast_recipients()
-                    total = len(recipients)
-                    msg_text = ud.get("broadcast_text") or ""
-                    photo_id = ud.get("broadcast_photo")
-                    buttons = ud.get("broadcast_buttons") or []
-                    ud.pop("broadcast_text", None)
-                    ud.pop("broadcast_photo", None)
-                    ud.pop("broadcast_buttons", None)
-                    keyboard = None
-                    if buttons:
-                        keyboard = InlineKeyboardMarkup(
-                            [[InlineKeyboardButton(t, url=u) for t, u in row] for row in buttons]
-                        )
-                    sent = 0
-                    failed = 0
-                    for chat_id in recipients:
-                        try:
-                            if photo_id:
-                                await context.bot.send_photo(
-                                    chat_id=chat_id,
-                                    photo=photo_id,
-                                    caption=msg_text[:1024] if msg_text else None,
-                                    parse_mode="Markdown",
-                                    reply_markup=keyboard,
-                                )
-                            else:
-                                await context.bot.send_message(
-                                    chat_id=chat_id,
-                                    text=msg_text or "—",
-                                    parse_mode="Markdown",
-                                    reply_markup=keyboard,
-                                )
-                            sent += 1
-                        except Exception:
-                            failed += 1
-                    await update.message.reply_text(
-                        BROADCAST_RESULT.format(sent=sent, failed=failed, total=total),
-                        parse_mode="Markdown",
-                        reply_markup=self._get_main_reply_keyboard(user.id),
+                    segment = ud.pop("broadcast_segment", None) or "all"
+                    total = await self.db.count_broadcast_recipients(segment)
+                    broadcast_id = await self.db.create_broadcast(
+                        admin_id=user.id,
+                        text=ud.pop("broadcast_text", None) or "",
+                        photo_id=ud.pop("broadcast_photo", None),
+                        buttons=ud.pop("broadcast_buttons", None) or [],
+                        total=total,
+                        segment=segment,
+                    )
+                    status_message = await update.message.reply_text(
+                        BROADCAST_STARTED.format(id=broadcast_id, total=total),
+                        reply_markup=self._broadcast_stop_keyboard(broadcast_id),
                     )
+                    await self.db.set_broadcast_status_message(
+                        broadcast_id, status_message.chat_id, status_message.message_id
+                    )
+                    # Рассылка хранится в БД и идёт в фоне — бот продолжает отвечать пользователям
+                    self._start_broadcast(await self.db.get_broadcast(broadcast_id))
                 return
             if state == "wait_buttons":
                 if text_cmd == "/done" or text_cmd == "/skip":
-                    ud["broadcast_state"] = "wait_confirm"
-                    total = len(await self.db.get_broadcast_recipients())
-                    preview = (ud.get("broadcast_text") or "")[:200]
-                    if ud.get("broadcast_photo"):
-                        preview = "[Фото] " + preview
+                    ud["broadcast_state"] = "wait_segment"
                     await update.message.reply_text(
-                        BROADCAST_PREVIEW.format(total=total) + "\n\n" + preview + "\n\n" + BROADCAST_CONFIRM,
-                        reply_markup=self._get_main_reply_keyboard(user.id),
+                        BROADCAST_CHOOSE_SEGMENT,
+                        reply_markup=self._broadcast_segment_keyboard(),
                     )
                     return
                 if "|" in text_cmd:
@@ -970,7 +1238,32 @@ class VPNBot:
 
     def build_application(self) -> Application:
         """Создать приложение бота"""
-        app = Application.builder().token(self.config.bot_token).build()
+        app = (
+            Application.builder()
+            .token(self.config.bot_token)
+            .context_types(ContextTypes(context=BotContext))
+            .concurrent_updates(self.update_processor)
+            .persistence(self.persistence)
+            .rate_limiter(PriorityRateLimiter(self.telegram_scheduler, INTERACTIVE))
+            .build()
+        )
+
+        self.persistence.bind(app)
+
+        interval = self.config.expiry_reminder_interval
+        if interval > 0:
+            if app.job_queue is None:
+                logger.warning(
+                    "Напоминания об окончании подписки выключены: нет JobQueue "
+                    "(pip install \"python-telegram-bot[job-queue]\")"
+                )
+            else:
+                app.job_queue.run_repeating(
+                    self.expiry_reminder_job, interval=interval, first=60, name="expiry_reminders"
+                )
+
+        # Состояние пользователя, блокировка и подписка на канал — до всех обработчиков
+        app.add_handler(TypeHandler(Update, self.guard), group=-1)
 
         app.add_handler(CommandHandler("start", self.start))
         app.add_handler(CommandHandler("stats", self.stats_command))
@@ -982,6 +1275,12 @@ class VPNBot:
         app.add_handler(CallbackQueryHandler(self.referral_callback, pattern="^referral$"))
         app.add_handler(CallbackQueryHandler(self.check_sub_callback, pattern="^check_sub$"))
         app.add_handler(CallbackQueryHandler(self.back_callback, pattern="^back$"))
+        if self.config.forced_channel_enabled:
+            app.add_handler(
+                ChatMemberHandler(self.channel_member_update, ChatMemberHandler.CHAT_MEMBER)
+            )
+        app.add_handler(CallbackQueryHandler(self.broadcast_stop_callback, pattern=r"^bc_stop:\d+$"))
+        app.add_handler(CallbackQueryHandler(self.broadcast_segment_callback, pattern="^bc_seg:"))
         main_buttons = [
             BTN_TARIFFS,
             BTN_MY_SUBSCRIPTION,
@@ -1005,13 +1304,50 @@ class VPNBot:
 
         return app
 
+    async def init_services(self) -> None:
+        """Инициализировать БД и сверить платежи, потерянные при прошлом запуске"""
+        await self.db.init()
+        await self.db.backfill_order_expiry({p.id: p.duration_days for p in self.config.plans})
+        if self.payments:
+            try:
+                adopted = await self.payments.adopt_orphaned_intents()
+                if adopted:
+                    logger.info(f"Сверка платежей: принято потерянных платежей — {adopted}")
+            except Exception as e:
+                logger.error(f"Ошибка сверки платежей при запуске: {e}")
+
+    def _make_bot(self, priority: int, pool_size: int) -> ExtBot:
+        """Bot для фонового класса трафика: отдельный пул соединений, общий бюджет запросов"""
+        return ExtBot(
+            self.config.bot_token,
+            request=HTTPXRequest(connection_pool_size=pool_size),
+            rate_limiter=PriorityRateLimiter(self.telegram_scheduler, priority),
+        )
+
+    async def start_senders(self) -> None:
+        """Создать Bot для уведомлений и рассылок (ответы пользователям идут через app.bot)"""
+        self.notify_bot = self._make_bot(NOTIFY, pool_size=8)
+        self.bulk_bot = self._make_bot(BULK, pool_size=BROADCAST_CONCURRENCY)
+        await self.notify_bot.initialize()
+        await self.bulk_bot.initialize()
+
+    async def stop_senders(self) -> None:
+        """Закрыть пулы соединений фоновых Bot"""
+        for bot in (self.notify_bot, self.bulk_bot):
+            if bot:
+                await bot.shutdown()
+        await self.telegram_scheduler.close()
+
     async def run(self) -> None:
         """Запустить бота"""
-        await self.db.init()
+        await self.init_services()
         app = self.build_application()
 
         await app.initialize()
+        self.load_identity(app.bot)
+        await self.start_senders()
         await app.start()
+        await self.resume_broadcasts()
         logger.info("Бот запущен")
 
         # Ожидание остановки
@@ -1021,8 +1357,12 @@ class VPNBot:
         except asyncio.CancelledError:
             pass
 
+        await self.broadcasts.stop()
         await app.stop()
         await app.shutdown()
+        await self.stop_senders()
+        if self.yookassa:
+            await self.yookassa.aclose()
 
 
 def create_bot(config: Config) -> VPNBot:
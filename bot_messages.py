@@ -6,6 +6,8 @@
 
 # --- Блокировка ---
 BLOCKED = "⛔ Вы заблокированы. Обратитесь в поддержку."
+RATE_LIMITED = "⏳ Слишком много запросов. Подождите несколько секунд и попробуйте снова."
+OVERLOADED = "⏳ Сервис сейчас перегружен. Попробуйте ещё раз через минуту."
 
 # --- Подписка на канал (обязательная) ---
 SUBSCRIBE_TEXT = (
@@ -58,21 +60,30 @@ NO_SUBSCRIPTION = (
     "Приобретите тариф, чтобы получить доступ к VPN."
 )
 SUBSCRIPTION_HEADER = "📋 *Ваша подписка*"
-SUBSCRIPTION_WITH_PLAN = (
-    "📋 *Ваша подписка*\n\n"
-    "*Тариф:* {plan_name}\n"
-    "*Статус:* Активна ✅\n\n"
+# Строки экрана подписки; строка выводится, только если данные известны
+SUBSCRIPTION_PLAN = "*Тариф:* {plan_name}"
+SUBSCRIPTION_STATUS = "*Статус:* {status}"
+SUBSCRIPTION_STATUS_ACTIVE = "Активна ✅"
+SUBSCRIPTION_STATUS_EXPIRED = "Истекла ❌"
+SUBSCRIPTION_STATUS_LIMITED = "Трафик исчерпан ⚠️"
+SUBSCRIPTION_STATUS_DISABLED = "Отключена ⛔"
+SUBSCRIPTION_STATUS_REVOKED = "Ссылка отозвана ❌"
+SUBSCRIPTION_EXPIRES = "*Действует до:* {date} (осталось {days} дн.)"
+SUBSCRIPTION_EXPIRED_AT = "*Закончилась:* {date}"
+SUBSCRIPTION_TRAFFIC = "*Трафик:* осталось {left} из {limit}"
+SUBSCRIPTION_TRAFFIC_UNLIMITED = "*Трафик:* безлимит, использовано {used}"
+SUBSCRIPTION_DEVICES = "*Устройств:* до {count}"
+SUBSCRIPTION_LINK = (
     "*Ссылка для подписки:*\n`{subscription_url}`\n\n"
     "Скопируйте ссылку и добавьте её в приложение VPN (V2RayTUN, V2RayNG, Clash и др.)"
 )
-SUBSCRIPTION_LINK_ONLY = (
-    "📋 *Ваша подписка*\n\n"
-    "*Ссылка для подписки:*\n`{subscription_url}`\n\n"
-    "Скопируйте ссылку и добавьте её в приложение VPN."
+SUBSCRIPTION_NO_LINK = "Обратитесь в поддержку для получения ссылки."
+SUBSCRIPTION_REVOKED = (
+    "Подписка удалена, прежняя ссылка больше не работает. "
+    "Оформите новый тариф или обратитесь в поддержку."
 )
-SUBSCRIPTION_ACTIVE_NO_LINK = "📋 Ваша подписка активна. Обратитесь в поддержку для получения ссылки."
+SUBSCRIPTION_PANEL_UNAVAILABLE = "Трафик и устройства сейчас недоступны — попробуйте позже."
 SUBSCRIPTION_LOAD_ERROR = "❌ Не удалось загрузить подписку. Попробуйте позже."
-SUBSCRIPTION_SHORT = "📋 *Ваша подписка*\n\n`{subscription_url}`"
 
 # --- Пробный период (Trial) ---
 TRIAL_DISABLED = "Пробный период отключен."
@@ -105,6 +116,7 @@ STATS_TEXT = (
     "📊 *Статистика бота*\n\n"
     "✅ Оплаченных заказов: {orders_succeeded}\n"
     "⏳ Ожидают оплаты: {orders_pending}\n"
+    "⌛ Не оплачены (истекли): {orders_expired}\n"
     "💰 Выручка: {revenue:.0f} ₽\n\n"
     "🎁 Trial пользователей: {trial_users}\n"
     "👥 Рефералов: {referrals}"
@@ -116,8 +128,30 @@ BROADCAST_SEND_PHOTO = "Отправьте фото к рассылке (или
 BROADCAST_SEND_BUTTONS = "Добавьте кнопки. Одна кнопка — одно сообщение в формате:\n`Текст кнопки | https://ссылка.com`\nПо готовности отправьте /done. Или /skip — без кнопок."
 BROADCAST_CONFIRM = "Подтвердить рассылку? Отправьте /yes или /cancel."
 BROADCAST_CANCELLED = "Рассылка отменена."
-BROADCAST_RESULT = "📢 *Рассылка завершена*\n\n✅ Доставлено: {sent}\n❌ Не доставлено: {failed}\n📊 Всего получателей: {total}"
+BROADCAST_RESULT = (
+    "📢 *Рассылка #{id} завершена*\n\n"
+    "✅ Доставлено: {sent}\n"
+    "🚫 Заблокировали бота: {unreachable}\n"
+    "❌ Не доставлено: {failed}\n"
+    "📊 Всего получателей: {total}"
+)
+BROADCAST_STARTED = "📢 Рассылка #{id} запущена: {total} получателей."
+BROADCAST_PROGRESS = (
+    "📢 Рассылка #{id}: {done} из {total}\n"
+    "✅ {sent} · 🚫 {unreachable} · ❌ {failed}"
+)
+BROADCAST_STOPPED = "⏹ Рассылка #{id} остановлена: {done} из {total}"
+BTN_BROADCAST_STOP = "⏹ Остановить"
+BROADCAST_ALREADY_RUNNING = "⏳ Предыдущая рассылка ещё идёт. Дождитесь её завершения."
 BROADCAST_PREVIEW = "📋 *Предпросмотр рассылки* (получателей: {total})\n\n—"
+BROADCAST_CHOOSE_SEGMENT = "Кому отправить рассылку?"
+BROADCAST_SEGMENT_LINE = "👥 Аудитория: {segment}"
+SEGMENT_ALL = "Все пользователи"
+SEGMENT_ACTIVE = "Активные подписчики"
+SEGMENT_EXPIRED = "Подписка истекла за {days} дн."
+SEGMENT_TRIAL = "Только пробный период, без оплаты"
+SEGMENT_PLAN = "Покупали тариф «{name}»"
+SEGMENT_REFERRERS = "Приглашали друзей"
 
 # --- Уведомления рефереру (когда по его ссылке перешёл новый пользователь) ---
 REFERRAL_BONUS_EXTENDED = (
@@ -128,3 +162,20 @@ REFERRAL_BONUS_PENDING = (
     "👋 По вашей ссылке перешёл новый пользователь! "
     "Бонус будет начислен при наличии активной подписки."
 )
+
+# --- Напоминания об окончании подписки (за 3, 1 и 0 дней) ---
+EXPIRY_REMINDERS = {
+    3: (
+        "⏳ Ваша VPN подписка «{plan_name}» закончится через 3 дня ({date}).\n\n"
+        "Продлите заранее, чтобы VPN не отключился."
+    ),
+    1: (
+        "⏰ Ваша VPN подписка «{plan_name}» закончится меньше чем через сутки ({date}).\n\n"
+        "Продлите сейчас — это займёт минуту."
+    ),
+    0: (
+        "🔴 Ваша VPN подписка «{plan_name}» закончилась.\n\n"
+        "Продлите её, чтобы снова пользоваться VPN."
+    ),
+}
+BTN_RENEW = "🔄 Продлить"
@@ -0,0 +1,240 @@
+"""Массовая рассылка сообщений с соблюдением лимитов Telegram"""
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Awaitable, Callable, Optional, Union
+
+from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+import metrics
+from database import Broadcast, Database
+from rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Параллельные отправки: с запасом, чтобы держать темп при задержках сети
+BROADCAST_CONCURRENCY = 20
+# Повторы при сетевых ошибках и flood-wait
+MAX_SEND_ATTEMPTS = 5
+# Порция получателей: после неё сохраняется курсор (после перезапуска повторится не больше порции)
+CHUNK_SIZE = 200
+# Как часто обновлять сообщение с прогрессом, сек
+PROGRESS_INTERVAL = 5.0
+
+# Ошибки BadRequest, после которых чат не существует для бота
+UNREACHABLE_ERRORS = ("chat not found", "user is deactivated", "peer_id_invalid")
+
+# Прогресс рассылки (вызывается не чаще PROGRESS_INTERVAL)
+ProgressCallback = Callable[[Broadcast], Awaitable[None]]
+
+
+@dataclass
+class BroadcastMessage:
+    """Содержимое рассылки"""
+    text: str
+    photo_id: Optional[str] = None
+    keyboard: Optional[InlineKeyboardMarkup] = None
+
+    @classmethod
+    def from_broadcast(cls, broadcast: Broadcast) -> "BroadcastMessage":
+        keyboard = None
+        if broadcast.buttons:
+            keyboard = InlineKeyboardMarkup(
+                [[InlineKeyboardButton(t, url=u) for t, u in row] for row in broadcast.buttons]
+            )
+        return cls(broadcast.text, broadcast.photo_id, keyboard)
+
+
+def _seconds(value: Union[int, float, timedelta]) -> float:
+    """retry_after в секундах (PTB отдаёт int или timedelta в зависимости от версии)"""
+    return value.total_seconds() if isinstance(value, timedelta) else float(value)
+
+
+class BroadcastEngine:
+    """
+    Рассылка по получателям из БД.
+
+    Отправки идут параллельно (BROADCAST_CONCURRENCY) через общий TokenBucket
+    с частотой rate сообщений в секунду — ниже глобального лимита Telegram (~30/с).
+    Каждый чат получает одно сообщение, поэтому лимит на чат (1/с) не превышается.
+    RetryAfter приостанавливает всю рассылку на указанное время и повторяет отправку;
+    пользователи, заблокировавшие бота, помечаются в БД и пропускаются в следующих рассылках.
+    """
+
+    def __init__(self, bot: Bot, db: Database, rate: float = 25.0):
+        self.bot = bot
+        self.db = db
+        self.bucket = TokenBucket(rate, capacity=max(rate, 1.0))
+
+    async def _send(self, chat_id: int, message: BroadcastMessage) -> None:
+        if message.photo_id:
+            await self.bot.send_photo(
+                chat_id=chat_id,
+                photo=message.photo_id,
+                caption=message.text[:1024] if message.text else None,
+                parse_mode="Markdown",
+                reply_markup=message.keyboard,
+            )
+        else:
+            await self.bot.send_message(
+                chat_id=chat_id,
+                text=message.text or "—",
+                parse_mode="Markdown",
+                reply_markup=message.keyboard,
+            )
+
+    async def _deliver(self, chat_id: int, message: BroadcastMessage) -> str:
+        """Отправить одному получателю. Возвращает sent / unreachable / failed."""
+        for attempt in range(1, MAX_SEND_ATTEMPTS + 1):
+            await self.bucket.acquire()
+            try:
+                await self._send(chat_id, message)
+                return "sent"
+            except RetryAfter as e:
+                wait = _seconds(e.retry_after)
+                metrics.incr("broadcast.flood_wait")
+                logger.warning(f"Рассылка: flood-wait {wait:.0f} сек")
+                self.bucket.pause(wait)
+            except Forbidden:
+                return "unreachable"
+            except BadRequest as e:
+                if any(s in str(e).lower() for s in UNREACHABLE_ERRORS):
+                    return "unreachable"
+                logger.warning(f"Рассылка: {chat_id} — {e}")
+                return "failed"
+            except (TimedOut, NetworkError) as e:
+                if attempt == MAX_SEND_ATTEMPTS:
+                    logger.warning(f"Рассылка: {chat_id} — {e}")
+                    return "failed"
+                await asyncio.sleep(attempt)
+        return "failed"
+
+    async def _deliver_chunk(
+        self, chat_ids: list[int], message: BroadcastMessage
+    ) -> dict[int, str]:
+        """Разослать порцию параллельно (BROADCAST_CONCURRENCY). Возвращает статус по chat_id."""
+        queue: asyncio.Queue[int] = asyncio.Queue()
+        for chat_id in chat_ids:
+            queue.put_nowait(chat_id)
+        statuses: dict[int, str] = {}
+
+        async def worker() -> None:
+            while True:
+                try:
+                    chat_id = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    statuses[chat_id] = await self._deliver(chat_id, message)
+                except Exception as e:
+                    logger.error(f"Рассылка: {chat_id} — {e}")
+                    statuses[chat_id] = "failed"
+
+        await asyncio.gather(*(worker() for _ in range(min(BROADCAST_CONCURRENCY, len(chat_ids)))))
+        return statuses
+
+    async def run(self, broadcast: Broadcast, progress: Optional[ProgressCallback] = None) -> Broadcast:
+        """
+        Выполнить рассылку с места курсора.
+
+        Получатели берутся порциями по CHUNK_SIZE по возрастанию telegram_id; после
+        каждой порции в БД сохраняются курсор и счётчики. После перезапуска повторно
+        может уйти не больше одной порции. Отмена (статус не running в БД)
+        проверяется перед каждой порцией.
+        """
+        message = BroadcastMessage.from_broadcast(broadcast)
+        started = time.monotonic()
+        last_progress = started
+        while True:
+            current = await self.db.get_broadcast(broadcast.id)
+            if not current or current.status != "running":
+                broadcast.status = current.status if current else "cancelled"
+                break
+            chat_ids = await self.db.get_broadcast_recipients(
+                after_id=broadcast.cursor, limit=CHUNK_SIZE, segment=broadcast.segment
+            )
+            if not chat_ids:
+                await self.db.finish_broadcast(broadcast.id, "done")
+                broadcast.status = "done"
+                break
+
+            statuses = await self._deliver_chunk(chat_ids, message)
+            unreachable = [cid for cid, st in statuses.items() if st == "unreachable"]
+            for status in statuses.values():
+                setattr(broadcast, status, getattr(broadcast, status) + 1)
+                metrics.incr(f"broadcast.{status}")
+            broadcast.cursor = chat_ids[-1]
+            await self.db.mark_unreachable(unreachable)
+            await self.db.save_broadcast_progress(broadcast)
+
+            now = time.monotonic()
+            if progress and now - last_progress >= PROGRESS_INTERVAL:
+                last_progress = now
+                try:
+                    await progress(broadcast)
+                except Exception as e:
+                    logger.debug(f"Рассылка: не удалось обновить прогресс: {e}")
+
+        logger.info(
+            f"Рассылка #{broadcast.id} ({broadcast.status}) за {time.monotonic() - started:.0f} сек: "
+            f"доставлено {broadcast.sent}, недоступны {broadcast.unreachable}, "
+            f"ошибки {broadcast.failed}, всего {broadcast.total}"
+        )
+        return broadcast
+
+
+# Вызывается по завершении рассылки (done / cancelled)
+FinishCallback = Callable[[Broadcast], Awaitable[None]]
+
+
+class BroadcastManager:
+    """
+    Запуск рассылок в фоне: не больше одной одновременно, продолжение после перезапуска.
+    """
+
+    def __init__(self, db: Database, rate: float = 25.0):
+        self.db = db
+        self.rate = rate
+        self._tasks: dict[int, asyncio.Task] = {}
+
+    def is_running(self) -> bool:
+        return any(not t.done() for t in self._tasks.values())
+
+    def start(
+        self,
+        bot: Bot,
+        broadcast: Broadcast,
+        progress: Optional[ProgressCallback] = None,
+        on_finish: Optional[FinishCallback] = None,
+    ) -> None:
+        """Запустить рассылку фоновой задачей"""
+        engine = BroadcastEngine(bot, self.db, rate=self.rate)
+
+        async def runner() -> None:
+            try:
+                result = await engine.run(broadcast, progress=progress)
+                if on_finish:
+                    await on_finish(result)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"Рассылка #{broadcast.id} прервана: {e}")
+            finally:
+                self._tasks.pop(broadcast.id, None)
+
+        self._tasks[broadcast.id] = asyncio.create_task(runner())
+
+    async def cancel(self, broadcast_id: int) -> bool:
+        """Отменить рассылку; задача остановится перед следующей порцией"""
+        return await self.db.finish_broadcast(broadcast_id, "cancelled")
+
+    async def stop(self) -> None:
+        """Остановить задачи при выключении (в БД рассылки остаются running и продолжатся)"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
@@ -43,9 +43,15 @@ class Config:
     yookassa_secret_key: str = ""
     # URL для webhook Yookassa (должен быть доступен из интернета)
     webhook_base_url: str = "https://your-domain.com"
+    # Получать обновления Telegram через webhook на том же сервере (иначе polling)
+    telegram_webhook_enabled: bool = False
+    # Секрет заголовка X-Telegram-Bot-Api-Secret-Token (пусто — выводится из токена бота)
+    telegram_webhook_secret: str = ""
     # Host и порт webhook сервера
     webhook_host: str = "0.0.0.0"
     webhook_port: int = 8000
+    # Количество процессов uvicorn для webhook (1 = в процессе бота)
+    webhook_workers: int = 1
     # Пробный режим: 0 = отключен, >0 = количество дней
     trial_days: int = 0
     # Лимит трафика для пробного периода (ГБ), 0 = безлимит
@@ -64,6 +70,27 @@ class Config:
     # Информация — кнопка «ℹ️ Информация»
     main_menu_info: str = ""
     expired_cleanup_days: int = 7  # 0 = отключено
+    # Сколько минут повторно выдавать ту же ссылку на оплату (0 = всегда новый платёж)
+    payment_link_ttl_minutes: int = 30
+    # Сверка неоплаченных заказов с Yookassa (если webhook потерян): период в секундах, 0 = выкл
+    payment_reconcile_interval: int = 120
+    # Напоминания об окончании подписки (за 3, 1 и 0 дней): период проверки, сек (0 = выключено)
+    expiry_reminder_interval: int = 1800
+    # Проверять заказы не старше N часов
+    payment_reconcile_max_age_hours: int = 48
+    # Неоплаченные заказы старше N часов помечаются expired (0 = не трогать)
+    pending_order_expire_hours: int = 72
+    # Скорость рассылки, сообщений в секунду (глобальный лимит Telegram ~30/с)
+    broadcast_rate: int = 25
+    # Количество фоновых обработчиков очереди задач (активация оплат и т.п.)
+    job_workers: int = 4
+    # Сколько обновлений Telegram обрабатывать одновременно (обновления одного пользователя — по очереди)
+    update_concurrency: int = 32
+    # Перегрузка: при стольких обновлениях в обработке или в ожидании слота (не больше одного на пользователя)
+    # тяжёлые действия (оплата, trial, подписка) отклоняются
+    overload_max_pending: int = 200
+    # ...или при средней задержке Yookassa/Remnawave выше N мс (0 = не учитывать)
+    overload_latency_ms: int = 5000
     # Принудительная подписка на канал: вкл/выкл (FORCED_CHANNEL_ENABLED)
     forced_channel_enabled: bool = False
     # ID канала (@channel → -100xxxxxxxxxx)
@@ -144,8 +171,11 @@ class Config:
             yookassa_shop_id=os.getenv("YOOKASSA_SHOP_ID", ""),
             yookassa_secret_key=os.getenv("YOOKASSA_SECRET_KEY", ""),
             webhook_base_url=os.getenv("WEBHOOK_BASE_URL", "https://your-domain.com"),
+            telegram_webhook_enabled=os.getenv("TELEGRAM_WEBHOOK_ENABLED", "false").lower() in ("1", "true", "yes"),
+            telegram_webhook_secret=(os.getenv("TELEGRAM_WEBHOOK_SECRET") or "").strip(),
             webhook_host=os.getenv("WEBHOOK_HOST", "0.0.0.0"),
             webhook_port=cls._int_env("WEBHOOK_PORT", 8000),
+            webhook_workers=cls._int_env("WEBHOOK_WORKERS", 1),
             trial_days=cls._int_env("TRIAL_DAYS", 0),
             trial_data_limit_gb=cls._int_env("TRIAL_DATA_LIMIT_GB", 0),
             referral_days=cls._int_env("REFERRAL_DAYS", 0),
@@ -156,6 +186,16 @@ class Config:
             cooperation_link=(os.getenv("COOPERATION_LINK") or "").strip(),
             main_menu_info=(os.getenv("MAIN_MENU_INFO") or "").replace("\\n", "\n"),
             expired_cleanup_days=cls._int_env("EXPIRED_CLEANUP_DAYS", 7),
+            payment_link_ttl_minutes=cls._int_env("PAYMENT_LINK_TTL_MINUTES", 30),
+            payment_reconcile_interval=cls._int_env("PAYMENT_RECONCILE_INTERVAL", 120),
+            expiry_reminder_interval=cls._int_env("EXPIRY_REMINDER_INTERVAL", 1800),
+            payment_reconcile_max_age_hours=cls._int_env("PAYMENT_RECONCILE_MAX_AGE_HOURS", 48),
+            pending_order_expire_hours=cls._int_env("PENDING_ORDER_EXPIRE_HOURS", 72),
+            job_workers=cls._int_env("JOB_WORKERS", 4),
+            update_concurrency=cls._int_env("UPDATE_CONCURRENCY", 32),
+            overload_max_pending=cls._int_env("OVERLOAD_MAX_PENDING", 200),
+            overload_latency_ms=cls._int_env("OVERLOAD_LATENCY_MS", 5000),
+            broadcast_rate=cls._int_env("BROADCAST_RATE", 25),
             forced_channel_enabled=os.getenv("FORCED_CHANNEL_ENABLED", "false").lower() in ("1", "true", "yes"),
             forced_channel_id=os.getenv("FORCED_CHANNEL_ID") or None,
             forced_channel_username=os.getenv("FORCED_CHANNEL_USERNAME") or None,
@@ -1,7 +1,8 @@
 """База данных для хранения заказов и привязки пользователей"""
 import asyncio
+import json
 from dataclasses import dataclass
-from datetime import datetime
+from datetime import datetime, timezone
 from typing import Optional
 
 import aiosqlite
@@ -16,12 +17,130 @@ class Order:
     plan_id: str
     plan_name: str
     amount: float
-    status: str  # pending, succeeded, failed, refunded
+    status: str  # pending, activating, succeeded, failed, refunded, canceled, expired
     created_at: datetime
     completed_at: Optional[datetime]
     username: Optional[str]  # Username в Remnawave
     short_uuid: Optional[str]  # Short UUID для подписки
     referrer_id: Optional[int] = None
+    confirmation_url: Optional[str] = None  # Ссылка на оплату (для повторной выдачи)
+    expires_at: Optional[datetime] = None  # Окончание оплаченной подписки (UTC)
+
+
+@dataclass
+class PaymentIntent:
+    """Намерение оплаты: записывается до запроса к Yookassa, хранит ключ идемпотентности"""
+    id: int
+    idempotence_key: str
+    telegram_id: int
+    plan_id: str
+    plan_name: str
+    amount: float
+    referrer_id: Optional[int]
+    payment_id: Optional[str]
+    status: str  # new, linked, failed, abandoned
+    created_at: datetime
+
+
+@dataclass
+class Job:
+    """Фоновая задача из очереди jobs (обработка webhook и т.п.)"""
+    id: int
+    kind: str
+    payload: dict
+    attempts: int  # номер текущей попытки (после захвата)
+
+
+@dataclass
+class Broadcast:
+    """Рассылка: содержимое и прогресс (курсор — последний обработанный telegram_id)"""
+    id: int
+    admin_id: int
+    text: str
+    photo_id: Optional[str]
+    buttons: list  # [[(текст, url)], ...]
+    status: str  # running, done, cancelled
+    total: int
+    cursor: int
+    sent: int
+    failed: int
+    unreachable: int
+    segment: str = "all"
+    status_chat_id: Optional[int] = None
+    status_message_id: Optional[int] = None
+
+    @property
+    def processed(self) -> int:
+        return self.sent + self.failed + self.unreachable
+
+
+@dataclass
+class OutboxMessage:
+    """Сообщение Telegram в очереди outbox (доставляется OutboxDispatcher)"""
+    chat_id: int
+    text: str
+    parse_mode: Optional[str] = None
+    id: int = 0
+    attempts: int = 0
+    reply_markup: Optional[dict] = None  # InlineKeyboardMarkup.to_dict()
+
+
+@dataclass
+class UserState:
+    """Состояние пользователя для обработки обновления (одним запросом, см. get_user_state)"""
+    telegram_id: int
+    blocked: bool = False
+    seen: bool = False
+    unreachable: bool = False
+    trial_used: bool = False
+    has_orders: bool = False
+    referrer_id: Optional[int] = None  # кто пригласил (referrals)
+    referral_pending: bool = False  # бонус за переход этого пользователя ещё не начислен
+
+    @property
+    def is_new(self) -> bool:
+        """Нет заказов, trial и реферальной записи"""
+        return not self.has_orders and not self.trial_used and self.referrer_id is None
+
+
+# Активная оплаченная подписка пользователя u (индекс idx_orders_user_expiry)
+_ACTIVE_SUBSCRIPTION = """EXISTS (
+    SELECT 1 FROM orders o WHERE o.telegram_id = u.telegram_id
+    AND o.status = 'succeeded' AND o.expires_at > datetime('now')
+)"""
+
+# Сегменты рассылки: условие на user_seen u. Параметр сегмента — после двоеточия (expired:30, plan:monthly)
+BROADCAST_SEGMENTS: dict[str, str] = {
+    "all": "1",
+    "active": _ACTIVE_SUBSCRIPTION,
+    "expired": f"""NOT {_ACTIVE_SUBSCRIPTION} AND EXISTS (
+        SELECT 1 FROM orders o WHERE o.telegram_id = u.telegram_id AND o.status = 'succeeded'
+        AND o.expires_at BETWEEN datetime('now', '-' || ? || ' days') AND datetime('now')
+    )""",
+    "trial": """EXISTS (SELECT 1 FROM trial_users t WHERE t.telegram_id = u.telegram_id)
+        AND NOT EXISTS (
+            SELECT 1 FROM orders o WHERE o.telegram_id = u.telegram_id AND o.status = 'succeeded'
+        )""",
+    "plan": """EXISTS (
+        SELECT 1 FROM orders o WHERE o.telegram_id = u.telegram_id
+        AND o.plan_id = ? AND o.status = 'succeeded'
+    )""",
+    "referrers": "EXISTS (SELECT 1 FROM referrals r WHERE r.referrer_id = u.telegram_id)",
+}
+
+
+def _segment_filter(segment: str) -> tuple[str, tuple]:
+    """SQL-условие и параметры для сегмента вида name[:arg]"""
+    name, _, arg = segment.partition(":")
+    condition = BROADCAST_SEGMENTS.get(name)
+    if condition is None:
+        raise ValueError(f"Неизвестный сегмент рассылки: {segment}")
+    params: tuple = ()
+    if "?" in condition:
+        if not arg:
+            raise ValueError(f"Сегмент {name} требует параметр: {segment}")
+        params = (int(arg),) if name == "expired" else (arg,)
+    return condition, params
 
 
 class Database:
@@ -34,6 +153,8 @@ class Database:
     async def init(self) -> None:
         """Инициализировать таблицы"""
         async with aiosqlite.connect(self.db_path) as db:
+            # WAL: чтение не блокируется записью, в том числе из других процессов (воркеры webhook)
+            await db.execute("PRAGMA journal_mode=WAL")
             await db.execute("""
                 CREATE TABLE IF NOT EXISTS orders (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -65,6 +186,9 @@ class Database:
                     PRIMARY KEY (referrer_id, referral_id)
                 )
             """)
+            await db.execute("""
+                CREATE INDEX IF NOT EXISTS idx_referrals_referral ON referrals(referral_id)
+            """)
             await db.execute("""
                 CREATE INDEX IF NOT EXISTS idx_orders_payment ON orders(payment_id)
             """)
@@ -84,10 +208,169 @@ class Database:
                     first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             """)
+            try:
+                # Пользователь заблокировал бота / удалил аккаунт — пропускается в рассылках
+                await db.execute("ALTER TABLE user_seen ADD COLUMN unreachable_at TIMESTAMP")
+            except Exception:
+                pass  # Колонка уже существует
+            try:
+                # Бонус рефереру начислен (фоновая задача referral.joined)
+                await db.execute("ALTER TABLE referrals ADD COLUMN rewarded_at TIMESTAMP")
+                await db.execute("UPDATE referrals SET rewarded_at = created_at")
+            except Exception:
+                pass  # Колонка уже существует
+            try:
+                # Запланированное продление реферера: пользователь Remnawave и окончание после бонуса
+                await db.execute("ALTER TABLE referrals ADD COLUMN bonus_user_uuid TEXT")
+                await db.execute("ALTER TABLE referrals ADD COLUMN bonus_expires_at TEXT")
+            except Exception:
+                pass  # Колонка уже существует
             try:
                 await db.execute("ALTER TABLE orders ADD COLUMN referrer_id INTEGER")
             except Exception:
                 pass  # Колонка уже существует
+            try:
+                await db.execute("ALTER TABLE orders ADD COLUMN confirmation_url TEXT")
+            except Exception:
+                pass  # Колонка уже существует
+            try:
+                # Окончание оплаченной подписки (для сегментов рассылки)
+                await db.execute("ALTER TABLE orders ADD COLUMN expires_at TIMESTAMP")
+            except Exception:
+                pass  # Колонка уже существует
+            # Поиск неоплаченного платежа пользователя по тарифу (повторная выдача ссылки)
+            await db.execute("""
+                CREATE INDEX IF NOT EXISTS idx_orders_user_plan_status
+                ON orders(telegram_id, plan_id, status, created_at)
+            """)
+            # Сегменты рассылки: активные/истёкшие подписки пользователя
+            await db.execute("""
+                CREATE INDEX IF NOT EXISTS idx_orders_user_expiry
+                ON orders(telegram_id, expires_at) WHERE status = 'succeeded'
+            """)
+            # Напоминания об окончании: сканирование окна по expires_at
+            await db.execute("""
+                CREATE INDEX IF NOT EXISTS idx_orders_expiry
+                ON orders(expires_at) WHERE status = 'succeeded'
+            """)
+            # Отправленные напоминания: одно на заказ и порог (за 3, 1, 0 дней)
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS expiry_reminders (
+                    order_id INTEGER NOT NULL,
+                    days INTEGER NOT NULL,
+                    sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (order_id, days)
+                )
+            """)
+            # Частичный индекс только по неоплаченным заказам: сверка, очистка, счётчик в статистике.
+            # Заказы, ушедшие из pending, из него выпадают — индекс остаётся маленьким.
+            await db.execute("DROP INDEX IF EXISTS idx_orders_status_created")
+            await db.execute("""
+                CREATE INDEX IF NOT EXISTS idx_orders_pending ON orders(created_at) WHERE status = 'pending'
+            """)
+            # Счётчик «не оплачены (истекли)» в статистике — без полного прохода по orders
+            await db.execute("""
+                CREATE INDEX IF NOT EXISTS idx_orders_expired ON orders(status) WHERE status = 'expired'
+            """)
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT DEFAULT 'queued',
+                    attempts INTEGER DEFAULT 0,
+                    run_after TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    last_error TEXT,
+                    duration_ms REAL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    finished_at TIMESTAMP
+                )
+            """)
+            await db.execute("""
+                CREATE INDEX IF NOT EXISTS idx_jobs_queued ON jobs(run_after) WHERE status = 'queued'
+            """)
+            # Дедупликация событий webhook (повторные доставки Yookassa)
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS processed_events (
+                    event_id TEXT PRIMARY KEY,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS payment_intents (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    idempotence_key TEXT UNIQUE NOT NULL,
+                    telegram_id INTEGER NOT NULL,
+                    plan_id TEXT NOT NULL,
+                    plan_name TEXT NOT NULL,
+                    amount REAL NOT NULL,
+                    referrer_id INTEGER,
+                    payment_id TEXT,
+                    status TEXT DEFAULT 'new',
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            await db.execute("""
+                CREATE INDEX IF NOT EXISTS idx_intents_user_plan
+                ON payment_intents(telegram_id, plan_id, status)
+            """)
+            await db.execute("""
+                CREATE INDEX IF NOT EXISTS idx_intents_status ON payment_intents(status, created_at)
+            """)
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS broadcasts (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    admin_id INTEGER NOT NULL,
+                    text TEXT NOT NULL,
+                    photo_id TEXT,
+                    buttons TEXT NOT NULL DEFAULT '[]',
+                    status TEXT DEFAULT 'running',
+                    total INTEGER DEFAULT 0,
+                    cursor INTEGER DEFAULT 0,
+                    sent INTEGER DEFAULT 0,
+                    failed INTEGER DEFAULT 0,
+                    unreachable INTEGER DEFAULT 0,
+                    segment TEXT DEFAULT 'all',
+                    status_chat_id INTEGER,
+                    status_message_id INTEGER,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    finished_at TIMESTAMP
+                )
+            """)
+            try:
+                await db.execute("ALTER TABLE broadcasts ADD COLUMN segment TEXT DEFAULT 'all'")
+            except Exception:
+                pass  # Колонка уже существует
+            # Исходящие сообщения Telegram: пишутся в одной транзакции с изменением заказа
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id INTEGER NOT NULL,
+                    text TEXT NOT NULL,
+                    parse_mode TEXT,
+                    status TEXT DEFAULT 'pending',
+                    attempts INTEGER DEFAULT 0,
+                    next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    last_error TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    sent_at TIMESTAMP
+                )
+            """)
+            try:
+                await db.execute("ALTER TABLE outbox ADD COLUMN reply_markup TEXT")
+            except Exception:
+                pass  # Колонка уже существует
+            await db.execute("""
+                CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox(next_attempt_at) WHERE status = 'pending'
+            """)
+            # context.user_data бота (SqlitePersistence): реферер, шаги рассылки
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS user_data (
+                    telegram_id INTEGER PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
             await db.commit()
 
     async def create_order(
@@ -98,16 +381,18 @@ class Database:
         plan_name: str,
         amount: float,
         referrer_id: Optional[int] = None,
+        confirmation_url: Optional[str] = None,
     ) -> int:
         """Создать заказ"""
         async with self._lock:
             async with aiosqlite.connect(self.db_path) as db:
                 cursor = await db.execute(
                     """
-                    INSERT INTO orders (payment_id, telegram_id, plan_id, plan_name, amount, status, referrer_id)
-                    VALUES (?, ?, ?, ?, ?, 'pending', ?)
+                    INSERT INTO orders (payment_id, telegram_id, plan_id, plan_name, amount, status,
+                                        referrer_id, confirmation_url)
+                    VALUES (?, ?, ?, ?, ?, 'pending', ?, ?)
                     """,
-                    (payment_id, telegram_id, plan_id, plan_name, amount, referrer_id),
+                    (payment_id, telegram_id, plan_id, plan_name, amount, referrer_id, confirmation_url),
                 )
                 await db.commit()
                 return cursor.lastrowid or 0
@@ -125,25 +410,278 @@ class Database:
                     return self._row_to_order(row)
         return None
 
+    async def get_pending_order(
+        self,
+        telegram_id: int,
+        plan_id: str,
+        amount: float,
+        max_age_minutes: int,
+    ) -> Optional[Order]:
+        """Последний неоплаченный заказ пользователя по тарифу не старше max_age_minutes"""
+        async with aiosqlite.connect(self.db_path) as db:
+            db.row_factory = aiosqlite.Row
+            async with db.execute(
+                """
+                SELECT * FROM orders
+                WHERE telegram_id = ? AND plan_id = ? AND status = 'pending'
+                  AND created_at >= datetime('now', ?)
+                  AND amount = ? AND confirmation_url IS NOT NULL
+                ORDER BY created_at DESC LIMIT 1
+                """,
+                (telegram_id, plan_id, f"-{max_age_minutes} minutes", amount),
+            ) as cursor:
+                row = await cursor.fetchone()
+                if row:
+                    return self._row_to_order(row)
+        return None
+
+    async def create_payment_intent(
+        self,
+        idempotence_key: str,
+        telegram_id: int,
+        plan_id: str,
+        plan_name: str,
+        amount: float,
+        referrer_id: Optional[int] = None,
+    ) -> PaymentIntent:
+        """Записать намерение оплаты до обращения к Yookassa"""
+        async with self._lock:
+            async with aiosqlite.connect(self.db_path) as db:
+                db.row_factory = aiosqlite.Row
+                cursor = await db.execute(
+                    """
+                    INSERT INTO payment_intents
+                        (idempotence_key, telegram_id, plan_id, plan_name, amount, referrer_id)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    """,
+                    (idempotence_key, telegram_id, plan_id, plan_name, amount, referrer_id),
+                )
+                await db.commit()
+                async with db.execute(
+                    "SELECT * FROM payment_intents WHERE id = ?", (cursor.lastrowid,)
+                ) as cur:
+                    return self._row_to_intent(await cur.fetchone())
+
+    async def get_open_intent(
+        self,
+        telegram_id: int,
+        plan_id: str,
+        amount: float,
+        max_age_hours: int = 23,
+    ) -> Optional[PaymentIntent]:
+        """Незавершённое намерение (платёж мог быть создан) — его ключ можно повторить"""
+        async with aiosqlite.connect(self.db_path) as db:
+            db.row_factory = aiosqlite.Row
+            async with db.execute(
+                """
+                SELECT * FROM payment_intents
+                WHERE telegram_id = ? AND plan_id = ? AND status = 'new'
+                  AND amount = ? AND created_at >= datetime('now', ?)
+                ORDER BY id DESC LIMIT 1
+                """,
+                (telegram_id, plan_id, amount, f"-{max_age_hours} hours"),
+            ) as cur:
+                row = await cur.fetchone()
+                return self._row_to_intent(row) if row else None
+
+    async def get_orphaned_intents(self, older_than_seconds: int = 60) -> list[PaymentIntent]:
+        """Намерения без заказа: процесс мог упасть между Yookassa и create_order"""
+        async with aiosqlite.connect(self.db_path) as db:
+            db.row_factory = aiosqlite.Row
+            async with db.execute(
+                """
+                SELECT * FROM payment_intents
+                WHERE status = 'new' AND created_at < datetime('now', ?)
+                ORDER BY created_at
+                """,
+                (f"-{older_than_seconds} seconds",),
+            ) as cur:
+                return [self._row_to_intent(row) for row in await cur.fetchall()]
+
+    async def link_intent_order(
+        self,
+        intent: PaymentIntent,
+        payment_id: str,
+        confirmation_url: Optional[str],
+    ) -> int:
+        """Создать заказ по намерению и отметить намерение связанным (одна транзакция)"""
+        async with self._lock:
+            async with aiosqlite.connect(self.db_path) as db:
+                await db.execute(
+                    """
+                    INSERT OR IGNORE INTO orders (payment_id, telegram_id, plan_id, plan_name, amount,
+                                                  status, referrer_id, confirmation_url)
+                    VALUES (?, ?, ?, ?, ?, 'pending', ?, ?)
+                    """,
+                    (payment_id, intent.telegram_id, intent.plan_id, intent.plan_name,
+                     intent.amount, intent.referrer_id, confirmation_url),
+                )
+                await db.execute(
+                    "UPDATE payment_intents SET status = 'linked', payment_id = ? WHERE id = ?",
+                    (payment_id, intent.id),
+                )
+                await db.commit()
+                async with db.execute(
+                    "SELECT id FROM orders WHERE payment_id = ?", (payment_id,)
+                ) as cur:
+                    row = await cur.fetchone()
+                    return int(row[0]) if row else 0
+
+    async def update_intent_status(self, intent_id: int, status: str) -> None:
+        """Обновить статус намерения (failed, abandoned)"""
+        async with self._lock:
+            async with aiosqlite.connect(self.db_path) as db:
+                await db.execute(
+                    "UPDATE payment_intents SET status = ? WHERE id = ?",
+                    (status, intent_id),
+                )
+                await db.commit()
+
+    async def get_pending_orders_for_reconcile(
+        self,
+        min_age_seconds: int,
+        max_age_hours: int,
+        after_id: int = 0,
+        limit: int = 100,
+    ) -> list[Order]:
+        """Неоплаченные заказы в окне возраста [max_age_hours; min_age_seconds], постранично по id"""
+        async with aiosqlite.connect(self.db_path) as db:
+            db.row_factory = aiosqlite.Row
+            async with db.execute(
+                """
+                SELECT * FROM orders
+                WHERE status = 'pending'
+                  AND created_at >= datetime('now', ?)
+                  AND created_at < datetime('now', ?)
+                  AND id > ?
+                ORDER BY id LIMIT ?
+                """,
+                (f"-{max_age_hours} hours", f"-{min_age_seconds} seconds", after_id, limit),
+            ) as cursor:
+                return [self._row_to_order(row) for row in await cursor.fetchall()]
+
+    async def expire_stale_pending_orders(self, older_than_hours: int, batch_size: int = 500) -> int:
+        """
+        Пометить expired неоплаченные заказы старше older_than_hours.
+        Короткие транзакции по batch_size строк, чтобы не держать блокировку БД.
+        Возвращает количество помеченных заказов.
+        """
+        total = 0
+        while True:
+            async with self._lock:
+                async with aiosqlite.connect(self.db_path) as db:
+                    cursor = await db.execute(
+                        """
+                        UPDATE orders SET status = 'expired'
+                        WHERE id IN (
+                            SELECT id FROM orders
+                            WHERE status = 'pending' AND created_at < datetime('now', ?)
+                            LIMIT ?
+                        )
+                        """,
+                        (f"-{older_than_hours} hours", batch_size),
+                    )
+                    await db.commit()
+                    swept = cursor.rowcount
+            total += swept
+            if swept < batch_size:
+                return total
+            await asyncio.sleep(0)
+
+    async def claim_order_for_activation(
+        self,
+        payment_id: str,
+        telegram_id: int,
+        plan_id: str,
+        plan_name: str,
+        amount: float,
+    ) -> bool:
+        """
+        Атомарно перевести заказ в activating (из pending/failed/expired).
+        Нет заказа (платёж создан вне бота или заказ потерян) — создаётся сразу в activating.
+        False — заказ уже активируется или активирован другим обработчиком.
+        """
+        async with self._lock:
+            async with aiosqlite.connect(self.db_path) as db:
+                async with db.execute(
+                    """
+                    UPDATE orders SET status = 'activating'
+                    WHERE payment_id = ? AND status IN ('pending', 'failed', 'expired')
+                    RETURNING id
+                    """,
+                    (payment_id,),
+                ) as cur:
+                    claimed = await cur.fetchone() is not None
+                if not claimed:
+                    cursor = await db.execute(
+                        """
+                        INSERT OR IGNORE INTO orders (payment_id, telegram_id, plan_id, plan_name, amount, status)
+                        VALUES (?, ?, ?, ?, ?, 'activating')
+                        """,
+                        (payment_id, telegram_id, plan_id, plan_name, amount),
+                    )
+                    claimed = cursor.rowcount > 0
+                await db.commit()
+                return claimed
+
+    async def reset_stale_activations(self) -> int:
+        """При запуске: заказы, застрявшие в activating после остановки процесса, — в failed"""
+        async with self._lock:
+            async with aiosqlite.connect(self.db_path) as db:
+                cursor = await db.execute(
+                    "UPDATE orders SET status = 'failed' WHERE status = 'activating'"
+                )
+                await db.commit()
+                return cursor.rowcount
+
     async def update_order_success(
         self,
         payment_id: str,
         username: str,
         short_uuid: str,
+        duration_days: Optional[int] = None,
+        notifications: Optional[list[OutboxMessage]] = None,
     ) -> bool:
-        """Обновить заказ при успешной оплате"""
+        """
+        Обновить заказ при успешной оплате (duration_days — срок подписки для expires_at).
+        notifications записываются в outbox в той же транзакции — сообщение о подписке
+        не потеряется, даже если Telegram недоступен или процесс упадёт сразу после коммита.
+        """
         async with self._lock:
             async with aiosqlite.connect(self.db_path) as db:
                 cursor = await db.execute(
                     """
                     UPDATE orders SET status = 'succeeded', completed_at = ?,
-                    username = ?, short_uuid = ? WHERE payment_id = ?
+                    username = ?, short_uuid = ?,
+                    expires_at = CASE WHEN ? IS NULL THEN NULL ELSE datetime('now', '+' || ? || ' days') END
+                    WHERE payment_id = ?
                     """,
-                    (datetime.utcnow().isoformat(), username, short_uuid, payment_id),
+                    (datetime.utcnow().isoformat(), username, short_uuid,
+                     duration_days, duration_days, payment_id),
                 )
+                if cursor.rowcount > 0 and notifications:
+                    await self._insert_outbox(db, notifications)
                 await db.commit()
                 return cursor.rowcount > 0
 
+    async def backfill_order_expiry(self, plan_days: dict[str, int]) -> int:
+        """Заполнить expires_at у оплаченных заказов, созданных до появления колонки"""
+        updated = 0
+        async with self._lock:
+            async with aiosqlite.connect(self.db_path) as db:
+                for plan_id, days in plan_days.items():
+                    cursor = await db.execute(
+                        """
+                        UPDATE orders SET expires_at = datetime(completed_at, '+' || ? || ' days')
+                        WHERE plan_id = ? AND status = 'succeeded'
+                          AND expires_at IS NULL AND completed_at IS NOT NULL
+                        """,
+                        (days, plan_id),
+                    )
+                    updated += cursor.rowcount
+                await db.commit()
+        return updated
+
     async def update_order_status(self, payment_id: str, status: str) -> bool:
         """Обновить статус заказа"""
         async with self._lock:
@@ -172,6 +710,41 @@ class Database:
                 rows = await cursor.fetchall()
                 return [self._row_to_order(row) for row in rows]
 
+    async def get_latest_subscription_order(self, telegram_id: int) -> Optional[Order]:
+        """Оплаченный заказ с ключом и самым поздним окончанием (индекс idx_orders_user_expiry)"""
+        async with aiosqlite.connect(self.db_path) as db:
+            db.row_factory = aiosqlite.Row
+            async with db.execute(
+                """
+                SELECT * FROM orders
+                WHERE telegram_id = ? AND status = 'succeeded' AND short_uuid IS NOT NULL
+                ORDER BY expires_at DESC, id DESC
+                LIMIT 1
+                """,
+                (telegram_id,),
+            ) as cursor:
+                row = await cursor.fetchone()
+                return self._row_to_order(row) if row else None
+
+    async def set_order_expiry(self, order_id: int, expires_at: datetime) -> bool:
+        """
+        Перенести окончание заказа на дату из Remnawave (бонус, продление в панели).
+        Отметки expiry_reminders заказа снимаются — напоминания придут к новой дате.
+        False — дата та же.
+        """
+        value = expires_at.astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        async with self._lock:
+            async with aiosqlite.connect(self.db_path) as db:
+                cursor = await db.execute(
+                    "UPDATE orders SET expires_at = ? WHERE id = ? AND expires_at IS NOT ?",
+                    (value, order_id, value),
+                )
+                if cursor.rowcount == 0:
+                    return False
+                await db.execute("DELETE FROM expiry_reminders WHERE order_id = ?", (order_id,))
+                await db.commit()
+                return True
+
     async def has_used_trial(self, telegram_id: int) -> bool:
         """Проверить, использовал ли пользователь пробный период"""
         async with aiosqlite.connect(self.db_path) as db:
@@ -204,6 +777,13 @@ class Database:
                     (telegram_id,),
                 ) as cur:
                     if await cur.fetchone():
+                        # Вернулся после блокировки бота — снова получает рассылки
+                        await db.execute(
+                            "UPDATE user_seen SET unreachable_at = NULL "
+                            "WHERE telegram_id = ? AND unreachable_at IS NOT NULL",
+                            (telegram_id,),
+                        )
+                        await db.commit()
                         return False
                 await db.execute(
                     "INSERT INTO user_seen (telegram_id) VALUES (?)",
@@ -212,45 +792,270 @@ class Database:
                 await db.commit()
                 return True
 
-    async def user_is_new(self, telegram_id: int) -> bool:
-        """Проверить, был ли пользователь раньше в базе (заказы или trial)"""
+    async def get_user_state(self, telegram_id: int) -> UserState:
+        """Блокировка, визит, trial, заказы и реферер — одним запросом (по первичным ключам и индексам)"""
         async with aiosqlite.connect(self.db_path) as db:
             async with db.execute(
-                "SELECT 1 FROM orders WHERE telegram_id = ? LIMIT 1",
-                (telegram_id,),
+                """
+                SELECT
+                    EXISTS (SELECT 1 FROM blocked_users WHERE telegram_id = :id),
+                    (SELECT CASE WHEN unreachable_at IS NULL THEN 0 ELSE 1 END
+                     FROM user_seen WHERE telegram_id = :id),
+                    EXISTS (SELECT 1 FROM trial_users WHERE telegram_id = :id),
+                    EXISTS (SELECT 1 FROM orders WHERE telegram_id = :id),
+                    (SELECT referrer_id FROM referrals WHERE referral_id = :id LIMIT 1),
+                    EXISTS (SELECT 1 FROM referrals WHERE referral_id = :id AND rewarded_at IS NULL)
+                """,
+                {"id": telegram_id},
             ) as cur:
-                if await cur.fetchone():
-                    return False
+                (
+                    blocked, unreachable, trial_used, has_orders, referrer_id, referral_pending,
+                ) = await cur.fetchone()
+        return UserState(
+            telegram_id=telegram_id,
+            blocked=bool(blocked),
+            seen=unreachable is not None,
+            unreachable=bool(unreachable),
+            trial_used=bool(trial_used),
+            has_orders=bool(has_orders),
+            referrer_id=referrer_id,
+            referral_pending=bool(referral_pending),
+        )
+
+    async def get_expiring_orders(
+        self,
+        days: int,
+        since: str,
+        until: str,
+        after: tuple[str, int] = ("", 0),
+        limit: int = 500,
+    ) -> list[Order]:
+        """
+        Оплаченные заказы с expires_at в (since, until], которым ещё не отправлено
+        напоминание за days дней. Только последняя подписка пользователя (продливших
+        не беспокоим) и только доступные пользователи. Порядок и курсор after —
+        (expires_at, id); сканируется диапазон индекса idx_orders_expiry.
+        """
+        after_expiry, after_id = after
+        async with aiosqlite.connect(self.db_path) as db:
+            db.row_factory = aiosqlite.Row
             async with db.execute(
-                "SELECT 1 FROM trial_users WHERE telegram_id = ? LIMIT 1",
-                (telegram_id,),
-            ) as cur:
-                if await cur.fetchone():
-                    return False
+                """
+                SELECT o.* FROM orders o
+                WHERE o.status = 'succeeded' AND o.expires_at > ? AND o.expires_at <= ?
+                  AND (o.expires_at > ? OR (o.expires_at = ? AND o.id > ?))
+                  AND NOT EXISTS (
+                      SELECT 1 FROM orders n WHERE n.telegram_id = o.telegram_id
+                      AND n.status = 'succeeded' AND n.expires_at > o.expires_at
+                  )
+                  AND NOT EXISTS (
+                      SELECT 1 FROM expiry_reminders r WHERE r.order_id = o.id AND r.days = ?
+                  )
+                  AND NOT EXISTS (
+                      SELECT 1 FROM user_seen u
+                      WHERE u.telegram_id = o.telegram_id AND u.unreachable_at IS NOT NULL
+                  )
+                ORDER BY o.expires_at, o.id
+                LIMIT ?
+                """,
+                (since, until, after_expiry, after_expiry, after_id, days, limit),
+            ) as cursor:
+                rows = await cursor.fetchall()
+                return [self._row_to_order(row) for row in rows]
+
+    async def record_expiry_reminders(
+        self, days: int, reminders: list[tuple[int, OutboxMessage]]
+    ) -> int:
+        """
+        Записать напоминания (order_id, сообщение): отметка в expiry_reminders и сообщение
+        в outbox — в одной транзакции; уже отправленные пропускаются. Возвращает число новых.
+        """
+        created = 0
+        async with self._lock:
+            async with aiosqlite.connect(self.db_path) as db:
+                for order_id, message in reminders:
+                    cursor = await db.execute(
+                        "INSERT OR IGNORE INTO expiry_reminders (order_id, days) VALUES (?, ?)",
+                        (order_id, days),
+                    )
+                    if cursor.rowcount > 0:
+                        await self._insert_outbox(db, [message])
+                        created += 1
+                await db.commit()
+        return created
+
+    async def claim_referral(self, referrer_id: int, referral_id: int) -> bool:
+        """
+        Записать переход по реферальной ссылке (первичный ключ — защита от дублей).
+        True — бонус ещё не начислен (в том числе повтор после сбоя); False — уже начислен
+        или пользователь приглашён другим реферером.
+        """
+        async with self._lock:
+            async with aiosqlite.connect(self.db_path) as db:
+                await db.execute(
+                    """
+                    INSERT OR IGNORE INTO referrals (referrer_id, referral_id)
+                    SELECT ?, ? WHERE NOT EXISTS (
+                        SELECT 1 FROM referrals WHERE referral_id = ? AND referrer_id != ?
+                    )
+                    """,
+                    (referrer_id, referral_id, referral_id, referrer_id),
+                )
+                await db.commit()
+                async with db.execute(
+                    "SELECT rewarded_at FROM referrals WHERE referrer_id = ? AND referral_id = ?",
+                    (referrer_id, referral_id),
+                ) as cur:
+                    row = await cur.fetchone()
+                return row is not None and row[0] is None
+
+    async def get_referral_bonus_plan(
+        self, referrer_id: int, referral_id: int
+    ) -> Optional[tuple[str, datetime]]:
+        """Запланированное продление реферера (uuid в Remnawave, окончание после бонуса)"""
+        async with aiosqlite.connect(self.db_path) as db:
             async with db.execute(
-                "SELECT 1 FROM referrals WHERE referral_id = ? LIMIT 1",
-                (telegram_id,),
+                """
+                SELECT bonus_user_uuid, bonus_expires_at FROM referrals
+                WHERE referrer_id = ? AND referral_id = ?
+                """,
+                (referrer_id, referral_id),
             ) as cur:
-                if await cur.fetchone():
-                    return False  # уже приходил по реф-ссылке
-        return True
+                row = await cur.fetchone()
+        if not row or not row[0] or not row[1]:
+            return None
+        return row[0], datetime.fromisoformat(row[1])
 
-    async def add_referral(self, referrer_id: int, referral_id: int, order_id: Optional[int] = None) -> bool:
-        """Записать реферала"""
+    async def save_referral_bonus_plan(
+        self, referrer_id: int, referral_id: int, user_uuid: str, expires_at: datetime
+    ) -> None:
+        """Записать продление до обращения к панели — повторы доводят окончание до той же даты"""
         async with self._lock:
             async with aiosqlite.connect(self.db_path) as db:
-                try:
+                await db.execute(
+                    """
+                    UPDATE referrals SET bonus_user_uuid = ?, bonus_expires_at = ?
+                    WHERE referrer_id = ? AND referral_id = ? AND bonus_user_uuid IS NULL
+                    """,
+                    (user_uuid, expires_at.isoformat(), referrer_id, referral_id),
+                )
+                await db.commit()
+
+    async def mark_referral_rewarded(
+        self,
+        referrer_id: int,
+        referral_id: int,
+        notifications: Optional[list[OutboxMessage]] = None,
+    ) -> None:
+        """Отметить бонус начисленным; уведомление рефереру — в outbox той же транзакцией"""
+        async with self._lock:
+            async with aiosqlite.connect(self.db_path) as db:
+                cursor = await db.execute(
+                    """
+                    UPDATE referrals SET rewarded_at = CURRENT_TIMESTAMP
+                    WHERE referrer_id = ? AND referral_id = ? AND rewarded_at IS NULL
+                    """,
+                    (referrer_id, referral_id),
+                )
+                if cursor.rowcount > 0 and notifications:
+                    await self._insert_outbox(db, notifications)
+                await db.commit()
+
+    async def enqueue_job(
+        self, kind: str, payload: dict, event_id: Optional[str] = None
+    ) -> Optional[int]:
+        """
+        Поставить задачу в очередь jobs.
+        С event_id — только если событие ещё не встречалось (иначе None, задача не создаётся).
+        """
+        async with self._lock:
+            async with aiosqlite.connect(self.db_path) as db:
+                if event_id is not None:
+                    cursor = await db.execute(
+                        "INSERT OR IGNORE INTO processed_events (event_id) VALUES (?)",
+                        (event_id,),
+                    )
+                    if cursor.rowcount == 0:
+                        return None
+                cursor = await db.execute(
+                    "INSERT INTO jobs (kind, payload) VALUES (?, ?)",
+                    (kind, json.dumps(payload, ensure_ascii=False)),
+                )
+                await db.commit()
+                return cursor.lastrowid or 0
+
+    async def forget_event(self, event_id: str) -> None:
+        """Удалить событие из дедупликации — повторная доставка снова будет обработана"""
+        async with self._lock:
+            async with aiosqlite.connect(self.db_path) as db:
+                await db.execute("DELETE FROM processed_events WHERE event_id = ?", (event_id,))
+                await db.commit()
+
+    async def claim_job(self) -> Optional[Job]:
+        """Атомарно взять следующую готовую задачу (queued -> running)"""
+        async with self._lock:
+            async with aiosqlite.connect(self.db_path) as db:
+                async with db.execute(
+                    """
+                    UPDATE jobs SET status = 'running', attempts = attempts + 1
+                    WHERE id = (
+                        SELECT id FROM jobs
+                        WHERE status = 'queued' AND run_after <= datetime('now')
+                        ORDER BY run_after, id LIMIT 1
+                    )
+                    RETURNING id, kind, payload, attempts
+                    """
+                ) as cur:
+                    row = await cur.fetchone()
+                await db.commit()
+                if not row:
+                    return None
+                return Job(id=row[0], kind=row[1], payload=json.loads(row[2]), attempts=row[3])
+
+    async def finish_job(
+        self,
+        job_id: int,
+        status: str,
+        duration_ms: float,
+        error: Optional[str] = None,
+        retry_in_seconds: Optional[float] = None,
+    ) -> None:
+        """Завершить попытку: done, dead или снова queued с задержкой retry_in_seconds"""
+        async with self._lock:
+            async with aiosqlite.connect(self.db_path) as db:
+                if status == "queued":
                     await db.execute(
                         """
-                        INSERT OR REPLACE INTO referrals (referrer_id, referral_id, order_id)
-                        VALUES (?, ?, ?)
+                        UPDATE jobs SET status = 'queued', last_error = ?, duration_ms = ?,
+                        run_after = datetime('now', ?) WHERE id = ?
                         """,
-                        (referrer_id, referral_id, order_id),
+                        (error, duration_ms, f"+{int(retry_in_seconds or 0)} seconds", job_id),
                     )
-                    await db.commit()
-                    return True
-                except Exception:
-                    return False
+                else:
+                    await db.execute(
+                        """
+                        UPDATE jobs SET status = ?, last_error = ?, duration_ms = ?,
+                        finished_at = CURRENT_TIMESTAMP WHERE id = ?
+                        """,
+                        (status, error, duration_ms, job_id),
+                    )
+                await db.commit()
+
+    async def requeue_running_jobs(self) -> int:
+        """Вернуть в очередь задачи, прерванные остановкой процесса"""
+        async with self._lock:
+            async with aiosqlite.connect(self.db_path) as db:
+                cursor = await db.execute(
+                    "UPDATE jobs SET status = 'queued' WHERE status = 'running'"
+                )
+                await db.commit()
+                return cursor.rowcount
+
+    async def get_job_counts(self) -> dict[str, int]:
+        """Количество задач по статусам"""
+        async with aiosqlite.connect(self.db_path) as db:
+            async with db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status") as cur:
+                return {row[0]: int(row[1]) for row in await cur.fetchall()}
 
     async def get_stats(self) -> dict:
         """Получить статистику для админки"""
@@ -278,17 +1083,137 @@ class Database:
             ) as cur:
                 row = await cur.fetchone()
                 stats["orders_pending"] = int(row["cnt"]) if row else 0
+            async with db.execute(
+                "SELECT COUNT(*) as cnt FROM orders WHERE status = 'expired'"
+            ) as cur:
+                row = await cur.fetchone()
+                stats["orders_expired"] = int(row["cnt"]) if row else 0
             return stats
 
-    async def get_broadcast_recipients(self) -> list[int]:
-        """Список telegram_id всех, кто хотя бы раз заходил в бота (для рассылки)"""
+    async def get_broadcast_recipients(
+        self, after_id: int = 0, limit: int = -1, segment: str = "all"
+    ) -> list[int]:
+        """
+        telegram_id тех, кто заходил в бота, не заблокировал его и входит в сегмент,
+        по возрастанию после after_id — курсор для порционной отправки.
+        """
+        condition, params = _segment_filter(segment)
         async with aiosqlite.connect(self.db_path) as db:
             async with db.execute(
-                "SELECT telegram_id FROM user_seen ORDER BY telegram_id"
+                f"""
+                SELECT u.telegram_id FROM user_seen u
+                WHERE u.unreachable_at IS NULL AND u.telegram_id > ? AND {condition}
+                ORDER BY u.telegram_id LIMIT ?
+                """,
+                (after_id, *params, limit),
             ) as cur:
                 rows = await cur.fetchall()
                 return [r[0] for r in rows] if rows else []
 
+    async def count_broadcast_recipients(self, segment: str = "all") -> int:
+        """Количество получателей рассылки в сегменте"""
+        condition, params = _segment_filter(segment)
+        async with aiosqlite.connect(self.db_path) as db:
+            async with db.execute(
+                f"SELECT COUNT(*) FROM user_seen u WHERE u.unreachable_at IS NULL AND {condition}",
+                params,
+            ) as cur:
+                row = await cur.fetchone()
+                return row[0] if row else 0
+
+    async def create_broadcast(
+        self,
+        admin_id: int,
+        text: str,
+        photo_id: Optional[str],
+        buttons: list,
+        total: int,
+        segment: str = "all",
+    ) -> int:
+        """Создать рассылку в статусе running"""
+        async with self._lock:
+            async with aiosqlite.connect(self.db_path) as db:
+                cursor = await db.execute(
+                    """
+                    INSERT INTO broadcasts (admin_id, text, photo_id, buttons, total, segment)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    """,
+                    (admin_id, text, photo_id, json.dumps(buttons, ensure_ascii=False), total, segment),
+                )
+                await db.commit()
+                return cursor.lastrowid
+
+    async def get_broadcast(self, broadcast_id: int) -> Optional[Broadcast]:
+        """Получить рассылку по ID"""
+        async with aiosqlite.connect(self.db_path) as db:
+            db.row_factory = aiosqlite.Row
+            async with db.execute("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,)) as cur:
+                row = await cur.fetchone()
+                return self._row_to_broadcast(row) if row else None
+
+    async def get_running_broadcasts(self) -> list[Broadcast]:
+        """Незавершённые рассылки (продолжаются после перезапуска)"""
+        async with aiosqlite.connect(self.db_path) as db:
+            db.row_factory = aiosqlite.Row
+            async with db.execute(
+                "SELECT * FROM broadcasts WHERE status = 'running' ORDER BY id"
+            ) as cur:
+                rows = await cur.fetchall()
+                return [self._row_to_broadcast(r) for r in rows]
+
+    async def save_broadcast_progress(self, broadcast: Broadcast) -> None:
+        """Сохранить курсор и счётчики рассылки"""
+        async with self._lock:
+            async with aiosqlite.connect(self.db_path) as db:
+                await db.execute(
+                    """
+                    UPDATE broadcasts SET cursor = ?, sent = ?, failed = ?, unreachable = ?
+                    WHERE id = ?
+                    """,
+                    (broadcast.cursor, broadcast.sent, broadcast.failed, broadcast.unreachable, broadcast.id),
+                )
+                await db.commit()
+
+    async def set_broadcast_status_message(
+        self, broadcast_id: int, chat_id: int, message_id: int
+    ) -> None:
+        """Запомнить сообщение, в котором показывается прогресс рассылки"""
+        async with self._lock:
+            async with aiosqlite.connect(self.db_path) as db:
+                await db.execute(
+                    "UPDATE broadcasts SET status_chat_id = ?, status_message_id = ? WHERE id = ?",
+                    (chat_id, message_id, broadcast_id),
+                )
+                await db.commit()
+
+    async def finish_broadcast(self, broadcast_id: int, status: str) -> bool:
+        """
+        Завершить рассылку (done / cancelled). False — уже была завершена.
+        """
+        async with self._lock:
+            async with aiosqlite.connect(self.db_path) as db:
+                cursor = await db.execute(
+                    """
+                    UPDATE broadcasts SET status = ?, finished_at = CURRENT_TIMESTAMP
+                    WHERE id = ? AND status = 'running'
+                    """,
+                    (status, broadcast_id),
+                )
+                await db.commit()
+                return cursor.rowcount > 0
+
+    async def mark_unreachable(self, telegram_ids: list[int]) -> None:
+        """Пометить пользователей, которым нельзя доставить сообщение (бот заблокирован)"""
+        if not telegram_ids:
+            return
+        async with self._lock:
+            async with aiosqlite.connect(self.db_path) as db:
+                await db.executemany(
+                    "UPDATE user_seen SET unreachable_at = CURRENT_TIMESTAMP WHERE telegram_id = ?",
+                    [(tid,) for tid in telegram_ids],
+                )
+                await db.commit()
+
     async def get_stats_chart_data(self, days: int = 14) -> dict:
         """Данные для графика: покупки и выручка по дням за последние N дней"""
         async with aiosqlite.connect(self.db_path) as db:
@@ -413,6 +1338,171 @@ class Database:
         except (KeyError, ValueError, TypeError):
             return None
 
+    def _get_optional(self, row: aiosqlite.Row, key: str) -> Optional[str]:
+        """Значение необязательной колонки (в старой схеме может отсутствовать)"""
+        try:
+            return row[key]
+        except (IndexError, KeyError):
+            return None
+
+    @staticmethod
+    async def _insert_outbox(db: aiosqlite.Connection, messages: list[OutboxMessage]) -> None:
+        await db.executemany(
+            "INSERT INTO outbox (chat_id, text, parse_mode, reply_markup) VALUES (?, ?, ?, ?)",
+            [
+                (m.chat_id, m.text, m.parse_mode,
+                 json.dumps(m.reply_markup, ensure_ascii=False) if m.reply_markup else None)
+                for m in messages
+            ],
+        )
+
+    async def add_outbox(self, messages: list[OutboxMessage]) -> None:
+        """Поставить сообщения в outbox"""
+        if not messages:
+            return
+        async with self._lock:
+            async with aiosqlite.connect(self.db_path) as db:
+                await self._insert_outbox(db, messages)
+                await db.commit()
+
+    async def claim_outbox(self, limit: int) -> list[OutboxMessage]:
+        """Взять пачку сообщений к отправке (pending -> sending, attempts + 1)"""
+        async with self._lock:
+            async with aiosqlite.connect(self.db_path) as db:
+                db.row_factory = aiosqlite.Row
+                async with db.execute(
+                    """
+                    UPDATE outbox SET status = 'sending', attempts = attempts + 1
+                    WHERE id IN (
+                        SELECT id FROM outbox
+                        WHERE status = 'pending' AND next_attempt_at <= CURRENT_TIMESTAMP
+                        ORDER BY next_attempt_at, id LIMIT ?
+                    )
+                    RETURNING id, chat_id, text, parse_mode, attempts, reply_markup
+                    """,
+                    (limit,),
+                ) as cur:
+                    rows = await cur.fetchall()
+                await db.commit()
+                return [
+                    OutboxMessage(
+                        chat_id=r["chat_id"], text=r["text"], parse_mode=r["parse_mode"],
+                        id=r["id"], attempts=r["attempts"],
+                        reply_markup=json.loads(r["reply_markup"]) if r["reply_markup"] else None,
+                    )
+                    for r in sorted(rows, key=lambda r: r["id"])
+                ]
+
+    async def finish_outbox(
+        self,
+        message_id: int,
+        status: str,
+        error: Optional[str] = None,
+        retry_in_seconds: float = 0,
+        refund_attempt: bool = False,
+    ) -> None:
+        """
+        Результат отправки: sent, dead или pending (повтор через retry_in_seconds).
+        refund_attempt — не засчитывать попытку (флуд-лимит Telegram).
+        """
+        async with self._lock:
+            async with aiosqlite.connect(self.db_path) as db:
+                await db.execute(
+                    """
+                    UPDATE outbox SET status = ?, last_error = ?,
+                        attempts = attempts - ?,
+                        next_attempt_at = datetime('now', '+' || ? || ' seconds'),
+                        sent_at = CASE WHEN ? = 'sent' THEN CURRENT_TIMESTAMP ELSE sent_at END
+                    WHERE id = ?
+                    """,
+                    (status, error, int(refund_attempt), int(retry_in_seconds + 0.999),
+                     status, message_id),
+                )
+                await db.commit()
+
+    async def requeue_sending_outbox(self) -> int:
+        """Вернуть в очередь сообщения, отправка которых прервана перезапуском"""
+        async with self._lock:
+            async with aiosqlite.connect(self.db_path) as db:
+                cursor = await db.execute(
+                    "UPDATE outbox SET status = 'pending' WHERE status = 'sending'"
+                )
+                await db.commit()
+                return cursor.rowcount
+
+    async def count_pending_outbox(self) -> int:
+        """Количество неотправленных сообщений"""
+        async with aiosqlite.connect(self.db_path) as db:
+            async with db.execute("SELECT COUNT(*) FROM outbox WHERE status = 'pending'") as cur:
+                row = await cur.fetchone()
+                return row[0] if row else 0
+
+    async def load_user_data(self, telegram_id: int) -> Optional[dict]:
+        """Сохранённый user_data пользователя (None — записи нет)"""
+        async with aiosqlite.connect(self.db_path) as db:
+            async with db.execute(
+                "SELECT data FROM user_data WHERE telegram_id = ?", (telegram_id,)
+            ) as cur:
+                row = await cur.fetchone()
+        return json.loads(row[0]) if row else None
+
+    async def save_user_data(self, items: dict[int, str]) -> None:
+        """Записать user_data нескольких пользователей (JSON) одной транзакцией"""
+        if not items:
+            return
+        async with self._lock:
+            async with aiosqlite.connect(self.db_path) as db:
+                await db.executemany(
+                    """
+                    INSERT INTO user_data (telegram_id, data) VALUES (?, ?)
+                    ON CONFLICT(telegram_id) DO UPDATE SET
+                        data = excluded.data, updated_at = CURRENT_TIMESTAMP
+                    """,
+                    list(items.items()),
+                )
+                await db.commit()
+
+    async def delete_user_data(self, telegram_id: int) -> None:
+        async with self._lock:
+            async with aiosqlite.connect(self.db_path) as db:
+                await db.execute("DELETE FROM user_data WHERE telegram_id = ?", (telegram_id,))
+                await db.commit()
+
+    def _row_to_broadcast(self, row: aiosqlite.Row) -> Broadcast:
+        """Преобразовать строку в Broadcast"""
+        return Broadcast(
+            id=row["id"],
+            admin_id=row["admin_id"],
+            text=row["text"],
+            photo_id=row["photo_id"],
+            buttons=json.loads(row["buttons"] or "[]"),
+            status=row["status"],
+            total=row["total"] or 0,
+            cursor=row["cursor"] or 0,
+            sent=row["sent"] or 0,
+            failed=row["failed"] or 0,
+            unreachable=row["unreachable"] or 0,
+            segment=row["segment"] or "all",
+            status_chat_id=row["status_chat_id"],
+            status_message_id=row["status_message_id"],
+        )
+
+    def _row_to_intent(self, row: aiosqlite.Row) -> PaymentIntent:
+        """Преобразовать строку в PaymentIntent"""
+        return PaymentIntent(
+            id=row["id"],
+            idempotence_key=row["idempotence_key"],
+            telegram_id=row["telegram_id"],
+            plan_id=row["plan_id"],
+            plan_name=row["plan_name"],
+            amount=row["amount"],
+            referrer_id=row["referrer_id"],
+            payment_id=row["payment_id"],
+            status=row["status"],
+            created_at=datetime.fromisoformat(row["created_at"])
+            if row["created_at"] else datetime.utcnow(),
+        )
+
     def _row_to_order(self, row: aiosqlite.Row) -> Order:
         """Преобразовать строку в Order"""
         return Order(
@@ -430,4 +1520,7 @@ class Database:
             username=row["username"],
             short_uuid=row["short_uuid"],
             referrer_id=self._get_referrer_from_row(row),
+            confirmation_url=self._get_optional(row, "confirmation_url"),
+            expires_at=datetime.fromisoformat(row["expires_at"])
+            if self._get_optional(row, "expires_at") else None,
         )
@@ -0,0 +1,150 @@
+"""Очередь фоновых задач в SQLite (таблица jobs) и пул асинхронных обработчиков"""
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Optional
+
+import metrics
+from database import Database, Job
+
+logger = logging.getLogger(__name__)
+
+# Обработчик задачи: (job, last_attempt) -> None; исключение означает неудачную попытку
+JobHandler = Callable[[Job, bool], Awaitable[None]]
+# Задача ушла в dead (ошибка или таймаут последней попытки): (job, ошибка) -> None
+DeadJobHandler = Callable[[Job, Exception], Awaitable[None]]
+
+MAX_ATTEMPTS = 6
+# Задержка перед повтором: 5, 10, 20, 40, 80 сек
+RETRY_BASE_DELAY = 5.0
+# Больше худшего случая клиента Remnawave: 3 попытки по (логин + повторный логин при 401
+# + запрос) по 30 сек с паузами, затем поиск уже созданного пользователя
+JOB_TIMEOUT = 600.0
+# Как часто проверять очередь, если не было сигнала о новой задаче
+POLL_INTERVAL = 1.0
+
+
+class JobWorkerPool:
+    """
+    Пул обработчиков задач из таблицы jobs.
+
+    Задача сначала записывается в БД (переживает перезапуск), затем её забирает
+    свободный обработчик. Ошибка — повтор с экспоненциальной задержкой, после
+    MAX_ATTEMPTS попыток задача помечается dead (dead-letter) и вызывается
+    dead_handlers[kind] — в том числе когда последняя попытка прервана по JOB_TIMEOUT
+    (обработчик при этом получает CancelledError и сам ошибку обработать не может).
+    """
+
+    def __init__(
+        self,
+        db: Database,
+        handlers: dict[str, JobHandler],
+        workers: int = 4,
+        dead_handlers: Optional[dict[str, DeadJobHandler]] = None,
+    ):
+        self.db = db
+        self.handlers = handlers
+        self.dead_handlers = dead_handlers or {}
+        self.workers = max(workers, 1)
+        self._wakeup = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+
+    async def enqueue(
+        self, kind: str, payload: dict, event_id: Optional[str] = None
+    ) -> Optional[int]:
+        """
+        Записать задачу в очередь и разбудить обработчики.
+        event_id — ключ дедупликации: повторное событие отклоняется (None).
+        """
+        job_id = await self.db.enqueue_job(kind, payload, event_id=event_id)
+        if job_id is None:
+            metrics.incr("jobs.duplicates")
+            return None
+        self._wakeup.set()
+        return job_id
+
+    async def start(self) -> None:
+        """Вернуть прерванные задачи в очередь и запустить обработчики"""
+        requeued = await self.db.requeue_running_jobs()
+        if requeued:
+            logger.info(f"Очередь задач: возвращено после перезапуска — {requeued}")
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        """Остановить обработчики (незавершённые задачи вернутся в очередь при запуске)"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _next_job(self) -> Optional[Job]:
+        """Взять задачу; если очередь пуста — подождать сигнала или POLL_INTERVAL"""
+        job = await self.db.claim_job()
+        if job:
+            return job
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        return None
+
+    async def _worker(self) -> None:
+        while True:
+            try:
+                job = await self._next_job()
+                if job:
+                    await self._run(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"Очередь задач: ошибка обработчика: {e}")
+                await asyncio.sleep(POLL_INTERVAL)
+
+    async def _run(self, job: Job) -> None:
+        """Выполнить одну попытку задачи и записать результат"""
+        handler = self.handlers.get(job.kind)
+        if not handler:
+            await self.db.finish_job(job.id, "dead", 0.0, error=f"Нет обработчика для {job.kind}")
+            logger.error(f"Задача {job.id}: неизвестный тип {job.kind}")
+            return
+
+        last_attempt = job.attempts >= MAX_ATTEMPTS
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(handler(job, last_attempt), JOB_TIMEOUT)
+        except Exception as e:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            metrics.observe(f"job.{job.kind}", elapsed_ms, ok=False)
+            error = f"{type(e).__name__}: {e}"[:1000]
+            if last_attempt:
+                metrics.incr("jobs.dead")
+                logger.error(f"Задача {job.id} ({job.kind}) не выполнена за {job.attempts} попыток: {error}")
+                await self._on_dead(job, e)
+                await self.db.finish_job(job.id, "dead", elapsed_ms, error=error)
+            else:
+                delay = RETRY_BASE_DELAY * 2 ** (job.attempts - 1)
+                metrics.incr("jobs.retried")
+                logger.warning(
+                    f"Задача {job.id} ({job.kind}), попытка {job.attempts}/{MAX_ATTEMPTS}: {error}. "
+                    f"Повтор через {delay:.0f} сек"
+                )
+                await self.db.finish_job(
+                    job.id, "queued", elapsed_ms, error=error, retry_in_seconds=delay
+                )
+            return
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        metrics.observe(f"job.{job.kind}", elapsed_ms)
+        metrics.incr("jobs.done")
+        await self.db.finish_job(job.id, "done", elapsed_ms)
+
+    async def _on_dead(self, job: Job, error: Exception) -> None:
+        """Обработка окончательной ошибки задачи (уведомление, снятие захвата и т.п.)"""
+        on_dead = self.dead_handlers.get(job.kind)
+        if not on_dead:
+            return
+        try:
+            await asyncio.wait_for(on_dead(job, error), JOB_TIMEOUT)
+        except Exception as e:
+            logger.exception(f"Задача {job.id} ({job.kind}): ошибка обработки dead: {e}")
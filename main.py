@@ -1,15 +1,26 @@
-"""Точка входа приложения — единый режим: webhook + nginx + админ-панель"""
+"""Точка входа приложения — единый режим: бот, webhook и админ-панель в одном event loop"""
 import asyncio
+import contextlib
 import logging
 import os
+import signal
 import sys
-import threading
+from dataclasses import replace
 
-from config import Config
-from bot import create_bot
+import uvicorn
+from telegram import Update
+from telegram.ext import Application
 
+import webhook
+from bot import REFERRAL_JOB, create_bot
+from config import Config
 from logging_config import setup_logging
 
+try:
+    import uvloop
+except ImportError:  # необязательная зависимость (uvicorn[standard])
+    uvloop = None
+
 log_dir = os.getenv("VPN_BOT_LOG_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs")
 try:
     setup_logging(log_dir)
@@ -23,45 +34,148 @@ except Exception:
 logger = logging.getLogger(__name__)
 
 
-async def run_bot(config: Config):
-    """Запустить бота (polling)"""
-    if not config.bot_token:
-        logger.error("TELEGRAM_BOT_TOKEN не задан в .env")
-        sys.exit(1)
+def _make_server(app, host: str, port: int, log_level: str = "info") -> uvicorn.Server:
+    """uvicorn.Server для запуска внутри общего event loop (сигналы обрабатывает main)"""
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level=log_level))
+    server.capture_signals = contextlib.nullcontext
+    return server
+
+
+async def _start_updates(config: Config, app: Application) -> None:
+    """Начать получение обновлений Telegram: webhook (TELEGRAM_WEBHOOK_ENABLED) или polling"""
+    if config.telegram_webhook_enabled:
+        # Обновления принимает маршрут webhook.py и кладёт в app.update_queue
+        from webhook import attach_telegram_application, telegram_webhook_secret, telegram_webhook_url
+        attach_telegram_application(app, asyncio.get_running_loop())
+        await app.bot.set_webhook(
+            url=telegram_webhook_url(config),
+            secret_token=telegram_webhook_secret(config),
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=True,
+        )
+        logger.info("Бот запущен (webhook)")
+    else:
+        # start_polling сам удаляет ранее установленный webhook;
+        # ALL_TYPES — чтобы приходили chat_member (обновление кэша подписки на канал)
+        await app.updater.start_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
+        logger.info("Бот запущен (polling)")
+
+
+async def _spawn_webhook_workers(config: Config) -> asyncio.subprocess.Process:
+    """WEBHOOK_WORKERS > 1: webhook в отдельных процессах uvicorn (фабрика webhook.create_app)"""
+    logger.info(f"Webhook: {config.webhook_workers} процессов uvicorn на порту {config.webhook_port}")
+    return await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "uvicorn", "webhook:create_app", "--factory",
+        "--host", config.webhook_host,
+        "--port", str(config.webhook_port),
+        "--workers", str(config.webhook_workers),
+        # cwd наследуется — воркеры открывают ту же vpn_bot.db, что и бот
+        "--app-dir", os.path.dirname(os.path.abspath(__file__)),
+    )
 
-    bot = create_bot(config)
-    await bot.db.init()
-    app = bot.build_application()
-    await app.initialize()
-    await app.start()
-    logger.info("Бот запущен (polling)")
 
-    await app.updater.start_polling(drop_pending_updates=True)
-    stop_event = asyncio.Event()
+async def _stop_process(proc: asyncio.subprocess.Process, timeout: float = 15.0) -> None:
+    """Остановить дочерний процесс: SIGTERM, по таймауту — SIGKILL"""
+    if proc.returncode is not None:
+        return
+    proc.terminate()
     try:
-        await stop_event.wait()
-    except asyncio.CancelledError:
-        pass
+        await asyncio.wait_for(proc.wait(), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
 
-    await app.updater.stop()
-    await app.stop()
-    await app.shutdown()
 
+async def run(config: Config) -> None:
+    """
+    Бот, webhook Yookassa/Telegram и админ-панель в одном event loop.
 
-def run_admin_panel_thread(config: Config, db, remnawave):
-    """Запуск админ-панели в отдельном потоке"""
-    if not config.admin_panel_enabled or not config.admin_panel_password:
-        return
-    from admin_panel import run_admin_panel
-    t = threading.Thread(target=run_admin_panel, args=(config, db, remnawave), daemon=True)
-    t.start()
-    logger.info("Админ-панель запущена в фоне (SSH-туннель)")
+    БД, клиенты Remnawave/Yookassa и Telegram Bot создаются один раз (в VPNBot)
+    и передаются webhook-серверу и админ-панели. Админ-панель слушает отдельный
+    порт на 127.0.0.1.
 
+    При WEBHOOK_WORKERS > 1 webhook обслуживают отдельные процессы uvicorn, а очередь
+    задач и сверка платежей остаются в этом процессе.
+    """
+    multi_worker = config.webhook_workers > 1
+    if multi_worker and config.telegram_webhook_enabled:
+        # Очередь обновлений PTB есть только в этом процессе
+        logger.warning("WEBHOOK_WORKERS > 1: обновления Telegram получаются через polling")
+        config = replace(config, telegram_webhook_enabled=False)
 
-def run_webhook():
-    """Запустить webhook, бота и админ-панель (nginx — reverse proxy)"""
-    from webhook import run_webhook_server
+    bot = create_bot(config)
+    await bot.init_services()
+    app = bot.build_application()
+    await app.initialize()
+    bot.load_identity(app.bot)
+    await bot.start_senders()
+
+    # Уведомления об оплате — через отдельный Bot с приоритетом ниже ответов пользователям
+    webhook.configure(config, bot.db, bot.remnawave, bot.notify_bot, bot.payments)
+    # Реферальные бонусы начисляются в фоне — /start отвечает сразу
+    webhook.register_job_handler(REFERRAL_JOB, bot.referral_job, on_dead=bot.referral_dead)
+    bot.enqueue_job = webhook.enqueue_job
+    # После оплаты «Моя подписка» показывает новую ссылку, а не экран из кэша
+    webhook.register_subscription_listener(bot.subscriptions.invalidate)
+    servers: list[uvicorn.Server] = []
+    background: list[asyncio.Task] = []
+    workers_proc = None
+    if multi_worker:
+        background = await webhook.start_background()
+        workers_proc = await _spawn_webhook_workers(config)
+    else:
+        servers.append(_make_server(webhook.app, config.webhook_host, config.webhook_port))
+    if config.admin_panel_enabled and config.admin_panel_password:
+        import admin_panel
+        admin_panel.configure(config, bot.db, bot.remnawave)
+        servers.append(
+            _make_server(admin_panel.app, "127.0.0.1", config.admin_panel_port, log_level="warning")
+        )
+        logger.info(f"Админ-панель: ssh -L {config.admin_panel_port}:127.0.0.1:{config.admin_panel_port} user@server")
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows: остановка через KeyboardInterrupt
+            pass
+
+    server_tasks = [asyncio.create_task(s.serve()) for s in servers]
+    if workers_proc:
+        server_tasks.append(asyncio.create_task(workers_proc.wait()))
+    await app.start()
+    await _start_updates(config, app)
+    await bot.resume_broadcasts()
 
+    # Остановка по сигналу или если один из серверов завершился (например, порт занят)
+    stop_task = asyncio.create_task(stop_event.wait())
+    try:
+        await asyncio.wait([stop_task, *server_tasks], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        logger.info("Остановка...")
+        stop_task.cancel()
+        await bot.broadcasts.stop()
+        if app.updater.running:
+            await app.updater.stop()
+        webhook.attach_telegram_application(None)
+        await app.stop()
+        for server in servers:
+            server.should_exit = True
+        if workers_proc:
+            await _stop_process(workers_proc)
+        await asyncio.gather(*server_tasks, return_exceptions=True)
+        await webhook.stop_background(background)
+        await app.shutdown()
+        await bot.stop_senders()
+        if bot.yookassa:
+            await bot.yookassa.aclose()
+        bot.remnawave.close()
+
+
+def main() -> None:
+    """Проверить настройки и запустить приложение (nginx — reverse proxy)"""
     config = Config.from_env()
 
     if not config.bot_token:
@@ -76,34 +190,11 @@ def run_webhook():
         logger.error("Задайте WEBHOOK_BASE_URL в .env (например https://bot.your-domain.com)")
         sys.exit(1)
 
-    # Админ-панель в отдельном потоке (до создания бота нужны db и remnawave)
-    from database import Database
-    from remnawave_client import RemnawaveClient
-    db = Database()
-    remnawave = RemnawaveClient(config.remnawave)
-
-    def start_admin():
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(db.init())
-        from admin_panel import run_admin_panel
-        run_admin_panel(config, db, remnawave)
-
-    if config.admin_panel_enabled and config.admin_panel_password:
-        admin_thread = threading.Thread(target=start_admin, daemon=True)
-        admin_thread.start()
-        logger.info(f"Админ-панель: ssh -L {config.admin_panel_port}:127.0.0.1:{config.admin_panel_port} user@server")
-
-    # Webhook в отдельном потоке
-    def start_webhook():
-        run_webhook_server(config)
-
-    webhook_thread = threading.Thread(target=start_webhook, daemon=True)
-    webhook_thread.start()
-
-    # Бот в main thread
-    asyncio.run(run_bot(config))
+    try:
+        (uvloop.run if uvloop else asyncio.run)(run(config))
+    except KeyboardInterrupt:
+        pass
 
 
 if __name__ == "__main__":
-    run_webhook()
+    main()
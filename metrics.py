@@ -0,0 +1,100 @@
+"""Простые метрики процесса: счётчики и задержки внешних вызовов"""
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Iterator
+
+_lock = threading.Lock()
+
+
+@dataclass
+class LatencyStats:
+    """Агрегированная статистика задержек одного вызова"""
+    count: int = 0
+    errors: int = 0
+    total_ms: float = 0.0
+    max_ms: float = 0.0
+    last_ms: float = 0.0
+    # Скользящее среднее последних вызовов (для детектора перегрузки)
+    recent_ms: float = 0.0
+    recent_at: float = 0.0  # time.monotonic() последнего замера
+
+    def as_dict(self) -> dict:
+        avg = self.total_ms / self.count if self.count else 0.0
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "avg_ms": round(avg, 1),
+            "max_ms": round(self.max_ms, 1),
+            "last_ms": round(self.last_ms, 1),
+            "recent_ms": round(self.recent_ms, 1),
+        }
+
+
+# Вес нового замера в recent_ms (~ последние 10 вызовов)
+RECENT_WEIGHT = 0.2
+
+_latency: dict[str, LatencyStats] = {}
+_counters: dict[str, int] = {}
+_gauges: dict[str, float] = {}
+
+
+def observe(name: str, elapsed_ms: float, ok: bool = True) -> None:
+    """Записать длительность вызова name (в миллисекундах)"""
+    with _lock:
+        stats = _latency.setdefault(name, LatencyStats())
+        stats.count += 1
+        stats.total_ms += elapsed_ms
+        stats.last_ms = elapsed_ms
+        stats.recent_at = time.monotonic()
+        if stats.count == 1:
+            stats.recent_ms = elapsed_ms
+        else:
+            stats.recent_ms += RECENT_WEIGHT * (elapsed_ms - stats.recent_ms)
+        stats.max_ms = max(stats.max_ms, elapsed_ms)
+        if not ok:
+            stats.errors += 1
+
+
+@contextmanager
+def timed(name: str) -> Iterator[None]:
+    """Замерить блок кода; исключение засчитывается как ошибка"""
+    started = time.perf_counter()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        observe(name, (time.perf_counter() - started) * 1000, ok)
+
+
+def recent_latency(name: str, max_age: float = 30.0) -> float:
+    """Скользящее среднее задержки name, мс; 0 — вызовов не было max_age секунд"""
+    with _lock:
+        stats = _latency.get(name)
+        if not stats or time.monotonic() - stats.recent_at > max_age:
+            return 0.0
+        return stats.recent_ms
+
+
+def incr(name: str, value: int = 1) -> None:
+    """Увеличить счётчик name"""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def gauge(name: str, value: float) -> None:
+    """Установить текущее значение name (последний результат, размер очереди и т.п.)"""
+    with _lock:
+        _gauges[name] = value
+
+
+def snapshot() -> dict:
+    """Текущее состояние всех метрик (для админ-панели)"""
+    with _lock:
+        return {
+            "latency": {k: v.as_dict() for k, v in sorted(_latency.items())},
+            "counters": dict(sorted(_counters.items())),
+            "gauges": dict(sorted(_gauges.items())),
+        }
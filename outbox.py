@@ -0,0 +1,133 @@
+"""Доставка исходящих сообщений Telegram из таблицы outbox"""
+import asyncio
+import logging
+from datetime import timedelta
+from typing import Optional
+
+from telegram import Bot, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, RetryAfter
+
+import metrics
+from database import Database, OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 8
+# Задержка перед повтором: 5, 10, 20, ... сек
+RETRY_BASE_DELAY = 5.0
+BATCH_SIZE = 20
+# Как часто проверять outbox, если не было сигнала о новом сообщении
+POLL_INTERVAL = 2.0
+
+
+class OutboxDispatcher:
+    """
+    Отправка сообщений, записанных в outbox вместе с изменением заказа.
+
+    Сообщение сначала фиксируется в БД в транзакции оплаты, затем диспетчер
+    забирает пачку и отправляет её параллельно. RetryAfter — повтор через
+    указанное Telegram время, Forbidden (бот заблокирован) — сразу dead,
+    прочие ошибки — экспоненциальная задержка, после MAX_ATTEMPTS — dead.
+    """
+
+    def __init__(self, db: Database, bot: Bot, batch_size: int = BATCH_SIZE):
+        self.db = db
+        self.bot = bot
+        self.batch_size = max(batch_size, 1)
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def wake(self) -> None:
+        """Сообщить о новых сообщениях (не ждать POLL_INTERVAL)"""
+        self._wakeup.set()
+
+    async def start(self) -> None:
+        """Вернуть прерванные отправки в очередь и запустить диспетчер"""
+        requeued = await self.db.requeue_sending_outbox()
+        if requeued:
+            logger.info(f"Outbox: возвращено после перезапуска — {requeued}")
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        """Остановить диспетчер (неотправленное останется в outbox)"""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                self._wakeup.clear()
+                messages = await self.db.claim_outbox(self.batch_size)
+                if messages:
+                    await asyncio.gather(*(self._deliver(m) for m in messages))
+                metrics.gauge("outbox.pending", await self.db.count_pending_outbox())
+                if len(messages) < self.batch_size:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), POLL_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"Outbox: ошибка диспетчера: {e}")
+                await asyncio.sleep(POLL_INTERVAL)
+
+    async def _deliver(self, message: OutboxMessage) -> None:
+        """Одна попытка отправки и запись результата"""
+        try:
+            with metrics.timed("telegram.outbox_send"):
+                await self.bot.send_message(
+                    chat_id=message.chat_id,
+                    text=message.text,
+                    parse_mode=message.parse_mode,
+                    reply_markup=(
+                        InlineKeyboardMarkup.de_json(message.reply_markup, self.bot)
+                        if message.reply_markup else None
+                    ),
+                )
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            delay = retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+            metrics.incr("outbox.retried")
+            # Флуд-лимит не считается неудачной попыткой
+            await self.db.finish_outbox(
+                message.id, "pending", error=str(e), retry_in_seconds=delay,
+                refund_attempt=True,
+            )
+            return
+        except (Forbidden, BadRequest) as e:
+            # Бот заблокирован, чат не найден, некорректный текст — повтор не поможет
+            await self._dead(message, e)
+            return
+        except Exception as e:
+            if message.attempts >= MAX_ATTEMPTS:
+                await self._dead(message, e)
+            else:
+                await self._retry(message, e)
+            return
+        metrics.incr("outbox.sent")
+        await self.db.finish_outbox(message.id, "sent")
+
+    async def _retry(self, message: OutboxMessage, error: Exception) -> None:
+        delay = RETRY_BASE_DELAY * 2 ** (message.attempts - 1)
+        metrics.incr("outbox.retried")
+        logger.warning(
+            f"Outbox: сообщение {message.id} (chat {message.chat_id}), попытка "
+            f"{message.attempts}/{MAX_ATTEMPTS}: {error}. Повтор через {delay:.0f} сек"
+        )
+        await self.db.finish_outbox(
+            message.id, "pending", error=f"{type(error).__name__}: {error}"[:1000],
+            retry_in_seconds=delay,
+        )
+
+    async def _dead(self, message: OutboxMessage, error: Exception) -> None:
+        metrics.incr("outbox.dead")
+        logger.error(
+            f"Outbox: сообщение {message.id} (chat {message.chat_id}) не доставлено "
+            f"за {message.attempts} попыток: {error}"
+        )
+        await self.db.finish_outbox(
+            message.id, "dead", error=f"{type(error).__name__}: {error}"[:1000]
+        )
@@ -0,0 +1,223 @@
+"""Оформление оплаты: создание платежей Yookassa, заказов и сверка статусов"""
+import asyncio
+import logging
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Optional
+
+import metrics
+from config import Config, PlanConfig
+from database import Database, Order, PaymentIntent
+from yookassa_client import YookassaClient, YookassaError
+
+logger = logging.getLogger(__name__)
+
+# Yookassa хранит ключ идемпотентности 24 часа; берём с запасом
+IDEMPOTENCE_KEY_TTL_HOURS = 23
+
+# Сверка: не трогаем совсем свежие заказы — webhook обычно приходит за секунды
+RECONCILE_MIN_AGE_SECONDS = 120
+RECONCILE_BATCH_SIZE = 20
+RECONCILE_CONCURRENCY = 5
+# Пауза между пачками запросов к Yookassa (ограничение частоты)
+RECONCILE_BATCH_PAUSE = 1.0
+
+# Активация оплаченного заказа: (payment_id, metadata) -> None
+ActivateCallback = Callable[[str, dict], Awaitable[None]]
+
+
+@dataclass
+class Checkout:
+    """Ссылка на оплату для пользователя"""
+    payment_id: str
+    confirmation_url: str
+    reused: bool = False  # True — выдана ссылка ранее созданного платежа
+
+
+class PaymentService:
+    """
+    Создание платежей с повторной выдачей неоплаченных ссылок.
+
+    Перед запросом к Yookassa в БД пишется намерение (payment_intents) с ключом
+    идемпотентности. Повтор после сбоя (в том числе после перезапуска) идёт с тем же
+    ключом, поэтому Yookassa вернёт уже созданный платёж, а не создаст второй.
+    """
+
+    def __init__(self, config: Config, db: Database, yookassa: YookassaClient):
+        self.config = config
+        self.db = db
+        self.yookassa = yookassa
+
+    async def _find_reusable(self, telegram_id: int, plan: PlanConfig) -> Optional[Checkout]:
+        """Неоплаченный платёж того же пользователя и тарифа, созданный в пределах TTL"""
+        ttl = self.config.payment_link_ttl_minutes
+        if ttl <= 0:
+            return None
+        order = await self.db.get_pending_order(telegram_id, plan.id, plan.price, ttl)
+        if not order or not order.confirmation_url:
+            return None
+        return Checkout(order.payment_id, order.confirmation_url, reused=True)
+
+    def _payment_request(self, intent: PaymentIntent) -> dict:
+        """Параметры платежа строятся только из намерения — повтор с тем же ключом идентичен"""
+        metadata = {
+            "telegram_id": str(intent.telegram_id),
+            "plan_id": intent.plan_id,
+            "intent_id": str(intent.id),
+        }
+        if intent.referrer_id:
+            metadata["referrer_id"] = str(intent.referrer_id)
+        return {
+            "amount": intent.amount,
+            "description": f"VPN подписка: {intent.plan_name}",
+            "return_url": f"{self.config.webhook_base_url}/return",
+            "metadata": metadata,
+            "idempotence_key": intent.idempotence_key,
+        }
+
+    async def checkout(
+        self,
+        telegram_id: int,
+        plan: PlanConfig,
+        referrer_id: Optional[int] = None,
+    ) -> Checkout:
+        """
+        Получить ссылку на оплату тарифа.
+
+        Повторное нажатие того же тарифа в течение PAYMENT_LINK_TTL_MINUTES
+        возвращает уже созданную ссылку без запроса к Yookassa.
+        """
+        existing = await self._find_reusable(telegram_id, plan)
+        if existing:
+            logger.info(f"Повторная выдача ссылки: payment_id={existing.payment_id}, telegram_id={telegram_id}")
+            return existing
+
+        # Незавершённое намерение: прошлый запрос мог дойти до Yookassa — повторяем с его ключом
+        intent = await self.db.get_open_intent(
+            telegram_id, plan.id, plan.price, IDEMPOTENCE_KEY_TTL_HOURS
+        )
+        if intent is None:
+            intent = await self.db.create_payment_intent(
+                idempotence_key=str(uuid.uuid4()),
+                telegram_id=telegram_id,
+                plan_id=plan.id,
+                plan_name=plan.name,
+                amount=plan.price,
+                referrer_id=referrer_id,
+            )
+
+        try:
+            payment = await self.yookassa.create_payment(**self._payment_request(intent))
+        except YookassaError as e:
+            # 4xx — платёж точно не создан; иначе намерение остаётся для повтора/сверки
+            if e.status_code and 400 <= e.status_code < 500:
+                await self.db.update_intent_status(intent.id, "failed")
+            raise
+
+        confirmation_url = payment.get("confirmation_url")
+        await self.db.link_intent_order(intent, payment["id"], confirmation_url)
+        if not confirmation_url:
+            raise YookassaError(f"Yookassa не вернула confirmation_url: {payment}")
+        return Checkout(payment["id"], confirmation_url)
+
+    async def adopt_orphaned_intents(self) -> int:
+        """
+        Сверка при запуске: найти в Yookassa платежи по незавершённым намерениям
+        и создать для них заказы. Возвращает количество принятых платежей.
+        """
+        intents = await self.db.get_orphaned_intents()
+        if not intents:
+            return 0
+
+        now = datetime.utcnow()
+        key_deadline = now - timedelta(hours=IDEMPOTENCE_KEY_TTL_HOURS)
+        by_id = {str(i.id): i for i in intents}
+        since = min(i.created_at for i in intents) - timedelta(minutes=5)
+        created_gte = since.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+        adopted = 0
+        cursor: Optional[str] = None
+        while by_id:
+            payments, cursor = await self.yookassa.list_payments(created_gte, cursor=cursor)
+            for payment in payments:
+                intent = by_id.pop(str(payment["metadata"].get("intent_id")), None)
+                if not intent:
+                    continue
+                await self.db.link_intent_order(intent, payment["id"], payment.get("confirmation_url"))
+                if payment["status"] == "canceled":
+                    await self.db.update_order_status(payment["id"], "canceled")
+                adopted += 1
+                logger.info(
+                    f"Принят потерянный платёж: payment_id={payment['id']}, intent_id={intent.id}, "
+                    f"status={payment['status']}"
+                )
+            if not cursor:
+                break
+
+        # Не найдены в Yookassa и ключ уже недействителен — платёж не создавался
+        for intent in by_id.values():
+            if intent.created_at < key_deadline:
+                await self.db.update_intent_status(intent.id, "abandoned")
+        return adopted
+
+    async def _reconcile_order(self, order: Order, activate: ActivateCallback) -> Optional[str]:
+        """Запросить статус платежа и применить его к заказу. Возвращает статус Yookassa."""
+        try:
+            payment = await self.yookassa.get_payment(order.payment_id)
+        except YookassaError as e:
+            logger.warning(f"Сверка: не удалось получить платёж {order.payment_id}: {e}")
+            return None
+        status = payment["status"]
+        if status == "succeeded":
+            logger.info(f"Сверка: платёж {order.payment_id} оплачен, webhook не получен — активация")
+            metadata = dict(payment["metadata"])
+            metadata.setdefault("telegram_id", str(order.telegram_id))
+            metadata.setdefault("plan_id", order.plan_id)
+            await activate(order.payment_id, metadata)
+        elif status == "canceled":
+            await self.db.update_order_status(order.payment_id, "canceled")
+        return status
+
+    async def reconcile_pending(self, activate: ActivateCallback) -> dict:
+        """
+        Сверить неоплаченные заказы с Yookassa (на случай потерянного webhook).
+
+        Заказы берутся через частичный индекс idx_orders_pending в окне возраста,
+        запросы идут пачками по RECONCILE_BATCH_SIZE с ограничением параллельности.
+        Оплаченные передаются в activate — тот же путь, что и у webhook.
+        """
+        semaphore = asyncio.Semaphore(RECONCILE_CONCURRENCY)
+        result = {"checked": 0, "succeeded": 0, "canceled": 0}
+
+        async def check(order: Order) -> Optional[str]:
+            async with semaphore:
+                return await self._reconcile_order(order, activate)
+
+        after_id = 0
+        while True:
+            orders = await self.db.get_pending_orders_for_reconcile(
+                RECONCILE_MIN_AGE_SECONDS,
+                self.config.payment_reconcile_max_age_hours,
+                after_id=after_id,
+                limit=RECONCILE_BATCH_SIZE,
+            )
+            if not orders:
+                break
+            after_id = orders[-1].id
+            statuses = await asyncio.gather(*(check(o) for o in orders), return_exceptions=True)
+            for status in statuses:
+                if isinstance(status, Exception):
+                    logger.error(f"Сверка: ошибка обработки заказа: {status}")
+                    continue
+                result["checked"] += 1
+                if status in ("succeeded", "canceled"):
+                    result[status] += 1
+            if len(orders) < RECONCILE_BATCH_SIZE:
+                break
+            await asyncio.sleep(RECONCILE_BATCH_PAUSE)
+
+        metrics.incr("reconcile.checked", result["checked"])
+        metrics.incr("reconcile.succeeded", result["succeeded"])
+        metrics.incr("reconcile.canceled", result["canceled"])
+        return result
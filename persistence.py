@@ -0,0 +1,173 @@
+"""Хранение context.user_data бота в SQLite (PTB BasePersistence)"""
+import asyncio
+import json
+import logging
+import time
+from typing import Optional
+
+from telegram.ext import Application, BasePersistence, PersistenceInput
+
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+# Как часто PTB передаёт изменённые user_data (сек)
+UPDATE_INTERVAL = 30
+# Изменения, пришедшие за это время, пишутся одной транзакцией
+WRITE_DELAY = 0.2
+# Пользователь без обновлений дольше IDLE_TTL выгружается из памяти (данные остаются в БД)
+IDLE_TTL = 3600
+EVICT_INTERVAL = 300
+
+
+class SqlitePersistence(BasePersistence[dict, dict, dict]):
+    """
+    user_data в таблице user_data; chat_data, bot_data и callback_data не хранятся.
+
+    Загрузка ленивая: данные пользователя читаются из БД при его первом обновлении
+    (refresh_user_data), а не все сразу при запуске. PTB раз в UPDATE_INTERVAL
+    передаёт user_data всех, кто писал боту, — в БД попадают только реально
+    изменившиеся, пачкой в одной транзакции. Неактивные пользователи выгружаются
+    из памяти через IDLE_TTL.
+    """
+
+    def __init__(self, db: Database, update_interval: float = UPDATE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(
+                bot_data=False, chat_data=False, user_data=True, callback_data=False
+            ),
+            update_interval=update_interval,
+        )
+        self.db = db
+        self.application: Optional[Application] = None
+        # user_id -> JSON, совпадающий с БД (только загруженные пользователи)
+        self._saved: dict[int, str] = {}
+        self._last_seen: dict[int, float] = {}
+        self._dirty: dict[int, str] = {}
+        self._write_task: Optional[asyncio.Task] = None
+        self._evicting: set[int] = set()
+        self._last_evict = time.monotonic()
+
+    def bind(self, application: Application) -> None:
+        """Приложение, из памяти которого выгружаются неактивные пользователи"""
+        self.application = application
+
+    @staticmethod
+    def _dump(data: dict) -> Optional[str]:
+        try:
+            return json.dumps(data, ensure_ascii=False, sort_keys=True)
+        except (TypeError, ValueError) as e:
+            logger.warning(f"user_data не сериализуется в JSON и не будет сохранён: {e}")
+            return None
+
+    async def get_user_data(self) -> dict[int, dict]:
+        # Ничего не загружаем заранее — см. refresh_user_data
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        """Перед обработкой обновления: подгрузить данные пользователя, если их ещё нет в памяти"""
+        self._last_seen[user_id] = time.monotonic()
+        if user_id not in self._saved:
+            stored = await self.db.load_user_data(user_id) or {}
+            for key, value in stored.items():
+                user_data.setdefault(key, value)
+            self._saved[user_id] = self._dump(stored) or "{}"
+        self._maybe_evict()
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        """Поставить в запись, если данные изменились с последней записи"""
+        if user_id not in self._saved:
+            # Пользователь не загружался (обновление без refresh) — не затираем запись в БД
+            return
+        dumped = self._dump(data)
+        if dumped is not None and dumped != self._saved[user_id]:
+            self._saved[user_id] = dumped
+            self._dirty[user_id] = dumped
+        # Непустая очередь без задачи записи — в том числе после ошибки прошлой записи
+        if self._dirty and (self._write_task is None or self._write_task.done()):
+            self._write_task = asyncio.create_task(self._write_later())
+
+    async def _write_later(self) -> None:
+        await asyncio.sleep(WRITE_DELAY)
+        await self._write()
+
+    async def _write(self) -> None:
+        batch, self._dirty = self._dirty, {}
+        if not batch:
+            return
+        try:
+            await self.db.save_user_data(batch)
+        except Exception as e:
+            logger.error(f"Не удалось сохранить user_data ({len(batch)} польз.): {e}")
+            # Вернём в очередь, не перетирая более свежие изменения
+            for user_id, dumped in batch.items():
+                self._dirty.setdefault(user_id, dumped)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        if user_id in self._evicting:
+            # Выгрузка из памяти, а не удаление данных
+            self._evicting.discard(user_id)
+            return
+        self._saved.pop(user_id, None)
+        self._last_seen.pop(user_id, None)
+        self._dirty.pop(user_id, None)
+        await self.db.delete_user_data(user_id)
+
+    def _maybe_evict(self) -> None:
+        """Не чаще EVICT_INTERVAL: выгрузить пользователей без обновлений дольше IDLE_TTL"""
+        now = time.monotonic()
+        if self.application is None or now - self._last_evict < EVICT_INTERVAL:
+            return
+        self._last_evict = now
+        idle = [
+            uid for uid, seen in self._last_seen.items()
+            if now - seen > IDLE_TTL and uid not in self._dirty
+        ]
+        for user_id in idle:
+            del self._last_seen[user_id]
+            del self._saved[user_id]
+            self._evicting.add(user_id)
+            self.application.drop_user_data(user_id)
+        if idle:
+            logger.debug(f"user_data: выгружено из памяти — {len(idle)}")
+
+    async def flush(self) -> None:
+        """Остановка приложения: записать всё, что ещё не записано"""
+        if self._write_task:
+            await asyncio.gather(self._write_task, return_exceptions=True)
+        await self._write()
+
+    # chat_data, bot_data, callback_data и ConversationHandler не используются
+
+    async def get_chat_data(self) -> dict[int, dict]:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data: object) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
@@ -0,0 +1,231 @@
+"""Ограничение частоты запросов (token bucket) и приоритеты для исходящих вызовов Telegram API"""
+import asyncio
+import heapq
+import time
+from datetime import timedelta
+from typing import Any, Callable, Coroutine, Optional, Union
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+
+class TokenBucket:
+    """
+    Token bucket: не больше rate операций в секунду, всплеск до capacity.
+
+    Один экземпляр делится между всеми корутинами одного event loop.
+    pause() останавливает выдачу токенов (например, после RetryAfter от Telegram).
+    """
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = max(rate, 0.001)
+        self.capacity = max(capacity, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._updated
+        self._updated = now
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+
+    async def acquire(self) -> None:
+        """Дождаться токена (ожидающие обслуживаются по очереди)"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def try_acquire(self) -> bool:
+        """Взять токен без ожидания; False — лимит исчерпан"""
+        now = time.monotonic()
+        if now < self._paused_until:
+            return False
+        self._refill(now)
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def is_full(self) -> bool:
+        """Запас восстановлен полностью (бакет можно забыть без потери состояния)"""
+        now = time.monotonic()
+        if now < self._paused_until:
+            return False
+        self._refill(now)
+        return self._tokens >= self.capacity
+
+    def pause(self, seconds: float) -> None:
+        """Не выдавать токены seconds секунд и сбросить накопленный запас"""
+        until = time.monotonic() + seconds
+        if until > self._paused_until:
+            self._paused_until = until
+            self._tokens = 0.0
+            self._updated = until
+
+
+class KeyedRateLimiter:
+    """
+    Отдельный TokenBucket на каждый ключ (например, telegram_id) без ожидания:
+    allow() сразу отвечает, можно ли выполнить действие.
+
+    Полностью восстановленные бакеты удаляются при росте словаря выше max_keys —
+    память ограничена числом активных пользователей, а не всех когда-либо писавших.
+    """
+
+    def __init__(self, rate: float, capacity: float, max_keys: int = 10_000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self._buckets: dict[int, TokenBucket] = {}
+
+    def allow(self, key: int) -> bool:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_keys:
+                self._buckets = {k: b for k, b in self._buckets.items() if not b.is_full()}
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity)
+        return bucket.try_acquire()
+
+
+# Классы исходящего трафика Telegram: меньше — важнее
+INTERACTIVE = 0  # ответы на действия пользователей
+NOTIFY = 1  # уведомления об оплате, админам
+BULK = 2  # рассылки
+
+
+class PriorityScheduler:
+    """
+    Общий бюджет запросов к Telegram (глобальный лимит на токен бота) с приоритетами.
+
+    INTERACTIVE проходит без ожидания, но расходует токен — фоновые классы
+    подождут дольше. Остальные ждут в очереди по приоритету: освободившийся токен
+    получает самый важный ожидающий запрос, рассылка занимает только остаток бюджета.
+    """
+
+    def __init__(self, rate: float = 30.0):
+        self.rate = max(rate, 0.001)
+        # Запас не больше секунды бюджета: после паузы нельзя выплеснуть всё сразу
+        self.capacity = max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    def _refill(self, now: float) -> None:
+        if now < self._paused_until:
+            return
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, priority: int) -> None:
+        """Дождаться очереди на запрос класса priority"""
+        now = time.monotonic()
+        self._refill(now)
+        if priority <= INTERACTIVE:
+            # Может уйти в минус — долг отработают фоновые классы
+            self._tokens -= 1
+            return
+        if not self._waiters and self._tokens >= 1 and now >= self._paused_until:
+            self._tokens -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._waiters, (priority, self._seq, future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        self._wakeup.set()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Токен мог быть уже выдан — вернуть его
+            if future.done() and not future.cancelled():
+                self._tokens += 1
+            raise
+
+    async def _dispatch(self) -> None:
+        """Раздавать токены ожидающим по приоритету, пока очередь не опустеет"""
+        while self._waiters:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            if future.cancelled():
+                continue
+            self._tokens -= 1
+            future.set_result(None)
+        self._dispatcher = None
+
+    def pause(self, seconds: float) -> None:
+        """Не выдавать токены seconds секунд (RetryAfter от Telegram)"""
+        until = time.monotonic() + seconds
+        if until > self._paused_until:
+            self._paused_until = until
+            self._tokens = 0.0
+            self._updated = until
+
+    async def close(self) -> None:
+        """Остановить раздачу токенов и отменить ожидающих"""
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+        for _, _, future in self._waiters:
+            future.cancel()
+        self._waiters.clear()
+
+
+class PriorityRateLimiter(BaseRateLimiter[int]):
+    """
+    Ограничитель PTB для одного класса трафика поверх общего PriorityScheduler.
+
+    У каждого класса свой Bot со своим пулом соединений и свой экземпляр
+    ограничителя; бюджет запросов общий. RetryAfter приостанавливает весь бюджет.
+    """
+
+    def __init__(self, scheduler: PriorityScheduler, priority: int):
+        self.scheduler = scheduler
+        self.priority = priority
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Union[bool, dict[str, Any], list[dict[str, Any]]]]],
+        args: Any,
+        kwargs: dict[str, Any],
+        endpoint: str,
+        data: dict[str, Any],
+        rate_limit_args: Optional[int],
+    ) -> Union[bool, dict[str, Any], list[dict[str, Any]]]:
+        # rate_limit_args позволяет переопределить класс для отдельного вызова
+        priority = self.priority if rate_limit_args is None else rate_limit_args
+        await self.scheduler.acquire(priority)
+        try:
+            return await callback(*args, **kwargs)
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            self.scheduler.pause(
+                retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+            )
+            raise
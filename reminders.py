@@ -0,0 +1,86 @@
+"""Напоминания об окончании подписки: сканирование expires_at по индексу"""
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import metrics
+from bot_messages import BTN_CHOOSE_TARIFF, BTN_RENEW, EXPIRY_REMINDERS
+from config import Config
+from database import Database, Order, OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+# За сколько дней до окончания напоминать (0 — в день окончания, после истечения)
+REMINDER_DAYS = (3, 1, 0)
+PAGE_SIZE = 500
+# Формат datetime('now') в SQLite — в нём хранится expires_at
+_DB_TIME = "%Y-%m-%d %H:%M:%S"
+
+
+def _db_time(moment: datetime) -> str:
+    return moment.strftime(_DB_TIME)
+
+
+class ExpiryReminders:
+    """
+    Поиск подписок, заканчивающихся через 3, 1 и 0 дней, и постановка напоминаний в outbox.
+
+    Окно порога days — заказы с expires_at в (now + days - 1 день, now + days];
+    каждый проход читает окно целиком по индексу idx_orders_expiry, так что
+    попадают и заказы, чей срок изменился задним числом. Продления в Remnawave
+    переносятся в orders.expires_at (Database.set_order_expiry, отметки заказа
+    сбрасываются): реферальный бонус — сразу, правка в панели — при показе экрана
+    «Моя подписка». Отметка в expiry_reminders пишется в одной транзакции
+    с сообщением — повторный проход не отправит напоминание второй раз.
+    Отправка — через outbox с лимитом частоты уведомлений.
+    """
+
+    def __init__(self, db: Database, config: Config):
+        self.db = db
+        self.config = config
+
+    async def scan(self, now: Optional[datetime] = None) -> int:
+        """Один проход по всем порогам; возвращает число поставленных напоминаний"""
+        now = now or datetime.now(timezone.utc)
+        total = 0
+        for days in REMINDER_DAYS:
+            since = _db_time(now + timedelta(days=days - 1))
+            until = _db_time(now + timedelta(days=days))
+            total += await self._scan_window(days, since, until)
+        if total:
+            metrics.incr("reminders.queued", total)
+            logger.info(f"Напоминания об окончании подписки: поставлено в очередь — {total}")
+        return total
+
+    async def _scan_window(self, days: int, since: str, until: str) -> int:
+        queued = 0
+        after = ("", 0)
+        while True:
+            orders = await self.db.get_expiring_orders(days, since, until, after=after, limit=PAGE_SIZE)
+            if not orders:
+                return queued
+            queued += await self.db.record_expiry_reminders(
+                days, [(order.id, self._message(order, days)) for order in orders]
+            )
+            if len(orders) < PAGE_SIZE:
+                return queued
+            last = orders[-1]
+            after = (_db_time(last.expires_at), last.id)
+
+    def _message(self, order: Order, days: int) -> OutboxMessage:
+        text = EXPIRY_REMINDERS[days].format(
+            plan_name=order.plan_name,
+            date=order.expires_at.strftime("%d.%m.%Y"),
+        )
+        # Продление тем же тарифом в одно нажатие; тариф убран из config — список тарифов
+        if any(p.id == order.plan_id for p in self.config.plans):
+            button = InlineKeyboardButton(BTN_RENEW, callback_data=f"buy:{order.plan_id}")
+        else:
+            button = InlineKeyboardButton(BTN_CHOOSE_TARIFF, callback_data="back")
+        return OutboxMessage(
+            chat_id=order.telegram_id,
+            text=text,
+            reply_markup=InlineKeyboardMarkup([[button]]).to_dict(),
+        )
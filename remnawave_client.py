@@ -1,12 +1,15 @@
 """Клиент API Remnawave для управления пользователями VPN"""
 import json
 import logging
+import threading
 import time
 from datetime import datetime, timedelta, timezone
 from typing import Any, Callable, Optional, TypeVar
 
 import requests
+from requests.adapters import HTTPAdapter
 
+import metrics
 from config import PlanConfig, RemnawaveConfig
 
 logger = logging.getLogger(__name__)
@@ -71,25 +74,50 @@ class RemnawaveError(Exception):
 
 
 class RemnawaveClient:
-    """Клиент для работы с API Remnawave"""
+    """
+    Клиент для работы с API Remnawave.
 
-    def __init__(self, config: RemnawaveConfig):
+    Методы синхронные: из async-кода вызывать через asyncio.to_thread.
+    Соединения переиспользуются через общий requests.Session (keep-alive).
+    Клиент общий для потоков: логин и сброс токена — под _token_lock.
+    """
+
+    def __init__(self, config: RemnawaveConfig, pool_size: int = 10):
         self.base_url = config.api_url.rstrip("/")
         self.username = config.username
         self.password = config.password
         self.default_squad_uuid = config.squad_uuid
         self._token: Optional[str] = None
-
-    def _clear_token(self) -> None:
-        """Сбросить токен (для переавторизации при 401)"""
-        self._token = None
+        self._token_lock = threading.Lock()
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+    def close(self) -> None:
+        """Закрыть пул соединений"""
+        self._session.close()
+
+    def _clear_token(self, rejected: str) -> None:
+        """Сбросить токен, получивший 401 (если другой поток его ещё не обновил)"""
+        with self._token_lock:
+            if self._token == rejected:
+                self._token = None
 
     def _get_token(self) -> str:
-        """Получить JWT токен авторизации"""
-        if self._token:
+        """Получить JWT токен авторизации (логинится один поток, остальные ждут его токен)"""
+        token = self._token
+        if token:
+            return token
+        with self._token_lock:
+            if self._token:
+                return self._token
+            self._token = self._login()
             return self._token
-            
-        response = requests.post(
+
+    def _login(self) -> str:
+        """Запросить новый токен (вызывается под _token_lock)"""
+        response = self._session.post(
             f"{self.base_url}/api/auth/login",
             json={"username": self.username, "password": self.password},
             headers={"Content-Type": "application/json"},
@@ -106,11 +134,11 @@ class RemnawaveClient:
         data = _safe_json(response)
         if not data:
             raise RemnawaveError("Пустой ответ панели при логине", status_code=response.status_code, response=None)
-        self._token = data.get("accessToken") or data.get("access_token")
-        if not self._token:
+        token = data.get("accessToken") or data.get("access_token")
+        if not token:
             raise RemnawaveError("Токен не найден в ответе", response=data)
 
-        return self._token
+        return token
 
     def _request(
         self,
@@ -118,27 +146,30 @@ class RemnawaveClient:
         path: str,
         json_data: Optional[dict] = None,
         params: Optional[dict] = None,
+        relogin: bool = True,
     ) -> dict:
-        """Выполнить запрос к API (с retry и обновлением токена при 401)"""
+        """Выполнить запрос к API (при 401 — один повтор с новым токеном)"""
         url = f"{self.base_url}{path}"
+        token = self._get_token()
         headers = {
-            "Authorization": f"Bearer {self._get_token()}",
+            "Authorization": f"Bearer {token}",
             "Content-Type": "application/json",
         }
 
-        response = requests.request(
-            method=method,
-            url=url,
-            json=json_data,
-            params=params,
-            headers=headers,
-            timeout=30,
-        )
+        with metrics.timed("remnawave.request"):
+            response = self._session.request(
+                method=method,
+                url=url,
+                json=json_data,
+                params=params,
+                headers=headers,
+                timeout=30,
+            )
 
-        if response.status_code == 401:
-            self._clear_token()
+        if response.status_code == 401 and relogin:
+            self._clear_token(token)
             logger.info("Remnawave 401: токен сброшен, повторная авторизация")
-            return self._request(method, path, json_data, params)
+            return self._request(method, path, json_data, params, relogin=False)
 
         if response.status_code >= 400:
             raise RemnawaveError(
@@ -231,34 +262,35 @@ class RemnawaveClient:
                 return []
             raise
 
-    def extend_user_subscription(
-        self, user_uuid: str, additional_days: int
-    ) -> dict:
+    @staticmethod
+    def user_expiration(user: dict) -> Optional[datetime]:
+        """Окончание подписки из ответа API (UTC); None — не указано или не разобрано"""
+        user_obj = user.get("user", user) if isinstance(user, dict) else {}
+        value = (
+            user_obj.get("expireAt") or user_obj.get("expirationTime") or user_obj.get("expiration_time")
+        )
+        if not value or not isinstance(value, str):
+            return None
+        try:
+            moment = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            return None
+        return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+    def ensure_user_expiration(self, user_uuid: str, expires_at: datetime) -> datetime:
         """
-        Продлить подписку пользователя на N дней.
-        Используется для реферальных бонусов.
+        Довести окончание подписки до expires_at, не сокращая его. Повторный вызов с той же
+        датой ничего не меняет — безопасно для повторов фоновых задач. Возвращает окончание.
         """
-        from datetime import datetime, timedelta
-
         user = self._request("GET", f"/api/users/{user_uuid}")
-        user_obj = user.get("user", user) if isinstance(user, dict) else user
-
-        current_exp = user_obj.get("expirationTime") or user_obj.get("expiration_time")
-        if current_exp and isinstance(current_exp, str):
-            try:
-                exp_dt = datetime.fromisoformat(current_exp.replace("Z", "+00:00"))
-            except ValueError:
-                exp_dt = datetime.utcnow()
-        else:
-            exp_dt = datetime.utcnow()
-
-        new_exp = exp_dt + timedelta(days=additional_days)
-        new_exp_str = new_exp.strftime("%Y-%m-%dT%H:%M:%S.000Z")
-
-        return self._request("PATCH", "/api/users", json_data={
+        current = self.user_expiration(user)
+        if current and current >= expires_at:
+            return current
+        self._request("PATCH", "/api/users", json_data={
             "uuid": user_uuid,
-            "expirationTime": new_exp_str,
+            "expirationTime": expires_at.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z"),
         })
+        return expires_at
 
     def get_all_users(self, size: int = 500, start: int = 0) -> dict:
         """Получить список всех пользователей (с пагинацией)"""
@@ -312,26 +344,6 @@ class RemnawaveClient:
 
         return deleted
 
-    def extend_user_by_telegram_id(
-        self, telegram_id: int, additional_days: int
-    ) -> bool:
-        """
-        Продлить подписку пользователя по Telegram ID (для реферальных бонусов).
-        Возвращает True если успешно.
-        """
-        users = self.get_user_by_telegram_id(telegram_id)
-        if not users:
-            return False
-        user = users[0] if isinstance(users, list) else users
-        user_uuid = user.get("uuid") or user.get("id")
-        if not user_uuid:
-            return False
-        try:
-            self.extend_user_subscription(user_uuid, additional_days)
-            return True
-        except RemnawaveError:
-            return False
-
     def revoke_user_by_telegram_id(self, telegram_id: int) -> tuple[int, list[str]]:
         """
         Отозвать ключи пользователя по Telegram ID (удалить из Remnawave).
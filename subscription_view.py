@@ -0,0 +1,262 @@
+"""Экран «Моя подписка»: данные из заказов и Remnawave, готовый текст в кэше на пользователя"""
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Optional
+
+import metrics
+from bot_messages import (
+    NO_SUBSCRIPTION,
+    SUBSCRIPTION_DEVICES,
+    SUBSCRIPTION_EXPIRED_AT,
+    SUBSCRIPTION_EXPIRES,
+    SUBSCRIPTION_HEADER,
+    SUBSCRIPTION_LINK,
+    SUBSCRIPTION_LOAD_ERROR,
+    SUBSCRIPTION_NO_LINK,
+    SUBSCRIPTION_PANEL_UNAVAILABLE,
+    SUBSCRIPTION_PLAN,
+    SUBSCRIPTION_REVOKED,
+    SUBSCRIPTION_STATUS,
+    SUBSCRIPTION_STATUS_ACTIVE,
+    SUBSCRIPTION_STATUS_DISABLED,
+    SUBSCRIPTION_STATUS_EXPIRED,
+    SUBSCRIPTION_STATUS_LIMITED,
+    SUBSCRIPTION_STATUS_REVOKED,
+    SUBSCRIPTION_TRAFFIC,
+    SUBSCRIPTION_TRAFFIC_UNLIMITED,
+)
+from config import Config
+from database import Database, Order
+from remnawave_client import RemnawaveClient, RemnawaveError
+from utils import extract_short_uuid, get_subscription_url
+
+logger = logging.getLogger(__name__)
+
+# Сколько держать готовый экран, сек; без данных Remnawave — меньше, чтобы скорее показать полный
+VIEW_TTL = 60
+VIEW_DEGRADED_TTL = 10
+# Выше этого размера кэш при записи очищается от устаревших записей
+VIEW_CACHE_MAX = 50_000
+
+_PANEL_STATUSES = {
+    "ACTIVE": SUBSCRIPTION_STATUS_ACTIVE,
+    "EXPIRED": SUBSCRIPTION_STATUS_EXPIRED,
+    "LIMITED": SUBSCRIPTION_STATUS_LIMITED,
+    "DISABLED": SUBSCRIPTION_STATUS_DISABLED,
+}
+
+
+@dataclass(frozen=True)
+class SubscriptionView:
+    """Готовый текст экрана (Markdown); has_subscription=False — предложить тарифы"""
+    text: str
+    has_subscription: bool
+
+
+def _parse_time(value: object) -> Optional[datetime]:
+    if not value or not isinstance(value, str):
+        return None
+    try:
+        moment = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+
+def _utc(moment: datetime) -> datetime:
+    """Время из БД (UTC без зоны) — с зоной, для сравнения с данными Remnawave"""
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+
+def _format_bytes(value: int) -> str:
+    gb = value / 1024 ** 3
+    return f"{gb:.1f} ГБ" if gb < 100 else f"{gb:.0f} ГБ"
+
+
+def _panel_fields(rw_user: dict) -> dict:
+    """Поля пользователя Remnawave (имена разных версий API)"""
+    user = rw_user.get("user", rw_user)
+    traffic = user.get("userTraffic") or {}
+    return {
+        "expires_at": _parse_time(
+            user.get("expireAt") or user.get("expirationTime") or user.get("expiration_time")
+        ),
+        "status": user.get("status"),
+        "traffic_limit": user.get("trafficLimitBytes", user.get("dataLimit")),
+        "traffic_used": user.get("usedTrafficBytes", traffic.get("usedTrafficBytes")),
+        "device_limit": user.get("hwidDeviceLimit"),
+        "short_uuid": extract_short_uuid(rw_user),
+    }
+
+
+class SubscriptionViews:
+    """
+    Сборка экрана подписки: кэш → заказы в БД (зеркало панели) → Remnawave.
+
+    Готовый текст хранится VIEW_TTL секунд, так что повторные открытия экрана
+    отвечают из памяти. Промах кэша — один последний оплаченный заказ из БД и
+    пользователь Remnawave, запрошенные параллельно. Remnawave даёт окончание,
+    трафик и лимит устройств; если панель недоступна, экран строится по заказу.
+    Панель запрашивается на каждом промахе, а не только за трафиком: лишь она
+    знает, что ключ заказа удалён (экран «ссылка отозвана» вместо «активна»).
+    «Нет подписки», отозванная ссылка и ошибки не кэшируются — оплативший
+    только что увидит подписку сразу.
+    """
+
+    def __init__(self, db: Database, remnawave: RemnawaveClient, config: Config):
+        self.db = db
+        self.remnawave = remnawave
+        self.config = config
+        # user_id -> (экран, истекает в monotonic)
+        self._cache: dict[int, tuple[SubscriptionView, float]] = {}
+
+    def cached(self, user_id: int) -> Optional[SubscriptionView]:
+        """Экран из кэша, если ещё не устарел"""
+        entry = self._cache.get(user_id)
+        if entry and entry[1] > time.monotonic():
+            metrics.incr("subscription_view.cache_hit")
+            return entry[0]
+        return None
+
+    def invalidate(self, user_id: int) -> None:
+        """Подписка изменилась (оплата, trial, бонус) — следующий показ соберёт экран заново"""
+        self._cache.pop(user_id, None)
+
+    async def extended(self, user_id: int, expires_at: datetime) -> None:
+        """Подписка продлена в Remnawave: окончание — в последний заказ (по нему напоминания)"""
+        order = await self.db.get_latest_subscription_order(user_id)
+        if order and (order.expires_at is None or _utc(order.expires_at) < expires_at):
+            await self.db.set_order_expiry(order.id, expires_at)
+        self.invalidate(user_id)
+
+    async def get(self, user_id: int) -> SubscriptionView:
+        """Экран подписки: из кэша или собранный заново"""
+        view = self.cached(user_id)
+        if view:
+            return view
+        metrics.incr("subscription_view.fetch")
+        order, panel_users = await asyncio.gather(
+            self.db.get_latest_subscription_order(user_id),
+            self._panel_users(user_id),
+        )
+        panel = None if panel_users is None else self._match_panel_user(order, panel_users)
+        if order and panel:
+            await self._sync_order_expiry(order, panel)
+        if panel is None and order is None:
+            return SubscriptionView(SUBSCRIPTION_LOAD_ERROR, has_subscription=False)
+        if not panel and order is None:
+            return SubscriptionView(NO_SUBSCRIPTION, has_subscription=False)
+        if panel == {}:
+            # Ключа заказа нет в панели — пользователь удалён, ссылка не работает
+            metrics.incr("subscription_view.revoked")
+            return SubscriptionView(self._render_revoked(order), has_subscription=False)
+
+        view = SubscriptionView(
+            self._render(order, panel or {}, panel_failed=panel is None), has_subscription=True
+        )
+        self._store(user_id, view, VIEW_DEGRADED_TTL if panel is None else VIEW_TTL)
+        return view
+
+    async def _panel_users(self, user_id: int) -> Optional[list[dict]]:
+        """Пользователи Remnawave с этим telegram_id; None — ошибка панели"""
+        try:
+            users = await asyncio.to_thread(self.remnawave.get_user_by_telegram_id, user_id)
+        except RemnawaveError as e:
+            logger.error(f"Ошибка Remnawave: {e}")
+            return None
+        return [_panel_fields(u) for u in users or [] if isinstance(u, dict)]
+
+    @staticmethod
+    def _match_panel_user(order: Optional[Order], users: list[dict]) -> dict:
+        """
+        Пользователь панели того же заказа (по short_uuid), чтобы тариф, срок и ссылка
+        были от одной подписки; иначе — с самым поздним окончанием. {} — у пользователя
+        нет ни одной записи в панели (ключ заказа удалён или отозван).
+        """
+        if order and order.short_uuid:
+            for user in users:
+                if user["short_uuid"] == order.short_uuid:
+                    return user
+        if not users:
+            return {}
+        oldest = datetime.min.replace(tzinfo=timezone.utc)
+        return max(users, key=lambda u: u["expires_at"] or oldest)
+
+    async def _sync_order_expiry(self, order: Order, panel: dict) -> None:
+        """Срок, изменённый в панели (админом), — в заказ, чтобы напоминания шли к нему"""
+        expires_at = panel.get("expires_at")
+        if panel.get("short_uuid") != order.short_uuid or expires_at is None:
+            return
+        if order.expires_at is None or abs((_utc(order.expires_at) - expires_at).total_seconds()) >= 1:
+            await self.db.set_order_expiry(order.id, expires_at)
+
+    def _store(self, user_id: int, view: SubscriptionView, ttl: float) -> None:
+        now = time.monotonic()
+        if len(self._cache) >= VIEW_CACHE_MAX:
+            self._cache = {uid: entry for uid, entry in self._cache.items() if entry[1] > now}
+        self._cache[user_id] = (view, now + ttl)
+
+    @staticmethod
+    def _render_revoked(order: Order) -> str:
+        """Текст экрана для заказа, чьего ключа уже нет в панели: без срока и ссылки"""
+        return "\n".join([
+            SUBSCRIPTION_HEADER,
+            "",
+            SUBSCRIPTION_PLAN.format(plan_name=order.plan_name),
+            SUBSCRIPTION_STATUS.format(status=SUBSCRIPTION_STATUS_REVOKED),
+            "",
+            SUBSCRIPTION_REVOKED,
+        ])
+
+    def _render(self, order: Optional[Order], panel: dict, panel_failed: bool) -> str:
+        """Текст экрана; данные панели важнее данных заказа"""
+        now = datetime.now(timezone.utc)
+        expires_at = panel.get("expires_at")
+        if expires_at is None and order and order.expires_at:
+            expires_at = _utc(order.expires_at)
+
+        status = _PANEL_STATUSES.get(panel.get("status") or "")
+        if status is None and expires_at:
+            status = SUBSCRIPTION_STATUS_ACTIVE if expires_at > now else SUBSCRIPTION_STATUS_EXPIRED
+
+        lines = [SUBSCRIPTION_HEADER, ""]
+        # Тариф заказа — только если панель показывает ту же подписку
+        if order and panel.get("short_uuid") in (None, order.short_uuid):
+            lines.append(SUBSCRIPTION_PLAN.format(plan_name=order.plan_name))
+        if status:
+            lines.append(SUBSCRIPTION_STATUS.format(status=status))
+        if expires_at:
+            date = expires_at.strftime("%d.%m.%Y")
+            if expires_at > now:
+                lines.append(SUBSCRIPTION_EXPIRES.format(date=date, days=(expires_at - now).days))
+            else:
+                lines.append(SUBSCRIPTION_EXPIRED_AT.format(date=date))
+
+        limit, used = panel.get("traffic_limit"), panel.get("traffic_used")
+        if used is not None:
+            if limit:
+                left = max(int(limit) - int(used), 0)
+                lines.append(SUBSCRIPTION_TRAFFIC.format(
+                    left=_format_bytes(left), limit=_format_bytes(int(limit))
+                ))
+            else:
+                lines.append(SUBSCRIPTION_TRAFFIC_UNLIMITED.format(used=_format_bytes(int(used))))
+        if panel.get("device_limit"):
+            lines.append(SUBSCRIPTION_DEVICES.format(count=panel["device_limit"]))
+
+        short_uuid = panel.get("short_uuid") or (order.short_uuid if order else None)
+        lines.append("")
+        if short_uuid:
+            subscription_url = get_subscription_url(
+                short_uuid, self.config.remnawave.subscription_base_url
+            )
+            lines.append(SUBSCRIPTION_LINK.format(subscription_url=subscription_url))
+        else:
+            lines.append(SUBSCRIPTION_NO_LINK)
+        if panel_failed:
+            lines.append("")
+            lines.append(SUBSCRIPTION_PANEL_UNAVAILABLE)
+        return "\n".join(lines)
@@ -0,0 +1,98 @@
+"""Параллельная обработка обновлений Telegram с сохранением порядка для каждого пользователя"""
+import asyncio
+import inspect
+import logging
+from typing import Any, Awaitable, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Семафор базового класса берётся до блокировки пользователя; делаем его заведомо
+# большим, чтобы обновления, ждущие свою очередь, не занимали слоты обработки
+_QUEUE_BOUND = 10_000
+# Сколько обновлений одного пользователя может ждать очереди; сверх — отбрасываются (флуд)
+MAX_QUEUED_PER_USER = 20
+
+
+def _update_key(update: object) -> Optional[int]:
+    """Чьё обновление: пользователь, иначе чат; None — порядок не важен"""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Обновления разных пользователей обрабатываются параллельно (до concurrency
+    одновременно), обновления одного пользователя — строго по очереди.
+
+    Порядок держится на asyncio.Lock пользователя: задачи PTB создаются в порядке
+    поступления, а Lock отдаёт владение ожидающим в порядке FIFO. Поэтому
+    пошаговые сценарии (рассылка, покупка) видят обновления так же, как при
+    последовательной обработке, а медленный запрос к Yookassa или Remnawave
+    задерживает только своего пользователя.
+
+    Очередь пользователя ограничена MAX_QUEUED_PER_USER: флуд одного скрипта
+    отбрасывается и не растёт в памяти. Сигнал перегрузки (active) считает только
+    обновления, занявшие слот или ждущие его, — не больше одного на пользователя,
+    так что очередь одного пользователя не выдаёт себя за общую нагрузку.
+    """
+
+    def __init__(self, concurrency: int):
+        super().__init__(_QUEUE_BOUND)
+        self.concurrency = max(concurrency, 1)
+        self._slots = asyncio.Semaphore(self.concurrency)
+        # user_id -> [Lock, сколько обновлений ждёт или обрабатывается]
+        self._locks: dict[int, list[Any]] = {}
+        self._active = 0
+
+    @property
+    def active(self) -> int:
+        """Обновления в слоте обработки или ждущие слот (очереди пользователей не считаются)"""
+        return self._active
+
+    async def _run(self, coroutine: Awaitable[Any]) -> None:
+        self._active += 1
+        try:
+            async with self._slots:
+                await coroutine
+        finally:
+            self._active -= 1
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = _update_key(update)
+        if key is None:
+            await self._run(coroutine)
+            return
+
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        elif entry[1] >= MAX_QUEUED_PER_USER:
+            metrics.incr("updates.dropped")
+            logger.debug(f"Очередь обновлений {key} переполнена — обновление отброшено")
+            if inspect.iscoroutine(coroutine):
+                coroutine.close()
+            return
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._run(coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
@@ -1,37 +1,161 @@
 """Webhook сервер для приёма уведомлений Yookassa"""
 import asyncio
+import hashlib
+import hmac
 import logging
 import uuid
-from typing import Optional
+from contextlib import asynccontextmanager
+from dataclasses import replace
+from typing import AsyncIterator, Callable, Optional
 
 import uvicorn
-from fastapi import FastAPI, Request, Response
+from fastapi import APIRouter, FastAPI, Request, Response
 from fastapi.responses import HTMLResponse
-from telegram import Bot
+from telegram import Bot, Update
+from telegram.ext import Application
 
+import metrics
 from config import Config
-from database import Database
+from database import Database, Job, OutboxMessage
+from jobs import DeadJobHandler, JobHandler, JobWorkerPool
+from outbox import OutboxDispatcher
+from payments import PaymentService
 from remnawave_client import RemnawaveClient, RemnawaveError
 from utils import extract_short_uuid, get_subscription_url
+from yookassa_client import YookassaClient
 
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="VPN Bot Webhook")
-
 # Глобальные объекты (инициализируются в main)
 config: Optional[Config] = None
 db: Optional[Database] = None
 remnawave: Optional[RemnawaveClient] = None
 telegram_bot: Optional[Bot] = None
+payments: Optional[PaymentService] = None
+job_pool: Optional[JobWorkerPool] = None
+outbox: Optional[OutboxDispatcher] = None
+# Приложение бота и его event loop — для обновлений Telegram в режиме webhook
+telegram_application: Optional[Application] = None
+telegram_loop: Optional[asyncio.AbstractEventLoop] = None
+
+# Тип задачи очереди: активация оплаченного заказа
+PAYMENT_JOB = "payment.succeeded"
+# Обработчики других типов задач (регистрирует процесс бота до start_background)
+extra_job_handlers: dict[str, JobHandler] = {}
+extra_dead_handlers: dict[str, DeadJobHandler] = {}
+
+
+# Вызываются с telegram_id после активации оплаченного заказа (сброс кэшей процесса бота)
+subscription_listeners: list[Callable[[int], None]] = []
+
+
+def register_job_handler(
+    kind: str, handler: JobHandler, on_dead: Optional[DeadJobHandler] = None
+) -> None:
+    """Добавить обработчик задач kind в пул очереди задач (on_dead — после последней попытки)"""
+    extra_job_handlers[kind] = handler
+    if on_dead:
+        extra_dead_handlers[kind] = on_dead
+
+
+def register_subscription_listener(listener: Callable[[int], None]) -> None:
+    """Подписаться на активацию подписки пользователя"""
+    subscription_listeners.append(listener)
 
 
-@app.post("/webhook/yookassa")
+async def _reconcile_loop() -> None:
+    """Периодическая сверка неоплаченных заказов с Yookassa (если webhook не дошёл)"""
+    while True:
+        await asyncio.sleep(config.payment_reconcile_interval)
+        try:
+            result = await payments.reconcile_pending(enqueue_payment)
+            if result["succeeded"] or result["canceled"]:
+                logger.info(
+                    "Сверка платежей: проверено %s, оплачено %s, отменено %s",
+                    result["checked"], result["succeeded"], result["canceled"],
+                )
+        except Exception as e:
+            logger.exception(f"Ошибка сверки платежей: {e}")
+
+
+# Период очистки зависших неоплаченных заказов
+SWEEP_INTERVAL_SECONDS = 3600
+
+
+async def _sweep_loop() -> None:
+    """Периодически помечать expired неоплаченные заказы старше PENDING_ORDER_EXPIRE_HOURS"""
+    while True:
+        try:
+            swept = await db.expire_stale_pending_orders(config.pending_order_expire_hours)
+            metrics.incr("orders.expired", swept)
+            metrics.gauge("sweeper.last_swept", swept)
+            if swept:
+                logger.info(f"Очистка заказов: помечено expired — {swept}")
+        except Exception as e:
+            logger.exception(f"Ошибка очистки неоплаченных заказов: {e}")
+        await asyncio.sleep(SWEEP_INTERVAL_SECONDS)
+
+
+async def start_background() -> list[asyncio.Task]:
+    """Запустить очередь задач, outbox и периодические задачи (сверка платежей, очистка заказов)"""
+    global job_pool, outbox
+    tasks: list[asyncio.Task] = []
+    if db and config:
+        stale = await db.reset_stale_activations()
+        if stale:
+            logger.warning(f"Заказов, прерванных во время активации: {stale} — будут активированы повторно")
+        job_pool = JobWorkerPool(
+            db,
+            {PAYMENT_JOB: _payment_job, **extra_job_handlers},
+            workers=config.job_workers,
+            dead_handlers={PAYMENT_JOB: _payment_dead, **extra_dead_handlers},
+        )
+        await job_pool.start()
+    if db and telegram_bot:
+        outbox = OutboxDispatcher(db, telegram_bot)
+        await outbox.start()
+    if payments and config and config.payment_reconcile_interval > 0:
+        tasks.append(asyncio.create_task(_reconcile_loop()))
+    if db and config and config.pending_order_expire_hours > 0:
+        tasks.append(asyncio.create_task(_sweep_loop()))
+    return tasks
+
+
+async def stop_background(tasks: list[asyncio.Task]) -> None:
+    """Остановить задачи, запущенные start_background"""
+    global job_pool, outbox
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if job_pool:
+        await job_pool.stop()
+        job_pool = None
+    if outbox:
+        await outbox.stop()
+        outbox = None
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI) -> AsyncIterator[None]:
+    """Фоновые задачи webhook-сервера (в процессе бота)"""
+    tasks = await start_background()
+    yield
+    await stop_background(tasks)
+
+
+router = APIRouter()
+
+
+@router.post("/webhook/yookassa")
 async def yookassa_webhook(request: Request) -> Response:
     """
     Webhook для приёма уведомлений от Yookassa о статусе платежа.
 
     В личном кабинете Yookassa нужно указать URL:
     https://your-domain.com/webhook/yookassa
+
+    Успешный платёж только записывается в очередь jobs, ответ 200 уходит сразу;
+    активацию выполняют фоновые обработчики (см. _payment_job).
     """
     try:
         body = await request.json()
@@ -53,32 +177,140 @@ async def yookassa_webhook(request: Request) -> Response:
 
     if status != "succeeded":
         # Для отменённых/неуспешных платежей просто логируем
-        if status in ("canceled", "pending"):
-            return Response(status_code=200)
         return Response(status_code=200)
 
-    # Обрабатываем успешный платёж
-    await process_successful_payment(payment_id, metadata)
+    if not db:
+        logger.error("БД не инициализирована")
+        return Response(status_code=503)
 
+    if not await enqueue_payment(payment_id, metadata):
+        logger.info(f"Повторное уведомление Yookassa отклонено: payment_id={payment_id}")
     return Response(status_code=200)
 
 
-async def process_successful_payment(payment_id: str, metadata: dict) -> None:
+TELEGRAM_WEBHOOK_PATH = "/webhook/telegram"
+
+
+def _derive_secret(cfg: Config, purpose: str) -> str:
+    """Стабильный секрет из токена бота (не меняется между перезапусками)"""
+    return hashlib.sha256(f"{purpose}:{cfg.bot_token}".encode()).hexdigest()
+
+
+def telegram_webhook_secret(cfg: Config) -> str:
+    """Значение заголовка X-Telegram-Bot-Api-Secret-Token"""
+    return cfg.telegram_webhook_secret or _derive_secret(cfg, "secret")
+
+
+def _telegram_path_token(cfg: Config) -> str:
+    """Секретная часть пути webhook Telegram"""
+    return _derive_secret(cfg, "path")[:32]
+
+
+def telegram_webhook_url(cfg: Config) -> str:
+    """URL для setWebhook: путь содержит секрет, чтобы его нельзя было угадать"""
+    return f"{cfg.webhook_base_url.rstrip('/')}{TELEGRAM_WEBHOOK_PATH}/{_telegram_path_token(cfg)}"
+
+
+def attach_telegram_application(
+    application: Optional[Application],
+    loop: Optional[asyncio.AbstractEventLoop] = None,
+) -> None:
+    """Подключить приложение бота к маршруту webhook (None — отключить)"""
+    global telegram_application, telegram_loop
+    telegram_application = application
+    telegram_loop = loop if application else None
+
+
+def _put_telegram_update(data: dict) -> None:
+    """Выполняется в event loop бота: передать обновление в очередь PTB"""
+    if not telegram_application:
+        return
+    try:
+        update = Update.de_json(data, telegram_application.bot)
+    except Exception as e:
+        logger.error(f"Некорректное обновление Telegram: {e}")
+        return
+    telegram_application.update_queue.put_nowait(update)
+
+
+@router.post(TELEGRAM_WEBHOOK_PATH + "/{path_token}")
+async def telegram_webhook(path_token: str, request: Request) -> Response:
+    """
+    Обновления Telegram (TELEGRAM_WEBHOOK_ENABLED=true).
+
+    URL регистрируется ботом при запуске через setWebhook; запрос принимается
+    только с верным путём и заголовком X-Telegram-Bot-Api-Secret-Token.
+    Обработка идёт в приложении бота, ответ 200 отдаётся сразу.
+    """
+    if not config or not config.telegram_webhook_enabled:
+        return Response(status_code=404)
+    if not hmac.compare_digest(path_token, _telegram_path_token(config)):
+        return Response(status_code=404)
+    header = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(header, telegram_webhook_secret(config)):
+        logger.warning("Webhook Telegram: неверный секрет")
+        return Response(status_code=403)
+
+    if not telegram_application or not telegram_loop:
+        # Бот ещё запускается — Telegram повторит доставку
+        return Response(status_code=503)
+
+    try:
+        data = await request.json()
+    except Exception:
+        return Response(status_code=400)
+
+    # Очередь PTB живёт в event loop бота (другой поток)
+    telegram_loop.call_soon_threadsafe(_put_telegram_update, data)
+    return Response(status_code=200)
+
+
+def _payment_event_id(payment_id: str) -> str:
+    """Ключ дедупликации события «платёж оплачен»"""
+    return f"{PAYMENT_JOB}:{payment_id}"
+
+
+async def enqueue_payment(payment_id: str, metadata: dict) -> bool:
+    """
+    Поставить активацию оплаченного заказа в очередь (webhook и сверка).
+    False — событие уже принято ранее (повторная доставка), задача не создана.
+    """
+    payload = {"payment_id": payment_id, "metadata": metadata}
+    job_id = await enqueue_job(PAYMENT_JOB, payload, event_id=_payment_event_id(payment_id))
+    return job_id is not None
+
+
+async def enqueue_job(kind: str, payload: dict, event_id: Optional[str] = None) -> Optional[int]:
+    """Поставить задачу в очередь и разбудить обработчики пула (None — событие уже было)"""
+    if job_pool:
+        return await job_pool.enqueue(kind, payload, event_id=event_id)
+    # Процесс-воркер uvicorn: задачу выполнит пул основного процесса (общая БД)
+    return await db.enqueue_job(kind, payload, event_id=event_id)
+
+
+async def _payment_job(job: Job, last_attempt: bool) -> None:
+    """Задача очереди: активировать оплаченный заказ"""
+    await activate_payment(job.payload["payment_id"], job.payload.get("metadata") or {})
+
+
+async def _payment_dead(job: Job, error: Exception) -> None:
+    """Активация не удалась за все попытки (в том числе по таймауту) — уведомить клиента"""
+    await _handle_activation_failure(
+        job.payload["payment_id"], job.payload.get("metadata") or {}, error
+    )
+
+
+async def activate_payment(payment_id: str, metadata: dict) -> None:
     """
     Обработать успешный платёж:
     1. Создать пользователя в Remnawave
-    2. Сохранить заказ в БД
-    3. Отправить подписку пользователю в Telegram
+    2. Сохранить заказ в БД вместе с сообщениями для outbox (одна транзакция)
+    3. Разбудить outbox — подписку пользователю и уведомления админам отправит OutboxDispatcher
+
+    Ошибки Remnawave/БД пробрасываются — вызывающий решает, повторять ли попытку.
     """
     if not db or not remnawave or not config:
-        logger.error("Сервисы не инициализированы")
-        return
-
-    # Проверяем, не обработан ли уже платёж
-    order = await db.get_order_by_payment(payment_id)
-    if order and order.status == "succeeded":
-        logger.info(f"Платёж {payment_id} уже обработан")
-        return
+        raise RuntimeError("Сервисы не инициализированы")
 
     telegram_id = metadata.get("telegram_id")
     plan_id = metadata.get("plan_id")
@@ -97,40 +329,69 @@ async def process_successful_payment(payment_id: str, metadata: dict) -> None:
         logger.error(f"Тариф {plan_id} не найден")
         return
 
+    # Имя покупателя для уведомления админам — до захвата заказа: таймаут или отмена
+    # здесь не оставят заказ в activating; записывается в outbox вместе с заказом
+    user_display_name = "—"
+    if telegram_bot and config.admin_ids:
+        user_display_name = await _get_user_display_name(telegram_bot, telegram_id)
+
+    # Захват заказа: pending/failed -> activating. Параллельная повторная доставка сюда не пройдёт.
+    if not await db.claim_order_for_activation(
+        payment_id, telegram_id, plan.id, plan.name, plan.price
+    ):
+        logger.info(f"Платёж {payment_id} уже обработан или обрабатывается")
+        return
+
     # Генерируем уникальный username
     username = f"tg_{telegram_id}_{payment_id[:8]}"
 
     try:
-        # Создаём пользователя в Remnawave
-        user_data = remnawave.create_user(
-            username=username,
-            plan=plan,
-            telegram_id=telegram_id,
-        )
-
+        user_data = await _create_remnawave_user(username, plan, telegram_id)
         short_uuid = extract_short_uuid(user_data)
-
         if not short_uuid:
-            logger.error(f"Short UUID не найден в ответе Remnawave: {user_data}")
-            return
+            # Повтор, а после последней попытки — _handle_activation_failure с уведомлением клиенту
+            raise RemnawaveError(f"Short UUID не найден в ответе Remnawave: {user_data}")
+
+        # Формируем URL подписки
+        subscription_url = get_subscription_url(
+            short_uuid, config.remnawave.subscription_base_url
+        )
+        notifications = [
+            OutboxMessage(telegram_id, _subscription_message(plan, subscription_url), "Markdown"),
+            *_admin_purchase_messages(
+                payment_id=payment_id,
+                plan_name=plan.name,
+                amount=plan.price,
+                telegram_id=telegram_id,
+                user_display_name=user_display_name,
+            ),
+        ]
 
-        # Обновляем заказ в БД
+        # Обновляем заказ в БД; сообщения фиксируются в той же транзакции
         await db.update_order_success(
             payment_id=payment_id,
             username=username,
             short_uuid=short_uuid,
+            duration_days=plan.duration_days,
+            notifications=notifications,
         )
+    except BaseException:
+        # Ошибка или таймаут задачи: освобождаем заказ, чтобы следующая попытка смогла его захватить
+        await db.update_order_status(payment_id, "failed")
+        raise
 
-        # Реферальный бонус начисляется при переходе по ссылке (см. bot.py start)
+    for listener in subscription_listeners:
+        listener(telegram_id)
+
+    # Реферальный бонус начисляется при переходе по ссылке (см. bot.py start)
+    logger.info(f"Подписка для {telegram_id} поставлена в outbox (payment_id={payment_id})")
+    if outbox:
+        outbox.wake()
 
-        # Формируем URL подписки
-        subscription_url = get_subscription_url(
-            short_uuid, config.remnawave.subscription_base_url
-        )
 
-        # Отправляем сообщение пользователю в Telegram
-        if telegram_bot:
-            message_text = f"""
+def _subscription_message(plan, subscription_url: str) -> str:
+    """Сообщение пользователю с активированной подпиской"""
+    return f"""
 ✅ *Оплата прошла успешно!*
 
 Ваша VPN подписка активирована.
@@ -148,47 +409,58 @@ async def process_successful_payment(payment_id: str, metadata: dict) -> None:
 
 Приятного использования! 🚀
 """
-            try:
-                await telegram_bot.send_message(
-                    chat_id=telegram_id,
-                    text=message_text,
-                    parse_mode="Markdown",
-                )
-                logger.info(f"Подписка отправлена пользователю {telegram_id}")
-            except Exception as e:
-                logger.error(f"Ошибка отправки в Telegram: {e}")
-
-        # Уведомление админам о покупке
-        if telegram_bot and config.admin_ids:
-            user_display_name = await _get_user_display_name(telegram_bot, telegram_id)
-            await _notify_admins_purchase(
-                payment_id=payment_id,
-                plan_name=plan.name,
-                amount=plan.price,
-                telegram_id=telegram_id,
-                user_display_name=user_display_name,
-            )
 
+
+async def _create_remnawave_user(username: str, plan, telegram_id: int) -> dict:
+    """
+    Создать пользователя в Remnawave (синхронный клиент — в отдельном потоке).
+    Если пользователь уже создан прошлой попыткой (username детерминирован) — вернуть его.
+    """
+    try:
+        return await asyncio.to_thread(
+            remnawave.create_user,
+            username=username,
+            plan=plan,
+            telegram_id=telegram_id,
+        )
     except RemnawaveError as e:
-        error_id = f"ERR-{uuid.uuid4().hex[:8].upper()}"
+        if e.status_code not in (400, 409):
+            raise
+        existing = await asyncio.to_thread(remnawave.get_user_by_username, username)
+        if not existing:
+            raise
+        logger.info(f"Пользователь {username} уже создан прошлой попыткой — используем его")
+        return existing
+
+
+async def _handle_activation_failure(payment_id: str, metadata: dict, error: Exception) -> None:
+    """Окончательная ошибка активации: статус failed и номер обращения клиенту"""
+    error_id = f"ERR-{uuid.uuid4().hex[:8].upper()}"
+    telegram_id = metadata.get("telegram_id")
+    plan_id = metadata.get("plan_id")
+    plan = next((p for p in config.plans if p.id == plan_id), None) if config else None
+    plan_name = plan.name if plan else str(plan_id)
+    if isinstance(error, RemnawaveError):
         logger.error(
             "[%s] Ошибка активации подписки (Remnawave): payment_id=%s, telegram_id=%s, plan=%s, error=%s",
-            error_id, payment_id, telegram_id, plan.name, e,
+            error_id, payment_id, telegram_id, plan_name, error,
         )
-        order_again = await db.get_order_by_payment(payment_id)
-        if not order_again or order_again.status != "succeeded":
-            await db.update_order_status(payment_id, "failed")
-            await _notify_payment_failure(telegram_id, plan.name, str(e), error_id)
-    except Exception as e:
-        error_id = f"ERR-{uuid.uuid4().hex[:8].upper()}"
-        logger.exception(
+    else:
+        logger.error(
             "[%s] Ошибка активации подписки: payment_id=%s, telegram_id=%s, plan=%s, error=%s",
-            error_id, payment_id, telegram_id, plan.name, e,
+            error_id, payment_id, telegram_id, plan_name, error, exc_info=error,
         )
-        order_again = await db.get_order_by_payment(payment_id)
-        if not order_again or order_again.status != "succeeded":
-            await db.update_order_status(payment_id, "failed")
-            await _notify_payment_failure(telegram_id, plan.name, str(e), error_id)
+    if not db:
+        return
+    # Повторная доставка webhook после исправления проблемы снова запустит активацию
+    await db.forget_event(_payment_event_id(payment_id))
+    order_again = await db.get_order_by_payment(payment_id)
+    if not order_again or order_again.status != "succeeded":
+        await db.update_order_status(payment_id, "failed")
+        try:
+            await _notify_payment_failure(int(telegram_id), plan_name, str(error), error_id)
+        except (TypeError, ValueError):
+            pass
 
 
 async def _get_user_display_name(bot: Bot, telegram_id: int) -> str:
@@ -208,16 +480,16 @@ async def _get_user_display_name(bot: Bot, telegram_id: int) -> str:
         return "—"
 
 
-async def _notify_admins_purchase(
+def _admin_purchase_messages(
     payment_id: str,
     plan_name: str,
     amount: float,
     telegram_id: int,
     user_display_name: str,
-) -> None:
-    """Отправить админам уведомление о новой покупке."""
-    if not telegram_bot or not config or not config.admin_ids:
-        return
+) -> list[OutboxMessage]:
+    """Уведомления админам о новой покупке (для outbox)."""
+    if not config or not config.admin_ids:
+        return []
     text = (
         "🛒 *Новая покупка*\n\n"
         f"*ID платежа:* `{payment_id}`\n"
@@ -226,39 +498,31 @@ async def _notify_admins_purchase(
         f"*Пользователь:* {user_display_name}\n"
         f"*Telegram ID:* `{telegram_id}`"
     )
-    for admin_id in config.admin_ids:
-        try:
-            await telegram_bot.send_message(
-                chat_id=admin_id,
-                text=text,
-                parse_mode="Markdown",
-            )
-        except Exception as e:
-            logger.warning(f"Не удалось отправить админу {admin_id} уведомление о покупке: {e}")
+    return [OutboxMessage(admin_id, text, "Markdown") for admin_id in config.admin_ids]
 
 
 async def _notify_payment_failure(
     telegram_id: int, plan_name: str, error_msg: str, error_id: str
 ) -> None:
     """Уведомить пользователя об ошибке обработки платежа (error_id показывается клиенту для обращения в поддержку)."""
-    if not telegram_bot:
+    if not db:
         return
+    text = (
+        "❌ *Оплата получена, но возникла ошибка при активации подписки.*\n\n"
+        f"Тариф: {plan_name}\n\n"
+        f"*Номер обращения:* `{error_id}`\n\n"
+        "Обратитесь в поддержку и укажите этот номер — мы исправим ситуацию в ближайшее время."
+    )
     try:
-        await telegram_bot.send_message(
-            chat_id=telegram_id,
-            text=(
-                "❌ *Оплата получена, но возникла ошибка при активации подписки.*\n\n"
-                f"Тариф: {plan_name}\n\n"
-                f"*Номер обращения:* `{error_id}`\n\n"
-                "Обратитесь в поддержку и укажите этот номер — мы исправим ситуацию в ближайшее время."
-            ),
-            parse_mode="Markdown",
-        )
+        await db.add_outbox([OutboxMessage(telegram_id, text, "Markdown")])
     except Exception as e:
-        logger.error(f"Не удалось отправить уведомление об ошибке: {e}")
+        logger.error(f"Не удалось поставить уведомление об ошибке в outbox: {e}")
+        return
+    if outbox:
+        outbox.wake()
 
 
-@app.get("/return")
+@router.get("/return")
 async def payment_return(request: Request):
     """
     Страница возврата после оплаты.
@@ -279,32 +543,86 @@ async def payment_return(request: Request):
     return HTMLResponse(html_content)
 
 
-@app.get("/health")
+@router.get("/health")
 async def health():
     """Проверка работоспособности"""
     return {"status": "ok"}
 
 
+app = FastAPI(title="VPN Bot Webhook", lifespan=lifespan)
+app.include_router(router)
+
+
+def configure(
+    cfg: Config,
+    database: Database,
+    rw_client: Optional[RemnawaveClient] = None,
+    bot: Optional[Bot] = None,
+    payment_service: Optional[PaymentService] = None,
+) -> None:
+    """Передать webhook-серверу общие сервисы процесса (БД, клиенты, бот)"""
+    global config, db, remnawave, telegram_bot, payments
+    config = cfg
+    db = database
+    remnawave = rw_client
+    telegram_bot = bot
+    payments = payment_service
+
+
 def run_webhook_server(
     cfg: Config,
     host: Optional[str] = None,
     port: Optional[int] = None,
 ) -> None:
-    """Запустить webhook сервер"""
-    global config, db, remnawave, telegram_bot
-
+    """Запустить только webhook сервер (без бота), со своими БД и клиентами"""
     # Логирование настраивается в main.py до вызова
-    config = cfg
-    db = Database()
-    remnawave = RemnawaveClient(cfg.remnawave)
-    telegram_bot = Bot(token=cfg.bot_token) if cfg.bot_token else None
+    yookassa: Optional[YookassaClient] = None
+    if cfg.yookassa_shop_id and cfg.yookassa_secret_key:
+        yookassa = YookassaClient(cfg.yookassa_shop_id, cfg.yookassa_secret_key)
+    database = Database()
+    configure(
+        cfg,
+        database,
+        RemnawaveClient(cfg.remnawave),
+        Bot(token=cfg.bot_token) if cfg.bot_token else None,
+        PaymentService(cfg, database, yookassa) if yookassa else None,
+    )
+
+    async def serve() -> None:
+        await database.init()
+        server = uvicorn.Server(uvicorn.Config(
+            app,
+            host=host or cfg.webhook_host,
+            port=port if port is not None else cfg.webhook_port,
+        ))
+        try:
+            await server.serve()
+        finally:
+            if yookassa:
+                await yookassa.aclose()
+
+    asyncio.run(serve())
 
-    host = host or cfg.webhook_host
-    port = port if port is not None else cfg.webhook_port
 
-    # Инициализация БД
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(db.init())
+@asynccontextmanager
+async def _worker_lifespan(_: FastAPI) -> AsyncIterator[None]:
+    """Ресурсы процесса-воркера: своё подключение к общей БД, без фоновых задач"""
+    cfg = Config.from_env()
+    # Обновления Telegram принимает только процесс бота
+    configure(replace(cfg, telegram_webhook_enabled=False), Database())
+    yield
 
-    uvicorn.run(app, host=host, port=port)
+
+def create_app() -> FastAPI:
+    """
+    Фабрика для нескольких процессов uvicorn (WEBHOOK_WORKERS > 1):
+    uvicorn webhook:create_app --factory --workers N
+
+    Воркер только принимает уведомления и пишет задачи в общую БД; дубликаты
+    отсекаются в БД (processed_events), активацию выполняет пул задач процесса бота.
+    """
+    from logging_config import setup_logging
+    setup_logging()
+    worker_app = FastAPI(title="VPN Bot Webhook", lifespan=_worker_lifespan)
+    worker_app.include_router(router)
+    return worker_app
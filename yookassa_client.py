@@ -1,86 +1,209 @@
-"""Клиент Yookassa для приёма платежей"""
+"""Асинхронный клиент Yookassa для приёма платежей (REST API v3)"""
+import asyncio
 import logging
 import time
 import uuid
-from typing import Optional
+from typing import Any, Optional
 
-from yookassa import Configuration, Payment
+import httpx
 
-from config import Config, PlanConfig
+import metrics
 
 logger = logging.getLogger(__name__)
 
+API_URL = "https://api.yookassa.ru/v3"
 
-def init_yookassa(shop_id: str, secret_key: str) -> None:
-    """Инициализировать Yookassa"""
-    Configuration.configure(shop_id, secret_key)
+# Коды, при которых запрос можно безопасно повторить с тем же ключом идемпотентности
+RETRYABLE_STATUSES = (202, 429, 500, 502, 503, 504)
 
 
-def create_payment(
-    amount: float,
-    description: str,
-    return_url: str,
-    metadata: Optional[dict] = None,
-) -> dict:
-    """
-    Создать платёж в Yookassa.
+class YookassaError(Exception):
+    """Ошибка API Yookassa"""
+    def __init__(self, message: str, status_code: Optional[int] = None, response: Optional[dict] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.response = response
+
 
-    Args:
-        amount: Сумма в рублях
-        description: Описание заказа
-        return_url: URL для возврата после оплаты
-        metadata: Дополнительные данные (telegram_id, plan_id и т.д.)
+class YookassaClient:
+    """
+    Клиент Yookassa поверх httpx.AsyncClient.
 
-    Returns:
-        Данные платежа с confirmation_url для редиректа
+    Одно соединение переиспользуется между запросами (keep-alive),
+    повторы ждут через asyncio.sleep и не блокируют event loop.
     """
-    idempotence_key = str(uuid.uuid4())
-    last_exc: Optional[Exception] = None
-
-    for attempt in range(3):
-        try:
-            payment = Payment.create(
-                {
-                    "amount": {
-                        "value": f"{amount:.2f}",
-                        "currency": "RUB",
-                    },
-                    "capture": True,
-                    "confirmation": {
-                        "type": "redirect",
-                        "return_url": return_url,
-                    },
-                    "description": description,
-                    "metadata": metadata or {},
-                },
-                idempotence_key,
+
+    def __init__(
+        self,
+        shop_id: str,
+        secret_key: str,
+        timeout: float = 15.0,
+        max_connections: int = 20,
+        max_attempts: int = 3,
+    ):
+        self.max_attempts = max_attempts
+        self._client = httpx.AsyncClient(
+            base_url=API_URL,
+            auth=(shop_id, secret_key),
+            timeout=timeout,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+                keepalive_expiry=60.0,
+            ),
+            headers={"Content-Type": "application/json"},
+        )
+
+    async def aclose(self) -> None:
+        """Закрыть пул соединений"""
+        await self._client.aclose()
+
+    async def _request(
+        self,
+        method: str,
+        path: str,
+        metric: str,
+        json_data: Optional[dict] = None,
+        params: Optional[dict] = None,
+        idempotence_key: Optional[str] = None,
+    ) -> dict:
+        """Выполнить запрос с повторами при временных ошибках"""
+        headers = {"Idempotence-Key": idempotence_key} if idempotence_key else None
+        delay = 1.0
+        for attempt in range(self.max_attempts):
+            last_try = attempt == self.max_attempts - 1
+            started = time.perf_counter()
+            try:
+                response = await self._client.request(
+                    method, path, json=json_data, params=params, headers=headers
+                )
+            except httpx.TransportError as e:
+                metrics.observe(metric, (time.perf_counter() - started) * 1000, ok=False)
+                if last_try:
+                    raise YookassaError(f"Ошибка соединения с Yookassa: {e}") from e
+                logger.warning(f"Yookassa retry {attempt + 1}/{self.max_attempts}: {e}")
+                await asyncio.sleep(delay)
+                delay *= 2
+                continue
+
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            ok = response.status_code == 200
+            metrics.observe(metric, elapsed_ms, ok=ok)
+            if ok:
+                return response.json()
+
+            body = _safe_json(response)
+            if response.status_code in RETRYABLE_STATUSES and not last_try:
+                # 202: запрос ещё обрабатывается — Yookassa сообщает, через сколько повторить
+                wait = delay
+                if response.status_code == 202 and body and body.get("retry_after"):
+                    wait = max(float(body["retry_after"]) / 1000, 0.1)
+                logger.warning(
+                    f"Yookassa retry {attempt + 1}/{self.max_attempts}: HTTP {response.status_code}"
+                )
+                await asyncio.sleep(wait)
+                delay *= 2
+                continue
+
+            description = (body or {}).get("description") or response.text[:500]
+            raise YookassaError(
+                f"Ошибка API Yookassa: {description}",
+                status_code=response.status_code,
+                response=body,
             )
-            return {
-                "id": payment.id,
-                "status": payment.status,
-                "amount": float(payment.amount.value),
-                "confirmation_url": payment.confirmation.confirmation_url if payment.confirmation else None,
-                "metadata": payment.metadata or {},
-            }
-        except Exception as e:
-            last_exc = e
-            retryable = "timeout" in str(e).lower() or "503" in str(e) or "502" in str(e)
-            if attempt < 2 and retryable:
-                logger.warning(f"Yookassa retry {attempt + 1}/3: {e}")
-                time.sleep(1.0 * (attempt + 1))
-            else:
-                raise
-
-    raise last_exc or Exception("Unknown Yookassa error")
-
-
-def get_payment(payment_id: str) -> dict:
-    """Получить информацию о платеже"""
-    payment = Payment.find_one(payment_id)
+        raise YookassaError("Unknown Yookassa error")
+
+    async def create_payment(
+        self,
+        amount: float,
+        description: str,
+        return_url: str,
+        metadata: Optional[dict] = None,
+        idempotence_key: Optional[str] = None,
+    ) -> dict:
+        """
+        Создать платёж в Yookassa.
+
+        Args:
+            amount: Сумма в рублях
+            description: Описание заказа
+            return_url: URL для возврата после оплаты
+            metadata: Дополнительные данные (telegram_id, plan_id и т.д.)
+            idempotence_key: Ключ идемпотентности (один на все повторы)
+
+        Returns:
+            Данные платежа с confirmation_url для редиректа
+        """
+        payload = {
+            "amount": {
+                "value": f"{amount:.2f}",
+                "currency": "RUB",
+            },
+            "capture": True,
+            "confirmation": {
+                "type": "redirect",
+                "return_url": return_url,
+            },
+            "description": description,
+            "metadata": metadata or {},
+        }
+        payment = await self._request(
+            "POST",
+            "/payments",
+            metric="yookassa.create_payment",
+            json_data=payload,
+            idempotence_key=idempotence_key or str(uuid.uuid4()),
+        )
+        return _payment_to_dict(payment)
+
+    async def get_payment(self, payment_id: str) -> dict:
+        """Получить информацию о платеже"""
+        payment = await self._request(
+            "GET", f"/payments/{payment_id}", metric="yookassa.get_payment"
+        )
+        return _payment_to_dict(payment)
+
+    async def list_payments(
+        self,
+        created_gte: str,
+        limit: int = 100,
+        cursor: Optional[str] = None,
+    ) -> tuple[list[dict], Optional[str]]:
+        """
+        Список платежей магазина, созданных не раньше created_gte (ISO 8601).
+
+        Returns:
+            (платежи, курсор следующей страницы или None)
+        """
+        params: dict[str, Any] = {"created_at.gte": created_gte, "limit": limit}
+        if cursor:
+            params["cursor"] = cursor
+        data = await self._request(
+            "GET", "/payments", metric="yookassa.list_payments", params=params
+        )
+        items = [_payment_to_dict(p) for p in data.get("items") or []]
+        return items, data.get("next_cursor")
+
+
+def _safe_json(response: httpx.Response) -> Optional[dict]:
+    """Безопасно распарсить JSON из ответа; при ошибке — None."""
+    try:
+        data = response.json()
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def _payment_to_dict(payment: dict[str, Any]) -> dict:
+    """Привести объект платежа API к формату, который использует бот"""
+    confirmation = payment.get("confirmation") or {}
+    amount = payment.get("amount") or {}
     return {
-        "id": payment.id,
-        "status": payment.status,
-        "paid": payment.paid,
-        "amount": float(payment.amount.value),
-        "metadata": payment.metadata or {},
+        "id": payment.get("id"),
+        "status": payment.get("status"),
+        "paid": bool(payment.get("paid")),
+        "amount": float(amount.get("value") or 0),
+        "confirmation_url": confirmation.get("confirmation_url"),
+        "metadata": payment.get("metadata") or {},
+        "created_at": payment.get("created_at"),
     }